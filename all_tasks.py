@@ -1,157 +1,221 @@
-from video_generator import *
-from all_tasks_func import *
-from datetime import datetime, timedelta
-import sys
-import logging
-from tensorflow.keras.models import load_model
-from collections import deque
-import numpy as np
-import os
-import pandas as pd
-from multiprocessing import Pool, cpu_count, get_context
-import multiprocessing as mp
-
-# get args from command line
-if len(sys.argv) > 1:
-    args = sys.argv
-
-# set GPU devices to empty
-os.environ["CUDA_VISIBLE_DEVICES"] = ""
-
-if __name__ == '__main__':
-
-    # print code start running
-    print(f'code running, args = {args[1:]}')
-
-    # init log file
-    logging.basicConfig(filename='all_tasks.log',
-                        # encoding='utf-8',
-                        format='%(asctime)s %(levelname)-8s %(message)s',
-                        level=logging.INFO,
-                        datefmt='%Y-%m-%d %H:%M:%S')
-
-    logging.info('all_task test code start ' +
-                 datetime.now().strftime("%H:%M:%S"))
-
-    # use start_date and end_date to get needed folder paths
-    try:
-        start_date_str, end_date_str = args[1], args[2]
-
-        start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
-        end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
-
-        # format: ['stream0/2010/10/01', ...]
-        subfolder_paths = get_subfolders_in_range(
-            start_date, end_date, folder_path=stream0_path)
-        logging.info(
-            f'getting paths from {subfolder_paths[0]} to {subfolder_paths[-1]}')
-
-    except Exception as e:
-        print(f'Start or end date not valid, Exception: {e}')
-        sys.exit()
-
-    # set the num of workers for multiprocessing later. default as the cpu_count.
-    try:
-        if len(args)>3:
-            num_workers = int(args[3])
-        else:
-            num_workers = cpu_count()
-    except Exception as e:
-        print(f'Number of processors not valid, Exception: {e}')
-        sys.exit()
-
-    # decompress the images to a dictionary
-    # address example: stream0/2011/08/08/mcgr_themis11/ut09/
-    # iterate through date folders
-    for date_folder_path in subfolder_paths:  # stream0/2011/08/08
-        logging.info(
-            f'Processing date_folder_path = {date_folder_path}, {datetime.now().strftime("%H:%M:%S")}')
-
-        # Iterate over the child folders (each camera) in the outer folder
-        for asi_name in os.listdir(date_folder_path)[0:1]:  # /mcgr_themis11
-
-            # camera_dict example k-v pair: {'atha20200104000206':img[:,:,:]}
-            camera_dict = {}
-
-            logging.info(
-                f'Processing asi = {asi_name}')
-            asi_folder_path = os.path.join(date_folder_path, asi_name)
-            hours = []
-
-            for hour_name in os.listdir(asi_folder_path):  # /ut09
-                # check if it is a sub folder
-                hour_folder_path = os.path.join(asi_folder_path, hour_name)
-                if os.path.isdir(hour_folder_path):
-                    hours.append(hour_folder_path)
-
-            for hour in hours[0:1]:
-                decompress_pgm_files_to_dict(hour, camera_dict)
-
-            logging.info(f'asi_name = {asi_name}, date = {date_folder_path} decompressed')
-
-            try:
-                # init a dataframe to store information
-                df = pd.DataFrame(
-                    columns=['date', 'time', 'prediction', 'prediction_str', 'confidence'])
-                
-                if not camera_dict:
-                    logging.info(
-                        f'DATE SKIPPED: camera_dict empty, asi_name = {asi_name}, date = {date_folder_path}')
-                    del camera_dict
-                    continue
-
-
-            except Exception as e:
-                logging.CRITICAL(f'Error occurs in making dataframe as {e}')
-                logging.CRITICAL(f'DATE SKIPPED: asi_name = {asi_name}, date = {date_folder_path}')
-                continue # if exception, go to next asi camera
-
-            # try multiprocessing steps
-            try: 
-                logging.info(f'starting multiprocessing')
-                # Create a pool of worker processes
-                num_workers = num_workers
-                pool = get_context("spawn").Pool(processes=num_workers)
-                logging.info(f'pool generated, num_workers = {num_workers}')
-
-                # Map the process_image function to each item in camera_dict using multiprocessing
-                results = pool.map(process_image, camera_dict.items())
-                del camera_dict
-
-                # Close the pool of worker processes
-                pool.close()
-                pool.join()
-                logging.info(f'Pool joined')
-
-                # Append the processed rows to the DataFrame
-                for result in results:
-                    new_row, directory_path, ymd_str = result
-                    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-                
-                del results
-                logging.info(f'dataframe generated')
-
-            except Exception as e:
-                logging.CRITICAL(f'Error occurs in multiprocessing as {e}')
-                logging.CRITICAL(
-                    f'DATE SKIPPED: asi_name = {asi_name}, date = {date_folder_path}')
-                continue  # if exception, go to next asi camera
-
-            try:  
-                if not os.path.exists(directory_path):
-                    os.makedirs(directory_path)
-                # needed info: date, time, prediction, prediction_str, confidence
-                logging.info(f'writing dataframe to txt file.')
-                with open(os.path.join(directory_path, ymd_str+'_'+asi_name+"_classifications.txt"), "w") as f:
-                    # create the comment section
-                    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    comment = f"# File created on {now}\n# This file contains the predictions generated by the model.\n\n"
-                    f.write(comment)
-                    df.to_csv(f, sep='\t', index=False)
-                    
-                del df
-                logging.info(f'date_folder_path={date_folder_path}, asi={asi_name} results generated, time = {datetime.now().strftime("%H:%M:%S")}')
-            except Exception as e:
-                logging.CRITICAL(
-                    f'Error occurs in outputing resultsfor asi_name = {asi_name}, date = {date_folder_path} as {e}')
-                continue
+from video_generator import *
+from all_tasks_func import *
+import manifest
+import sharding
+import classification_index
+import frame_cache
+import instrumentation
+from datetime import datetime, timedelta
+import sys
+import argparse
+import logging
+from collections import deque
+import numpy as np
+import os
+import pandas as pd
+from multiprocessing import Pool, cpu_count, get_context
+import multiprocessing as mp
+from functools import partial
+
+# set GPU devices to empty
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+# (date, camera) units of the date range for this process, claimed and marked running as the pipeline asks for them
+def pending_units(subfolder_paths, conn, version, shard=None, queue_folder_path=None):
+    # address example: stream0/2011/08/08/mcgr_themis11/ut09/
+    # iterate through date folders
+    for date_folder_path in subfolder_paths:  # stream0/2011/08/08
+        logging.info(
+            f'Processing date_folder_path = {date_folder_path}, {datetime.now().strftime("%H:%M:%S")}')
+        date = folder_date(date_folder_path)
+        date_str = date.strftime('%Y-%m-%d')
+
+        # Iterate over the child folders (each camera) in the outer folder
+        for asi_name in sorted(os.listdir(date_folder_path)):  # /mcgr_themis11
+
+            # this process only takes the units of its shard, or the units it claims from the queue
+            if shard is not None and sharding.shard_of(date_str, asi_name, shard[1]) != shard[0]:
+                continue
+            claim = None
+            if queue_folder_path is not None:
+                claim = sharding.claim_unit(queue_folder_path, date_str, asi_name)
+                if claim is None:
+                    logging.info(f'CLAIMED ELSEWHERE: asi_name = {asi_name}, date = {date_folder_path}')
+                    continue
+
+            # only the hours that are not done with the same files and model are classified
+            asi_folder_path = os.path.join(date_folder_path, asi_name)
+            hours = list_hours(asi_folder_path)
+            fingerprints = {hour: manifest.fingerprint_folder(hour) for hour in hours}
+            pending = [hour for hour in hours
+                       if manifest.needs_run(conn, date_str, asi_name, os.path.basename(hour), fingerprints[hour], version)]
+            if not pending:
+                logging.info(f'ALREADY DONE: asi_name = {asi_name}, date = {date_folder_path}')
+                if claim is not None:
+                    sharding.release_unit(claim, True)
+                continue
+            for hour in pending:
+                manifest.mark(conn, date_str, asi_name, os.path.basename(hour), manifest.RUNNING,
+                              fingerprint=fingerprints[hour], model_version=version)
+
+            logging.info(
+                f'Processing asi = {asi_name}, {len(pending)} of {len(hours)} hours pending')
+            yield {'hours': pending,
+                   'txt_path': classification_path(date, asi_name),
+                   'keep_hours': [os.path.basename(hour) for hour in hours if hour not in pending],
+                   'attrs': {'asi': asi_name, 'date': date_str, 'model_version': version},
+                   'date_folder_path': date_folder_path,
+                   'date_str': date_str,
+                   'asi_name': asi_name,
+                   'claim': claim}
+
+# called by the pipeline writer after each unit: record the finished and failed hours and release the claim
+def unit_done(unit, row_num, failed_hours, conn=None, index_conn=None):
+    date_str, asi_name, txt_path = unit['date_str'], unit['asi_name'], unit['txt_path']
+    for hour in unit['hours']:
+        if hour in failed_hours:
+            manifest.mark(conn, date_str, asi_name, os.path.basename(hour), manifest.FAILED,
+                          error='unable to classify')
+        else:
+            manifest.mark(conn, date_str, asi_name, os.path.basename(hour), manifest.DONE,
+                          output_path=txt_path if row_num else None)
+    if unit['claim'] is not None:
+        sharding.release_unit(unit['claim'], not failed_hours)
+
+    # keep the query index up to date with the new store
+    if index_conn is not None and row_num:
+        try:
+            classification_index.index_file(index_conn, store_path(txt_path))
+        except Exception as e:
+            logging.critical(f'Error occurs when indexing {txt_path} as {e}')
+
+    if row_num == 0:
+        logging.info(
+            f'DATE SKIPPED: no frames decompressed, asi_name = {asi_name}, date = {unit["date_folder_path"]}')
+    else:
+        logging.info(f'date_folder_path={unit["date_folder_path"]}, asi={asi_name} results generated at {txt_path}, time = {datetime.now().strftime("%H:%M:%S")}')
+
+if __name__ == '__main__':
+
+    # get args from command line
+    # usage: python all_tasks.py start_date end_date [num_workers] [batch_size] [max_memory_mb]
+    #        [--decode-depth n] [--write-depth n] [--infer-threads n] [--manifest path] [--shard i/N | --queue folder]
+    #        [--index path] [--frame-cache folder] [--frame-cache-mb n] [--metrics path]
+    parser = argparse.ArgumentParser(description='Classify the THEMIS images in stream0 between two dates.')
+    parser.add_argument('start_date', help='format: YYYY-MM-DD')
+    parser.add_argument('end_date', help='format: YYYY-MM-DD')
+    parser.add_argument('num_workers', nargs='?', type=int, default=cpu_count(),
+                        help='number of decompress workers, default as the cpu_count')
+    parser.add_argument('batch_size', nargs='?', type=int, default=batch_size,
+                        help='number of frames in each model prediction')
+    parser.add_argument('max_memory_mb', nargs='?', type=int, default=None,
+                        help='memory ceiling in MB of the decoded hours in flight, sets --decode-depth')
+    parser.add_argument('--manifest', default='./all_tasks_manifest.sqlite',
+                        help='sqlite file recording the finished (date, asi, hour) units, use one per host on network filesystems')
+    parser.add_argument('--decode-depth', type=int, default=2,
+                        help='number of hours decompressed ahead of the model')
+    parser.add_argument('--write-depth', type=int, default=4,
+                        help='number of classified hours waiting for the writer')
+    parser.add_argument('--infer-threads', type=int, default=None,
+                        help='number of TensorFlow threads of the model, default lets TensorFlow decide')
+    parser.add_argument('--shard', default=None,
+                        help='i/N, only classify the (date, camera) units of shard i out of N, 0 <= i < N')
+    parser.add_argument('--queue', default=None,
+                        help='folder shared by several workers that claim (date, camera) units with file locks')
+    parser.add_argument('--index', default=None,
+                        help='sqlite file of the classification index to update as each (date, camera) is written')
+    parser.add_argument('--frame-cache', default=None,
+                        help='folder caching the decoded hours, later runs memory-map them instead of decompressing again')
+    parser.add_argument('--frame-cache-mb', type=int, default=frame_cache.max_cache_mb,
+                        help='size limit in MB of the frame cache, the least recently used hours are evicted above it')
+    parser.add_argument('--metrics', default='./all_tasks_metrics.jsonl',
+                        help='JSONL file receiving the decode, contrast, preprocess, infer and write spans of every hour')
+    args = parser.parse_args()
+
+    # print code start running
+    print(f'code running, args = {sys.argv[1:]}')
+
+    # init log file
+    logging.basicConfig(filename='all_tasks.log',
+                        # encoding='utf-8',
+                        format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    logging.info('all_task test code start ' +
+                 datetime.now().strftime("%H:%M:%S"))
+
+    # set before the workers are spawned, so they append their spans to the same file
+    run = instrumentation.configure(args.metrics)
+    logging.info(f'metrics {args.metrics}, run = {run}')
+
+    # use start_date and end_date to get needed folder paths
+    try:
+        start_date = datetime.strptime(args.start_date, "%Y-%m-%d")
+        end_date = datetime.strptime(args.end_date, "%Y-%m-%d")
+
+        # format: ['stream0/2010/10/01', ...]
+        subfolder_paths = get_subfolders_in_range(
+            start_date, end_date, folder_path=stream0_path)
+        logging.info(
+            f'getting paths from {subfolder_paths[0]} to {subfolder_paths[-1]}')
+
+    except Exception as e:
+        print(f'Start or end date not valid, Exception: {e}')
+        sys.exit()
+
+    try:
+        shard = sharding.parse_shard(args.shard) if args.shard is not None else None
+    except ValueError as e:
+        print(f'Shard not valid, Exception: {e}')
+        sys.exit()
+
+    num_workers = args.num_workers
+    batch_size = args.batch_size
+    # the memory ceiling bounds the hours decompressed ahead of the model
+    if args.max_memory_mb is not None:
+        args.decode_depth = decode_depth_for(args.max_memory_mb, batch_size)
+
+    # load the model once in this process and keep it warm for the whole date range, the workers only decompress and clahe the images
+    tic = datetime.now()
+    load_classifier(threads=args.infer_threads)
+    model_load_seconds = (datetime.now() - tic).total_seconds()
+    model_warmup_seconds = warm_classifier(batch_size)
+    version = model_version()
+    logging.info(f'metric model_load_seconds = {model_load_seconds:.3f}, model_warmup_seconds = {model_warmup_seconds:.3f}')
+
+    # the manifest lets a rerun skip finished hours and retry the failed ones
+    conn = manifest.open_manifest(args.manifest)
+    logging.info(f'manifest {args.manifest}, model version = {version}, states = {manifest.summary(conn)}')
+    logging.info(f'shard = {args.shard}, queue = {args.queue}')
+    index_conn = classification_index.open_index(args.index) if args.index is not None else None
+
+    # one warm pool for the whole run: the workers decompress and clahe the hours, the model runs in batches
+    # in this process and a writer thread writes the files
+    pool, startup = start_worker_pool(num_workers)
+    logging.info(f'pool generated, num_workers = {num_workers}, decode_depth = {args.decode_depth}, write_depth = {args.write_depth}')
+    logging.info(f'metric pool_startup_seconds = {startup["pool_startup_seconds"]:.3f}, '
+                 f'worker_init_seconds = {startup["worker_init_seconds"]:.3f}, worker_ready_seconds = {startup["worker_ready_seconds"]:.3f}')
+    print(f'startup: model load {model_load_seconds:.1f} s, model warmup {model_warmup_seconds:.1f} s, '
+          f'pool {startup["pool_startup_seconds"]:.1f} s for {startup["workers_started"]} workers')
+    try:
+        units = pending_units(subfolder_paths, conn, version, shard=shard, queue_folder_path=args.queue)
+        unit_num = classify_units(units, pool=pool, batch_size=batch_size,
+                                  decode_depth=args.decode_depth, write_depth=args.write_depth,
+                                  on_unit_done=partial(unit_done, conn=conn, index_conn=index_conn),
+                                  cache_folder_path=args.frame_cache, max_cache_mb=args.frame_cache_mb)
+        logging.info(f'{unit_num} units classified')
+    except Exception as e:
+        logging.critical(f'Error occurs in the classification pipeline as {e}')
+    finally:
+        # Close the pool of worker processes
+        pool.shutdown(cancel_futures=True)
+        logging.info(f'Pool joined')
+
+    logging.info(f'all_task done, manifest states = {manifest.summary(conn)}')
+    summary = instrumentation.format_summary(instrumentation.summarize(instrumentation.read_metrics(args.metrics, run)))
+    logging.info('metrics summary\n'+summary)
+    print(summary)
+    conn.close()
+    if index_conn is not None:
+        index_conn.close()
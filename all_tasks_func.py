@@ -1,115 +1,648 @@
-from video_generator import *
-from datetime import datetime, timedelta
-import logging
-from tensorflow.keras.models import load_model
-from collections import deque
-import numpy as np
-import pickle
-import cv2
-import os
-
-# set the folder path for stream0
-stream0_path = './stream0'
-# stream0_path = 'D:\stream0'
-
-# load trained model
-model_path = './CNN_model'
-# model_path = 'F:\pa_sample_models\CNN model'
-model = load_model(
-    os.path.join(model_path, 'model', 'CNN_0524.model'))
-
-# load the binarized class labels
-lb_path = os.path.join(model_path, "model/lb_4c.pickle")
-lb = pickle.loads(open(lb_path, "rb").read())
-
-# Predictions queue. The prediction is smoothed by
-# the averarge of past "maxlen" frames
-Q = deque(maxlen=20)
-
-# np.array to cut the bourndary of the frames
-elev_angle = np.load(os.path.join(model_path, "T_angle.npy"))
-angle = 15
-
-# get the dates available between start_date and end_date in folder_path that points to stream0 folder
-def get_subfolders_in_range(start_date, end_date, folder_path=stream0_path):
-    subfolder_paths = []
-    current_date = start_date
-    while current_date <= end_date:
-        year = str(current_date.year)
-        month = f"{current_date.month:02d}"
-        day = f"{current_date.day:02d}"
-        subfolder_path = os.path.join(folder_path, year, month, day)
-        if os.path.exists(subfolder_path):
-            subfolder_paths.append(subfolder_path)
-        current_date += timedelta(days=1)
-    return subfolder_paths
-
-# helper function that decompress one folder
-def decompress_pgm_files_to_dict(folder_path, img_dict):
-    logging.info('decompressing hour = '+folder_path[-4:]+'  '+folder_path)
-    # folder_path: str, should be ut** folder path
-
-    # get all compressed images absolute path in the folder, exclude hidden files and different shape files
-    file_names = os.listdir(folder_path)
-    file_names = [folder_path+'/' +
-                  f for f in file_names if 'full' in f and not f.startswith('.')]
-
-    # read the images using themis_imager_readfile - input is the list of absolute paths to compressed images
-    try:
-        img, meta, problematic_files = themis_imager_readfile.read(file_names)
-        frame_num = img.shape[2]
-    except:
-        return
-
-    for frame in range(frame_num):
-        # '2020-01-04 00:02:06.053611 UTC'
-        strtime = meta[frame]['Image request start']
-        # 'datetime.datetime(2020, 1, 4, 0, 2, 6, 53611)'
-        dt = datetime.strptime(strtime, "%Y-%m-%d %H:%M:%S.%f %Z")
-        # '20200104000206'
-        dt = dt.strftime('%Y%m%d%H%M%S')
-        key = meta[frame]['Site unique ID']+dt
-        value = img[:, :, frame]
-        img_dict[key] = value
-
-    return
-
-# input should be a frame/image, output (predition, label)
-def pred_frame(image):
-    try:
-        frame = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) # convert the frame to RGB color
-        frame = cv2.resize(frame, (256, 256)).astype("float32") # resize the frame to 256 by 256 to cut the boundary
-        frame[elev_angle < angle] = 0 #cut the boundary
-        frame = cv2.resize(frame, (224, 224)).astype("float32") # resize the frame to 224 by 224 for prediction
-        preds = model(np.expand_dims(frame, axis=0))[0] # prediction
-        i = np.argmax(preds)
-        confidence = np.max(preds)
-        label = lb.classes_[i]
-        return preds, label, i, confidence
-    except Exception as e:
-        logging.CRITICAL(f'unable to pred_frame, error = {e}')
-        return e
-
-    
-
-
-def process_image(item):
-    key, value = item
-    dt = datetime.strptime(key[4:], '%Y%m%d%H%M%S')
-    year, month, day = str(dt.year), str(dt.month), str(dt.day)
-    directory_path = os.path.join(year, month, day)
-    ymd_str = dt.strftime('%Y%m%d')
-    time_str = dt.strftime('%H:%M:%S')
-
-    try: 
-        # process the image using clahe
-        clahe = cv2.createCLAHE(clipLimit=3, tileGridSize=(8, 8))
-        value = cv2.convertScaleAbs(clahe.apply(value), alpha=(255.0/65535.0))
-
-        # classification name format: YYYY/MM/DD/YYYYMMDD_site_themis##_classifications.txt
-        preds, prediction_str, prediction, confidence = pred_frame(value)
-        new_row = {'date': ymd_str, 'time': time_str, 'prediction': prediction,
-                'prediction_str': prediction_str, 'confidence': confidence}        
-        return new_row, directory_path, ymd_str
-    except:
-        return 
+from video_generator import *
+from video_generator import _read_hour
+import frame_cache
+import instrumentation
+from classification_store import create_store, append_rows, keys_to_timestamps, read_store, store_path, export_txt
+from prediction_events import events_path, export_events
+from datetime import datetime, timedelta
+import logging
+from collections import deque
+import numpy as np
+import pickle
+import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+import cv2
+import os
+import pandas as pd
+import h5py
+
+# set the folder path for stream0
+stream0_path = './stream0'
+# stream0_path = 'D:\stream0'
+
+# trained model folder
+model_path = './CNN_model'
+# model_path = 'F:\pa_sample_models\CNN model'
+
+# number of frames sent to the model in each predict_on_batch call
+batch_size = 64
+
+# memory ceiling in MB for the decoded hours in flight and the batch buffers, see decode_depth_for()
+max_memory_mb = 2048
+
+# one hour of clahe frames at 3 s cadence, used to size the decode queue
+_hour_bytes = 1200 * 256 * 256
+
+# frames of a shared memory slot, one hour at 3 s cadence with some margin. Larger hours are pickled back instead
+_slot_frames = 1280
+
+# the model and the binarized class labels are loaded once per process by load_classifier()
+model = None
+lb = None
+
+# per-process state of the decode workers, set up once by init_worker()
+_clahe = None
+_worker_startup_seconds = None
+_worker_ready_time = None
+
+# np.array to cut the bourndary of the frames
+elev_angle = np.load(os.path.join(model_path, "T_angle.npy"))
+angle = 15
+
+# boundary masks per resolution and flat scratch buffers per name, filled on first use
+_elev_masks = {}
+_stack_buffers = {}
+
+# the cv2 python bindings take at most 128 channels, so stacks are resized in blocks of frames
+_resize_block = 128
+
+# load trained model and the binarized class labels, only the first call reads them from disk
+# threads sets the number of TensorFlow threads used by each prediction, default lets TensorFlow decide
+def load_classifier(threads=None):
+    global model, lb
+    if model is None:
+        import tensorflow as tf
+        from tensorflow.keras.models import load_model
+        if threads:
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+        model = load_model(
+            os.path.join(model_path, 'model', 'CNN_0524.model'))
+        lb_path = os.path.join(model_path, "model/lb_4c.pickle")
+        lb = pickle.loads(open(lb_path, "rb").read())
+        logging.info('classifier loaded')
+    return model, lb
+
+# run one zero batch through the model so the first real batch does not pay for graph tracing, returns seconds taken
+def warm_classifier(batch_size=batch_size):
+    model, lb = load_classifier()
+    tic = time.perf_counter()
+    model.predict_on_batch(np.zeros((batch_size, 224, 224, 3), dtype="float32"))
+    return time.perf_counter() - tic
+
+# initializer of the decode workers: no GPU, and the CLAHE object and boundary mask are built once per worker
+def init_worker():
+    global _worker_startup_seconds, _worker_ready_time
+    tic = time.perf_counter()
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    _get_clahe()
+    _elev_mask((256, 256))
+    _worker_startup_seconds = time.perf_counter() - tic
+    _worker_ready_time = time.time()
+
+# pid, initializer time and time of readiness of the worker that runs it. Every worker waits at the barrier,
+# so a warm worker cannot answer for one that is still starting
+def _worker_startup(barrier, timeout):
+    barrier.wait(timeout)
+    return os.getpid(), _worker_startup_seconds, _worker_ready_time
+
+def start_worker_pool(num_workers):
+    """ Start the long-lived pool of decode workers and wait until every worker is warm
+    Inputs:
+        num_workers: int. Number of worker processes
+    Returns:
+        pool: concurrent.futures.ProcessPoolExecutor. themis_imager_readfile.read starts its own pool,
+              so the workers must not be daemonic as in multiprocessing.Pool
+        startup: dict. 'pool_startup_seconds' until every worker answered, 'worker_init_seconds' the slowest initializer,
+                 'worker_ready_seconds' the slowest spawn, import and initializer of a worker from the pool creation,
+                 'workers_started' the number of distinct workers that answered
+    """
+    tic = time.perf_counter()
+    start_time = time.time()
+    context = get_context("spawn")
+    pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=context, initializer=init_worker)
+
+    # one task per worker, each one holds its worker at the barrier until every worker has started
+    timeout = 600
+    with context.Manager() as manager:
+        barrier = manager.Barrier(num_workers)
+        answers = list(pool.map(_worker_startup, [barrier] * num_workers, [timeout] * num_workers))
+    startup = {'pool_startup_seconds': time.perf_counter() - tic,
+               'worker_init_seconds': max(seconds for pid, seconds, ready_time in answers),
+               'worker_ready_seconds': max(ready_time - start_time for pid, seconds, ready_time in answers),
+               'workers_started': len({pid for pid, seconds, ready_time in answers})}
+    logging.info(f'worker pool started: {startup}')
+    return pool, startup
+
+# version of the trained model, changes whenever the model or label files change
+def model_version():
+    digest = hashlib.sha1()
+    model_files = [os.path.join(model_path, "model/lb_4c.pickle")]
+    for root, dirs, file_names in os.walk(os.path.join(model_path, 'model', 'CNN_0524.model')):
+        dirs.sort()
+        model_files.extend(os.path.join(root, f) for f in sorted(file_names))
+    if os.path.isfile(os.path.join(model_path, 'model', 'CNN_0524.model')):
+        model_files.append(os.path.join(model_path, 'model', 'CNN_0524.model'))
+    for file_path in model_files:
+        if os.path.isfile(file_path):
+            digest.update(os.path.relpath(file_path, model_path).encode())
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024**2), b''):
+                    digest.update(block)
+    return 'CNN_0524-' + digest.hexdigest()[:12]
+
+# get the dates available between start_date and end_date in folder_path that points to stream0 folder
+def get_subfolders_in_range(start_date, end_date, folder_path=stream0_path):
+    subfolder_paths = []
+    current_date = start_date
+    while current_date <= end_date:
+        year = str(current_date.year)
+        month = f"{current_date.month:02d}"
+        day = f"{current_date.day:02d}"
+        subfolder_path = os.path.join(folder_path, year, month, day)
+        if os.path.exists(subfolder_path):
+            subfolder_paths.append(subfolder_path)
+        current_date += timedelta(days=1)
+    return subfolder_paths
+
+# helper function that decompress one folder
+def decompress_pgm_files_to_dict(folder_path, img_dict):
+    logging.info('decompressing hour = '+folder_path[-4:]+'  '+folder_path)
+    # folder_path: str, should be ut** folder path
+
+    # get all compressed images absolute path in the folder, exclude hidden files and different shape files
+    file_names = os.listdir(folder_path)
+    file_names = [folder_path+'/' +
+                  f for f in file_names if 'full' in f and not f.startswith('.')]
+
+    # read the images using themis_imager_readfile - input is the list of absolute paths to compressed images
+    try:
+        img, meta, problematic_files = themis_imager_readfile.read(file_names)
+        frame_num = img.shape[2]
+    except:
+        return
+
+    for frame in range(frame_num):
+        # '2020-01-04 00:02:06.053611 UTC'
+        strtime = meta[frame]['Image request start']
+        # 'datetime.datetime(2020, 1, 4, 0, 2, 6, 53611)'
+        dt = datetime.strptime(strtime, "%Y-%m-%d %H:%M:%S.%f %Z")
+        # '20200104000206'
+        dt = dt.strftime('%Y%m%d%H%M%S')
+        key = meta[frame]['Site unique ID']+dt
+        value = img[:, :, frame]
+        img_dict[key] = value
+
+    return
+
+# CLAHE object of this process, created on first use
+def _get_clahe():
+    global _clahe
+    if _clahe is None:
+        _clahe = cv2.createCLAHE(clipLimit=3, tileGridSize=(8, 8))
+    return _clahe
+
+# clahe the 16 bit frame and downscale the result to 8 bit
+def clahe_frame(image):
+    return cv2.convertScaleAbs(_get_clahe().apply(image), alpha=(255.0/65535.0))
+
+# cut the boundary and resize an 8 bit frame to the (224, 224, 3) model input
+def preprocess_frame(image):
+    frame = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) # convert the frame to RGB color
+    frame = cv2.resize(frame, (256, 256)).astype("float32") # resize the frame to 256 by 256 to cut the boundary
+    frame[elev_angle < angle] = 0 #cut the boundary
+    frame = cv2.resize(frame, (224, 224)).astype("float32") # resize the frame to 224 by 224 for prediction
+    return frame
+
+# float32 mask of shape (H, W, 1), 0 where the elevation angle is below the cut and 1 elsewhere
+def _elev_mask(shape):
+    if shape not in _elev_masks:
+        angles = elev_angle
+        if angles.shape != shape:
+            angles = cv2.resize(angles.astype("float32"), (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+        _elev_masks[shape] = (angles >= angle).astype("float32")[:, :, np.newaxis]
+    return _elev_masks[shape]
+
+# reusable contiguous scratch buffer of the given shape, only grows when a larger shape is asked for
+def _stack_buffer(name, shape, dtype):
+    size = int(np.prod(shape))
+    buffer = _stack_buffers.get(name)
+    if buffer is None or buffer.dtype != np.dtype(dtype) or buffer.size < size:
+        buffer = np.empty(size, dtype=dtype)
+        _stack_buffers[name] = buffer
+    return buffer[:size].reshape(shape)
+
+# cut the boundary and resize a stack of 8 bit frames (H, W, N) to the (N, 224, 224, 3) model input
+# matches preprocess_frame() on every frame up to float32 rounding, the gray channel is only copied to 3 channels at the end
+def preprocess_stack(frames, out=None):
+    frame_num = frames.shape[2]
+    if out is None:
+        out = np.empty((frame_num, 224, 224, 3), dtype="float32")
+    mask = _elev_mask((256, 256))
+
+    for start in range(0, frame_num, _resize_block):
+        stop = min(start + _resize_block, frame_num)
+        block_num = stop - start
+
+        # resize to 256 by 256 to cut the boundary, then apply the mask to every frame at once
+        resized = _stack_buffer('resized', (256, 256, block_num), frames.dtype)
+        if block_num > 1:
+            cv2.resize(frames[:, :, start:stop], (256, 256), dst=resized)
+        else:
+            resized[:, :, 0] = cv2.resize(frames[:, :, start], (256, 256))
+        masked = _stack_buffer('masked', (256, 256, block_num), "float32")
+        np.multiply(resized, mask, out=masked)
+
+        # resize to 224 by 224 for prediction
+        small = _stack_buffer('small', (224, 224, block_num), "float32")
+        if block_num > 1:
+            cv2.resize(masked, (224, 224), dst=small)
+        else:
+            small[:, :, 0] = cv2.resize(masked[:, :, 0], (224, 224))
+
+        # frames first, gray copied to the 3 channels
+        out[start:stop] = np.moveaxis(small, 2, 0)[:, :, :, np.newaxis]
+
+    return out
+
+# input should be a frame/image, output (predition, label)
+def pred_frame(image):
+    try:
+        model, lb = load_classifier()
+        frame = preprocess_frame(image)
+        preds = model(np.expand_dims(frame, axis=0))[0] # prediction
+        i = np.argmax(preds)
+        confidence = np.max(preds)
+        label = lb.classes_[i]
+        return preds, label, i, confidence
+    except Exception as e:
+        logging.critical(f'unable to pred_frame, error = {e}')
+        return e
+
+# producer task: decompress one ut** folder and clahe every frame, no model needed. keys is None if the hour failed.
+# With slot_name the frames are written into that shared memory slot and only their number is returned,
+# otherwise the frames are returned as an array. With cache_folder_path the decoded hour is read from or added to the frame cache
+def decompress_and_clahe_hour(folder_path, slot_name=None, cache_folder_path=None, max_cache_mb=frame_cache.max_cache_mb):
+    logging.info('decompressing hour = '+folder_path[-4:]+'  '+folder_path)
+    try:
+        img, keys = _read_hour(folder_path, cache_folder_path=cache_folder_path, max_cache_mb=max_cache_mb)
+    except Exception as e:
+        logging.warning(f'unable to decompress {folder_path}, error = {e}')
+        return None, None
+
+    frame_num = img.shape[2]
+    if slot_name is None or img.shape[:2] != (256, 256) or frame_num > _slot_frames:
+        frames = np.empty(img.shape, dtype=np.uint8)
+        _clahe_hour(img, frames, folder_path)
+        return keys, frames
+
+    slot = shared_memory.SharedMemory(name=slot_name)
+    try:
+        frames = _slot_array(slot)
+        _clahe_hour(img, frames, folder_path)
+        del frames
+    finally:
+        slot.close()
+    return keys, frame_num
+
+# clahe every frame of a decoded hour into frames, which may be longer than the hour
+def _clahe_hour(img, frames, folder_path):
+    with instrumentation.span('contrast', method='clahe', **instrumentation.path_labels(folder_path)) as record:
+        for frame in range(img.shape[2]):
+            frames[:, :, frame] = clahe_frame(img[:, :, frame])
+        record['frames'] = img.shape[2]
+
+# (256, 256, _slot_frames) uint8 view of a shared memory slot
+def _slot_array(slot):
+    return np.ndarray((256, 256, _slot_frames), dtype=np.uint8, buffer=slot.buf)
+
+def open_slots(slot_num):
+    """ Create the shared memory slots that receive the clahe frames of the hours in flight,
+    so the decode workers hand the frames over without pickling them
+    Inputs:
+        slot_num: int. Number of hours in flight, the decode depth
+    Returns:
+        slots: list of multiprocessing.shared_memory.SharedMemory, free them with close_slots()
+    """
+    return [shared_memory.SharedMemory(create=True, size=256 * 256 * _slot_frames) for _ in range(slot_num)]
+
+def close_slots(slots):
+    """ Release the slots of open_slots(), every array viewing them must be gone """
+    for slot in slots:
+        slot.close()
+        slot.unlink()
+
+# frames (H, W, N) of a decode result, a view of its slot when the worker wrote them there
+def _slot_frames_of(slot, frames):
+    if frames is None or isinstance(frames, np.ndarray):
+        return frames
+    return _slot_array(slot)[:, :, :frames]
+
+# submit one hour to the pool with a free slot, the slot is None when the worker returns an array
+def _submit_hour(pool, hour, free_slots, cache_folder_path=None, max_cache_mb=frame_cache.max_cache_mb):
+    slot = free_slots.pop() if free_slots else None
+    future = pool.submit(decompress_and_clahe_hour, hour, slot.name if slot is not None else None, cache_folder_path,
+                         max_cache_mb)
+    return future, slot
+
+# wait for the hours still in flight, so no worker writes into a slot once it is released
+def _drain(pending):
+    for *_, future, slot in pending:
+        if future is not None:
+            future.cancel()
+    for *_, future, slot in pending:
+        if future is not None and not future.cancelled():
+            try:
+                future.result()
+            except Exception:
+                pass
+
+# run the model over the clahe frames (H, W, N) in fixed-size batches, output softmax of shape (N, n_classes)
+def predict_frames(frames, batch_size=batch_size):
+    model, lb = load_classifier()
+
+    # the batch buffer keeps the same shape for every call, the last batch is zero padded
+    batch = np.zeros((batch_size, 224, 224, 3), dtype="float32")
+    preds = []
+    frame_num = frames.shape[2]
+    for start in range(0, frame_num, batch_size):
+        n = min(batch_size, frame_num - start)
+        with instrumentation.span('preprocess') as record:
+            preprocess_stack(frames[:, :, start:start + n], out=batch[:n])
+            if n < batch_size:
+                batch[n:] = 0
+            record['frames'] = n
+        with instrumentation.span('infer') as record:
+            preds.append(np.array(model.predict_on_batch(batch))[:n])
+            record['frames'] = n
+
+    if not preds:
+        return np.empty((0, len(lb.classes_)), dtype="float32")
+    return np.concatenate(preds)
+
+# turn keys like 'atha20200104000206' and softmax predictions into classification rows
+def predictions_to_rows(keys, preds):
+    _, lb = load_classifier()
+    dts = [datetime.strptime(key[4:], '%Y%m%d%H%M%S') for key in keys]
+    prediction = np.argmax(preds, axis=1)
+    return pd.DataFrame({'date': [dt.strftime('%Y%m%d') for dt in dts],
+                         'time': [dt.strftime('%H:%M:%S') for dt in dts],
+                         'prediction': prediction,
+                         'prediction_str': np.asarray(lb.classes_)[prediction],
+                         'confidence': np.max(preds, axis=1)},
+                        columns=['date', 'time', 'prediction', 'prediction_str', 'confidence'])
+
+def process_image(item):
+    key, value = item
+    dt = datetime.strptime(key[4:], '%Y%m%d%H%M%S')
+    year, month, day = str(dt.year), str(dt.month), str(dt.day)
+    directory_path = os.path.join(year, month, day)
+    ymd_str = dt.strftime('%Y%m%d')
+    time_str = dt.strftime('%H:%M:%S')
+
+    try: 
+        # process the image using clahe
+        value = clahe_frame(value)
+
+        # classification name format: YYYY/MM/DD/YYYYMMDD_site_themis##_classifications.txt
+        preds, prediction_str, prediction, confidence = pred_frame(value)
+        new_row = {'date': ymd_str, 'time': time_str, 'prediction': prediction,
+                'prediction_str': prediction_str, 'confidence': confidence}        
+        return new_row, directory_path, ymd_str
+    except:
+        return 
+
+# list the ut** folders of one camera-day, sorted in time
+def list_hours(asi_folder_path):
+    hours = []
+    for hour_name in sorted(os.listdir(asi_folder_path)):  # /ut09
+        # check if it is a sub folder
+        hour_folder_path = os.path.join(asi_folder_path, hour_name)
+        if os.path.isdir(hour_folder_path):
+            hours.append(hour_folder_path)
+    return hours
+
+# the decode queue holds as many hours as fit under the memory ceiling next to the batch buffers, at least one
+def decode_depth_for(max_memory_mb, batch_size=batch_size):
+    batch_bytes = 2 * batch_size * 224 * 224 * 3 * 4
+    return max(1, int((max_memory_mb * 1024**2 - batch_bytes) // (2 * _hour_bytes)))
+
+# date of a stream0 date folder. Example: 'stream0/2011/08/08' -> datetime(2011, 8, 8)
+def folder_date(date_folder_path):
+    year, month, day = os.path.normpath(date_folder_path).split(os.sep)[-3:]
+    return datetime(int(year), int(month), int(day))
+
+# path of the classification file of a camera-day, format: YYYY/MM/DD/YYYYMMDD_site_themis##_classifications.txt
+def classification_path(dt, asi_name):
+    directory_path = os.path.join(str(dt.year), str(dt.month), str(dt.day))
+    return os.path.join(directory_path, dt.strftime('%Y%m%d')+'_'+asi_name+"_classifications.txt")
+
+# read a classification txt file back to a dataframe
+def read_classifications(txt_path):
+    return pd.read_csv(txt_path, sep='\t', comment='#', dtype={'date': str, 'time': str})
+
+def write_classifications(chunks, txt_path, keep_hours=(), attrs=None):
+    """ Stream (hour, keys, preds) chunks from classify_units() to the classification h5 store,
+    then export the classification txt file from it
+    Inputs:
+        chunks: iterable of (hour, keys, preds)
+        txt_path: str. Example: '2011/8/8/20110808_mcgr_themis11_classifications.txt', the store goes next to it
+        keep_hours: list of str. Hours like 'ut09' whose rows are kept from the existing store
+        attrs: dict. Extra attributes of the store, example: {'model_version': 'CNN_0524-...'}
+    Returns:
+        row_num: int. Number of rows in the files, 0 if there were no frames and nothing was written
+        failed_hours: list of str. Hours of the chunks that failed to decompress
+    """
+    _, lb = load_classifier()
+    h5_path = store_path(txt_path)
+
+    # rows of hours that are not classified again
+    kept = None
+    if keep_hours:
+        kept = _kept_rows(h5_path, txt_path, keep_hours, lb.classes_)
+
+    directory_path = os.path.dirname(txt_path)
+    if directory_path and not os.path.exists(directory_path):
+        os.makedirs(directory_path)
+
+    # write to a partial file first, a killed run never leaves a truncated store
+    part_path = h5_path+'.part'
+    row_num = 0
+    failed_hours = []
+    unit_labels = instrumentation.path_labels(txt_path)
+    with h5py.File(part_path, 'w') as h5f:
+        create_store(h5f, lb.classes_, attrs)
+        # the spans only cover the writes, not the wait for the next chunk
+        for hour, keys, preds in chunks:
+            if keys is None:
+                failed_hours.append(hour)
+                continue
+            if not keys:
+                continue
+            with instrumentation.span('write', hour=os.path.basename(hour), **unit_labels) as record:
+                append_rows(h5f, keys_to_timestamps(keys), preds)
+                record.update(frames=len(keys), bytes_written=preds.nbytes + len(keys) * 14)
+            row_num += len(keys)
+
+        # merge the kept rows in time order
+        if kept is not None and len(kept[0]) > 0:
+            timestamps = np.concatenate([kept[0], h5f['timestamp'][:]])
+            softmax = np.concatenate([kept[1], h5f['softmax'][:]])
+            order = np.argsort(timestamps, kind='stable')
+            for name in ['timestamp', 'prediction', 'confidence', 'softmax']:
+                h5f[name].resize(0, axis=0)
+            append_rows(h5f, timestamps[order], softmax[order])
+            row_num = len(timestamps)
+
+    if row_num == 0:
+        os.remove(part_path)
+        return row_num, failed_hours
+
+    with instrumentation.span('write', **unit_labels) as record:
+        os.replace(part_path, h5_path)
+        export_txt(h5_path, txt_path)
+
+        # smoothed labels and events of the whole camera-day, the raw classifications stand without them
+        try:
+            export_events(h5_path, events_path(txt_path))
+        except Exception as e:
+            logging.critical(f'unable to write the events of {txt_path}, error = {e}')
+        record.update(frames=row_num, bytes_written=sum(os.path.getsize(path) for path in
+                                                        [txt_path, events_path(txt_path)] if os.path.exists(path)))
+    return row_num, failed_hours
+
+# (timestamps, softmax) of the rows of keep_hours in an existing store. Files written before the store
+# only have the txt, their softmax only holds the confidence of the predicted class
+def _kept_rows(h5_path, txt_path, keep_hours, classes):
+    if os.path.exists(h5_path):
+        df, softmax, attrs = read_store(h5_path)
+    elif os.path.exists(txt_path):
+        txt = read_classifications(txt_path)
+        df = pd.DataFrame({'timestamp': keys_to_timestamps(['site'+d+t.replace(':', '') for d, t in zip(txt['date'], txt['time'])])})
+        softmax = np.zeros((len(txt), len(classes)), dtype="float32")
+        softmax[np.arange(len(txt)), txt['prediction'].to_numpy()] = txt['confidence'].to_numpy()
+    else:
+        return None
+    hours = 'ut' + pd.to_datetime(df['timestamp'], unit='s').dt.strftime('%H')
+    mask = hours.isin(list(keep_hours)).to_numpy()
+    return df['timestamp'].to_numpy()[mask], softmax[mask]
+
+# one decoded hour to the model, a failed prediction is reported like a failed decompression
+def _predict_hour(hour, keys, frames, batch_size):
+    if not keys:
+        return keys, None
+    try:
+        with instrumentation.labels(**instrumentation.path_labels(hour)):
+            return keys, predict_frames(frames, batch_size=batch_size)
+    except Exception as e:
+        logging.critical(f'unable to predict {hour}, error = {e}')
+        return None, None
+
+# chunks of one unit from the write queue, until its end message
+def _queue_chunks(write_queue, state):
+    while True:
+        message = write_queue.get()
+        if message is None:
+            state['stopped'] = True
+            raise RuntimeError('pipeline stopped before the unit was complete')
+        kind, payload = message
+        if kind == 'end':
+            return
+        yield payload
+
+# write stage of classify_units(): one classification file per unit, in order
+def _write_units(write_queue, on_unit_done):
+    state = {'stopped': False}
+    while not state['stopped']:
+        message = write_queue.get()
+        if message is None:
+            return
+        kind, unit = message
+        chunks = _queue_chunks(write_queue, state)
+        try:
+            row_num, failed_hours = write_classifications(chunks, unit['txt_path'], keep_hours=unit.get('keep_hours', ()),
+                                                          attrs=unit.get('attrs'))
+        except Exception as e:
+            logging.critical(f'Error occurs in writing {unit["txt_path"]} as {e}')
+            row_num, failed_hours = 0, list(unit['hours'])
+            # drop the rest of the unit
+            if not state['stopped']:
+                try:
+                    for _ in chunks:
+                        pass
+                except RuntimeError:
+                    pass
+        if on_unit_done is not None:
+            try:
+                on_unit_done(unit, row_num, failed_hours)
+            except Exception as e:
+                logging.critical(f'Error occurs in on_unit_done for {unit["txt_path"]} as {e}')
+
+def classify_units(units, pool=None, batch_size=batch_size, decode_depth=2, write_depth=4, on_unit_done=None,
+                   cache_folder_path=None, max_cache_mb=frame_cache.max_cache_mb):
+    """ Classify camera-days as one pipeline: the hours of the next camera are decompressed while
+    the current one goes through the model and the previous one is written
+    Inputs:
+        units: iterable of dict, may be a generator that is consumed as the decode stage needs work.
+               Keys: 'hours' (list of ut** folder paths), 'txt_path', optional 'keep_hours' and 'attrs' of the store,
+               anything else for on_unit_done
+        pool: concurrent.futures.ProcessPoolExecutor that decompresses and clahes the hours, reused for every unit.
+              Its max_workers is the worker count of the decode stage. None to do it in this process
+        batch_size: int. Number of frames in each predict_on_batch call
+        decode_depth: int. Number of hours decompressed ahead of the model
+        write_depth: int. Number of classified hours waiting for the writer
+        on_unit_done: function(unit, row_num, failed_hours), called by the writer thread after each unit
+        cache_folder_path: str or None. Folder of the decoded hours cache, see frame_cache.py
+        max_cache_mb: int. Size limit of the cache
+    Returns:
+        unit_num: int. Number of units classified
+    """
+    write_queue = queue.Queue(maxsize=max(1, write_depth))
+    writer = threading.Thread(target=_write_units, args=(write_queue, on_unit_done), daemon=True)
+    writer.start()
+
+    # every hour of every unit, in order
+    def _hour_items():
+        for unit in units:
+            for n, hour in enumerate(unit['hours']):
+                yield unit, hour, n == len(unit['hours']) - 1
+    items = _hour_items()
+
+    # the workers write the frames into shared memory slots, one per hour in flight
+    slots = open_slots(max(1, decode_depth)) if pool is not None else []
+    free_slots = list(slots)
+    pending = deque()
+    current = None
+    unit_num = 0
+    try:
+        while True:
+            # keep decode_depth hours in flight
+            while len(pending) < max(1, decode_depth):
+                item = next(items, None)
+                if item is None:
+                    break
+                if pool is not None:
+                    future, slot = _submit_hour(pool, item[1], free_slots, cache_folder_path, max_cache_mb)
+                else:
+                    future, slot = None, None
+                pending.append((item, future, slot))
+            if not pending:
+                break
+
+            (unit, hour, last), future, slot = pending.popleft()
+            if unit is not current:
+                current = unit
+                unit_num += 1
+                write_queue.put(('unit', unit))
+
+            if future is not None:
+                keys, frames = future.result()
+            else:
+                keys, frames = decompress_and_clahe_hour(hour, None, cache_folder_path, max_cache_mb)
+            keys, preds = _predict_hour(hour, keys, _slot_frames_of(slot, frames), batch_size)
+            del frames
+            if slot is not None:
+                free_slots.append(slot)
+            write_queue.put(('hour', (hour, keys, preds)))
+            if last:
+                write_queue.put(('end', unit))
+    finally:
+        write_queue.put(None)
+        writer.join()
+        _drain(pending)
+        close_slots(slots)
+
+    return unit_num
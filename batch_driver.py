@@ -0,0 +1,272 @@
+"""
+Batch driver of video_generator for many sites and days.
+Each (site, date) unit goes through download -> decompress -> render, and the stages of different units overlap:
+downloads run in a network pool, decompression in a disk pool and rendering in a cpu pool, each with its own limit.
+The decompress stage fills the frame cache and the render stage memory-maps the cached hours, so no pgm files are
+written and read back; without a frame cache the days go through pgm files in a '-decompressed' folder.
+Usage:
+    python batch_driver.py gako,fsmi 2020-01-01 2020-01-31 --outputs mp4,h5 --method clahe --network 2 --disk 2 --cpu 4
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from multiprocessing import cpu_count, get_context
+
+from download_manager import themis_server, verify_day
+import frame_cache
+import instrumentation
+from video_generator import (decompress_to_cache, download_skymap, download_themis_images, images_to_h5, images_to_mp4,
+                             list_and_decompress_images, list_and_decompress_pgm_files, pgm_images_to_h5, pgm_images_to_mp4)
+
+# stages of a unit in order, with the pool each one runs in
+stages = ['download', 'decompress', 'render']
+stage_pools = {'download': 'network', 'decompress': 'disk', 'render': 'cpu'}
+
+# total size in bytes and number of files of a folder tree
+def _folder_size(folder_path):
+    size, file_num = 0, 0
+    for root, dirs, file_names in os.walk(folder_path):
+        for file_name in file_names:
+            size += os.path.getsize(os.path.join(root, file_name))
+            file_num += 1
+    return size, file_num
+
+# download one (site, date), runs in a network thread since the work is done by rsync.
+# The days of a site share their skymap, so it is fetched under the lock of the site and only the first day downloads it
+def _download_task(site, date, folder_path, skymap_folder_path, server, max_transfers, skymap_lock):
+    tic = time.perf_counter()
+    full_path = folder_path+'/'+site+'/'+date.strftime('%Y-%m-%d')
+    if not verify_day(full_path)[0]:
+        with skymap_lock:
+            download_skymap(date, site, full_path, skymap_folder_path, server)
+    img_folder_path = download_themis_images(date, site, folder_path=folder_path, skymap=0,
+                                             skymap_folder_path=skymap_folder_path, server=server,
+                                             max_transfers=max_transfers)
+    size, file_num = _folder_size(img_folder_path)
+    # the .pgm.gz files hold several frames and sit next to the skymaps and the manifest, frames are counted once decompressed
+    return img_folder_path, {'seconds': time.perf_counter() - tic, 'bytes': size, 'files': file_num, 'frames': 0}
+
+# decompress one downloaded day into the frame cache, or into pgm files without a cache, runs in a disk worker process
+def _decompress_task(img_folder_path, cache_folder_path=None, max_cache_mb=frame_cache.max_cache_mb):
+    tic = time.perf_counter()
+    if cache_folder_path is not None:
+        hour_num, frame_num, size = decompress_to_cache(img_folder_path, cache_folder_path, max_cache_mb=max_cache_mb)
+        return img_folder_path, {'seconds': time.perf_counter() - tic, 'bytes': size, 'files': hour_num,
+                                 'frames': frame_num}
+    # one hour at a time, the disk pool sets how many days are decompressed at once
+    decompressed_folder_path = list_and_decompress_pgm_files(img_folder_path, processes=1)
+    size, file_num = _folder_size(decompressed_folder_path)
+    frame_num = len([name for name in os.listdir(decompressed_folder_path) if name.endswith('.pgm')])
+    return decompressed_folder_path, {'seconds': time.perf_counter() - tic, 'bytes': size, 'files': file_num,
+                                      'frames': frame_num}
+
+# render the videos and h5 files of one day from the frame cache, or from its pgm files without a cache,
+# runs in a cpu worker process
+def _render_task(folder_path, outputs, method, video_folder_path, h5_folder_path, render_threads,
+                 cache_folder_path=None, max_cache_mb=frame_cache.max_cache_mb):
+    if cache_folder_path is None:
+        return _render_pgm_task(folder_path, outputs, method, video_folder_path, h5_folder_path, render_threads)
+    tic = time.perf_counter()
+    images, image_names, skymap_path = list_and_decompress_images(folder_path, cache_folder_path=cache_folder_path,
+                                                                  max_cache_mb=max_cache_mb)
+    if not image_names:
+        raise ValueError(f'no images in {folder_path}')
+    output_paths = []
+    if 'mp4' in outputs:
+        output_paths.append(images_to_mp4(images, image_names, video_folder_path, file_suffix=f'{method}.mp4',
+                                          method=method, processes=render_threads))
+    if 'h5' in outputs:
+        output_paths.append(images_to_h5(images, image_names, skymap_path, h5_folder_path, file_suffix=f'{method}.h5',
+                                         method=method, processes=render_threads))
+    size = sum(os.path.getsize(path) for path in output_paths)
+    return output_paths, {'seconds': time.perf_counter() - tic, 'bytes': size, 'files': len(output_paths),
+                          'frames': len(image_names)}
+
+# render the videos and h5 files of one day from its decompressed pgm files
+def _render_pgm_task(decompressed_folder_path, outputs, method, video_folder_path, h5_folder_path, render_threads):
+    tic = time.perf_counter()
+    frame_num = len([name for name in os.listdir(decompressed_folder_path) if name.endswith('.pgm')])
+    if frame_num == 0:
+        raise ValueError(f'no images in {decompressed_folder_path}')
+    output_paths = []
+    if 'mp4' in outputs:
+        output_paths.append(pgm_images_to_mp4(decompressed_folder_path, video_folder_path, file_suffix=f'{method}.mp4',
+                                              method=method, processes=render_threads))
+    if 'h5' in outputs:
+        output_paths.append(pgm_images_to_h5(decompressed_folder_path, h5_folder_path, file_suffix=f'{method}.h5',
+                                             method=method, processes=render_threads))
+    size = sum(os.path.getsize(path) for path in output_paths)
+    return output_paths, {'seconds': time.perf_counter() - tic, 'bytes': size, 'files': len(output_paths),
+                          'frames': frame_num}
+
+def run_batch(sites, start_date, end_date, outputs=('mp4',), method='clahe', folder_path='./images',
+              video_folder_path='./videos', h5_folder_path='./h5s', skymap_folder_path='./skymaps',
+              network_workers=2, disk_workers=2, cpu_workers=None, render_threads=1, server=themis_server, max_transfers=4,
+              cache_folder_path='./frame_cache', max_cache_mb=frame_cache.max_cache_mb):
+    """ Download, decompress and render every (site, date) between two dates, overlapping the stages of different units
+    Inputs:
+        sites: list of str. Example: ['gako', 'fsmi']
+        start_date, end_date: datetime object. Both days included
+        outputs: tuple of str. Options: 'mp4', 'h5'
+        method: str. Processing method of pgm_images_to_mp4() and pgm_images_to_h5()
+        folder_path: str. Folder of the downloaded and decompressed images
+        video_folder_path, h5_folder_path: str. Folders of the outputs
+        skymap_folder_path: str. Folder of the skymap cache
+        network_workers: int. Number of downloads at once
+        disk_workers: int. Number of days decompressed at once
+        cpu_workers: int. Number of days rendered at once, default as the cpu_count
+        render_threads: int. Number of threads rendering each day
+        server: str. rsync:// url of the THEMIS asi data, or a local folder with the same layout
+        max_transfers: int. Number of hour folders of a day downloaded at once
+        cache_folder_path: str or None. Frame cache filled by the decompress stage and memory-mapped by the render
+            stage, each cpu worker holds one day of uint16 frames. None writes and reads pgm files instead
+        max_cache_mb: int. Size limit of the frame cache, keep it above the days in flight or they are decoded twice
+    Returns:
+        report: dict. Per-stage throughput and the units that failed, see format_report()
+    """
+    cpu_workers = cpu_workers or cpu_count()
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    units = [(site, day) for day in days for site in sites]
+    logging.info(f'batch start: {len(units)} units, network = {network_workers}, disk = {disk_workers}, cpu = {cpu_workers}')
+
+    stats = {stage: {'units': 0, 'failed': 0, 'seconds': 0.0, 'bytes': 0, 'files': 0, 'frames': 0, 'first': None, 'last': None}
+             for stage in stages}
+    failed = []
+    done = []
+    tic = time.perf_counter()
+
+    # spawn workers are not daemonic, so themis_imager_readfile can start its own pool inside them
+    context = get_context('spawn')
+    with ThreadPoolExecutor(max_workers=network_workers) as network, \
+            ProcessPoolExecutor(max_workers=disk_workers, mp_context=context) as disk, \
+            ProcessPoolExecutor(max_workers=cpu_workers, mp_context=context) as cpu:
+
+        # every future maps to the unit and the stage it runs
+        running = {}
+        def submit(unit, stage, *args):
+            stat = stats[stage]
+            if stat['first'] is None:
+                stat['first'] = time.perf_counter()
+            if stage == 'download':
+                future = network.submit(_download_task, *args)
+            elif stage == 'decompress':
+                future = disk.submit(_decompress_task, *args)
+            else:
+                future = cpu.submit(_render_task, *args)
+            running[future] = (unit, stage)
+
+        skymap_locks = {site: threading.Lock() for site in sites}
+        for unit in units:
+            submit(unit, 'download', unit[0], unit[1], folder_path, skymap_folder_path, server, max_transfers,
+                   skymap_locks[unit[0]])
+
+        # start the next stage of a unit as soon as the previous one completes
+        while running:
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                unit, stage = running.pop(future)
+                stat = stats[stage]
+                stat['last'] = time.perf_counter()
+                try:
+                    result, metrics = future.result()
+                except Exception as e:
+                    logging.critical(f'{stage} failed for {unit[0]} {unit[1].date()} as {e}')
+                    stat['failed'] += 1
+                    failed.append((unit[0], unit[1].strftime('%Y-%m-%d'), stage, str(e)))
+                    continue
+                stat['units'] += 1
+                for key in ['seconds', 'bytes', 'files', 'frames']:
+                    stat[key] += metrics[key]
+                logging.info(f'{stage} done for {unit[0]} {unit[1].date()} in {metrics["seconds"]:.1f} s')
+
+                if stage == 'download':
+                    submit(unit, 'decompress', result, cache_folder_path, max_cache_mb)
+                elif stage == 'decompress':
+                    submit(unit, 'render', result, tuple(outputs), method, video_folder_path, h5_folder_path,
+                           render_threads, cache_folder_path, max_cache_mb)
+                else:
+                    done.append((unit[0], unit[1].strftime('%Y-%m-%d'), result))
+
+    report = {'units': len(units), 'done': done, 'failed': failed, 'seconds': time.perf_counter() - tic, 'stages': {}}
+    for stage in stages:
+        stat = stats[stage]
+        span = (stat['last'] - stat['first']) if stat['first'] is not None and stat['last'] is not None else 0.0
+        report['stages'][stage] = {'pool': stage_pools[stage],
+                                   'units': stat['units'],
+                                   'failed': stat['failed'],
+                                   'busy_seconds': stat['seconds'],
+                                   'wall_seconds': span,
+                                   'files': stat['files'],
+                                   'frames': stat['frames'],
+                                   'megabytes': stat['bytes'] / 1e6,
+                                   'frames_per_second': stat['frames'] / span if span else 0.0,
+                                   'megabytes_per_second': stat['bytes'] / 1e6 / span if span else 0.0}
+    logging.info(f'batch done in {report["seconds"]:.1f} s, {len(done)} units done, {len(failed)} failed')
+    return report
+
+def format_report(report):
+    """ Table of the per-stage throughput of a run_batch() report
+    The wall time of a stage runs from its first start to its last completion, so the rates include the overlap with the other stages.
+    """
+    lines = [f'{len(report["done"])}/{report["units"]} units done in {report["seconds"]:.1f} s, {len(report["failed"])} failed',
+             f'{"stage":<12}{"pool":<9}{"units":>7}{"failed":>8}{"busy s":>10}{"wall s":>10}{"files":>8}{"frames":>9}{"MB":>10}{"frames/s":>10}{"MB/s":>9}']
+    for stage, stat in report['stages'].items():
+        lines.append(f'{stage:<12}{stat["pool"]:<9}{stat["units"]:>7}{stat["failed"]:>8}{stat["busy_seconds"]:>10.1f}'
+                     f'{stat["wall_seconds"]:>10.1f}{stat["files"]:>8}{stat["frames"]:>9}{stat["megabytes"]:>10.1f}'
+                     f'{stat["frames_per_second"]:>10.1f}{stat["megabytes_per_second"]:>9.2f}')
+    for site, date, stage, error in report['failed']:
+        lines.append(f'failed: {site} {date} at {stage}: {error}')
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make THEMIS videos and h5 files for many sites and days.')
+    parser.add_argument('sites', help='comma separated, example: gako,fsmi')
+    parser.add_argument('start_date', help='format: YYYY-MM-DD')
+    parser.add_argument('end_date', help='format: YYYY-MM-DD, included')
+    parser.add_argument('--outputs', default='mp4', help='comma separated, options: mp4,h5')
+    parser.add_argument('--method', default='clahe', help='processing method of the images')
+    parser.add_argument('--folder', default='./images', help='folder of the downloaded and decompressed images')
+    parser.add_argument('--videos', default='./videos', help='folder of the mp4 files')
+    parser.add_argument('--h5s', default='./h5s', help='folder of the h5 files')
+    parser.add_argument('--skymaps', default='./skymaps', help='folder of the skymap cache')
+    parser.add_argument('--server', default=themis_server, help='rsync:// url of the THEMIS asi data, or a local folder')
+    parser.add_argument('--network', type=int, default=2, help='number of days downloaded at once')
+    parser.add_argument('--transfers', type=int, default=4, help='number of hour folders of a day downloaded at once')
+    parser.add_argument('--disk', type=int, default=2, help='number of days decompressed at once')
+    parser.add_argument('--cpu', type=int, default=cpu_count(), help='number of days rendered at once')
+    parser.add_argument('--render-threads', type=int, default=1, help='number of threads rendering each day')
+    parser.add_argument('--frame-cache', default='./frame_cache',
+                        help="folder of the decoded hours shared by the decompress and render stages, 'none' for pgm files")
+    parser.add_argument('--frame-cache-mb', type=int, default=frame_cache.max_cache_mb, help='size limit of the frame cache')
+    parser.add_argument('--metrics', default='./batch_driver_metrics.jsonl', help='JSONL file receiving the spans of every stage')
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='batch_driver.log',
+                        format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    try:
+        start_date = datetime.strptime(args.start_date, '%Y-%m-%d')
+        end_date = datetime.strptime(args.end_date, '%Y-%m-%d')
+    except ValueError as e:
+        print(f'Start or end date not valid, Exception: {e}')
+        sys.exit()
+
+    # set before the pools are started, so the workers append their spans to the same file
+    run = instrumentation.configure(args.metrics)
+    report = run_batch(args.sites.split(','), start_date, end_date, outputs=args.outputs.split(','),
+                       method=args.method, folder_path=args.folder, video_folder_path=args.videos,
+                       h5_folder_path=args.h5s, skymap_folder_path=args.skymaps, network_workers=args.network,
+                       disk_workers=args.disk, cpu_workers=args.cpu, render_threads=args.render_threads,
+                       server=args.server, max_transfers=args.transfers,
+                       cache_folder_path=None if args.frame_cache.lower() == 'none' else args.frame_cache,
+                       max_cache_mb=args.frame_cache_mb)
+    print(format_report(report))
+    print(instrumentation.format_summary(instrumentation.summarize(instrumentation.read_metrics(args.metrics, run))))
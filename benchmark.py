@@ -0,0 +1,385 @@
+"""
+Benchmarks for the THEMIS processing steps.
+The pipeline benchmark builds a synthetic stream0 tree of THEMIS-format .pgm.gz files at the real 3 s cadence, then
+times every stage on it with frames/s and peak RSS, so runs on different commits or hosts can be compared offline.
+Usage:
+    python benchmark.py preprocess --frames 1200
+    python benchmark.py synthetic ./bench_data --hours 1
+    python benchmark.py pipeline --data ./bench_data --hours 1 --json bench.json
+    python benchmark.py download --data ./bench_data --days 6 --network 6
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import os
+import platform
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from instrumentation import peak_rss_mb
+
+# day, site and camera of the synthetic stream0 tree
+synthetic_date = datetime.datetime(2020, 1, 4)
+synthetic_site = 'gako'
+synthetic_asi = 'gako_themis19'
+
+# THEMIS cadence: one .pgm.gz file per minute holding 20 frames 3 s apart
+_frames_per_file = 20
+_cadence_seconds = 3
+
+# class names of the stand-in model
+_stand_in_classes = ['class_0', 'class_1', 'class_2', 'class_3']
+
+# time func over repeats and return the best wall time in seconds
+def _best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        toc = time.perf_counter() - tic
+        best = toc if best is None else min(best, toc)
+    return best
+
+def bench_preprocess(frame_num=1200, repeat=3, seed=0):
+    """ Compare the per-frame classifier preprocessing with the whole-stack one
+    Inputs:
+        frame_num: int. Number of synthetic 256x256 frames, about one hour at 3 s cadence by default
+        repeat: int. Number of runs, the best one is reported
+        seed: int. Seed of the synthetic frames
+    Returns:
+        results: dict. frames/s of both paths, the speedup and the max absolute difference
+    """
+    from all_tasks_func import preprocess_frame, preprocess_stack
+
+    frames = np.random.default_rng(seed).integers(0, 256, (256, 256, frame_num), dtype=np.uint8)
+    out_frame = np.empty((frame_num, 224, 224, 3), dtype="float32")
+    out_stack = np.empty((frame_num, 224, 224, 3), dtype="float32")
+
+    def per_frame():
+        for frame in range(frame_num):
+            out_frame[frame] = preprocess_frame(frames[:, :, frame])
+
+    def stack():
+        preprocess_stack(frames, out=out_stack)
+
+    frame_time = _best_time(per_frame, repeat)
+    stack_time = _best_time(stack, repeat)
+
+    return {'frames': frame_num,
+            'per_frame_fps': frame_num / frame_time,
+            'stack_fps': frame_num / stack_time,
+            'speedup': frame_time / stack_time,
+            'max_abs_diff': float(np.abs(out_frame - out_stack).max())}
+
+# one synthetic minute of 16 bit frames (20, 256, 256): a dark sky in the fisheye circle, stars and a drifting auroral arc
+def _synthetic_minute(rng, minute_index):
+    y, x = np.mgrid[0:256, 0:256].astype('float32')
+    sky = ((x - 128)**2 + (y - 128)**2) < 120**2
+    stars = np.zeros((256, 256), dtype='float32')
+    star_rng = np.random.default_rng(7)
+    stars[star_rng.integers(0, 256, 60), star_rng.integers(0, 256, 60)] = 6000
+
+    frames = np.empty((_frames_per_file, 256, 256), dtype='float32')
+    for k in range(_frames_per_file):
+        t = minute_index * _frames_per_file + k
+        # the arc drifts across the sky and brightens and fades over about an hour
+        center = 40 + (t * 0.15) % 176
+        brightness = 5000 * (0.6 + 0.4 * np.sin(t / 190.0))
+        arc = brightness * np.exp(-((y - center - 0.2 * (x - 128))**2) / (2 * 9.0**2))
+        frames[k] = 3000 + sky * (arc + stars)
+    frames += rng.normal(0, 60, frames.shape).astype('float32')
+    return np.clip(frames, 0, 65535).astype('>u2')
+
+def make_synthetic_stream0(stream0_path, hours=1, minutes=60, date=synthetic_date, asi=synthetic_asi, seed=0):
+    """ Build a synthetic stream0 tree of THEMIS-format .pgm.gz files that themis_imager_readfile can read
+    Inputs:
+        stream0_path: str. Example: './bench_data/stream0'
+        hours: int. Number of ut** folders, from ut00
+        minutes: int. Number of one-minute files of 20 frames in every hour, 60 for a full hour
+        date: datetime object. Day of the tree
+        asi: str. Camera folder name. Example: 'gako_themis19'
+        seed: int. Seed of the noise, the same arguments always give the same files
+    Returns:
+        hour_folder_paths: list of str. Example: ['./bench_data/stream0/2020/01/04/gako_themis19/ut00']
+    """
+    site = asi.split('_')[0]
+    rng = np.random.default_rng(seed)
+    hour_folder_paths = []
+    for hour in range(hours):
+        hour_folder_path = os.path.join(stream0_path, date.strftime('%Y/%m/%d'), asi, f'ut{hour:02d}')
+        hour_folder_paths.append(hour_folder_path)
+        done_path = os.path.join(hour_folder_path, f'.synthetic_{minutes}_{seed}')
+        if os.path.exists(done_path):
+            continue
+        if os.path.isdir(hour_folder_path):
+            shutil.rmtree(hour_folder_path)
+        os.makedirs(hour_folder_path)
+
+        for minute in range(minutes):
+            start = date + datetime.timedelta(hours=hour, minutes=minute)
+            frames = _synthetic_minute(rng, hour * 60 + minute)
+            file_path = os.path.join(hour_folder_path, start.strftime('%Y%m%d_%H%M')+f'_{asi}_full.pgm.gz')
+            with gzip.open(file_path, 'wb', compresslevel=6) as f:
+                for k in range(_frames_per_file):
+                    frame_time = start + datetime.timedelta(seconds=k * _cadence_seconds)
+                    f.write(b'P5\n')
+                    f.write(f'#"Image request start" {frame_time.strftime("%Y-%m-%d %H:%M:%S.%f")} UTC\n'.encode())
+                    f.write(f'#"Site unique ID" {site}\n'.encode())
+                    f.write(b'#"Exposure plus initial readout" 1000 ms\n')
+                    f.write(b'256 256\n65535\n')
+                    f.write(frames[k].tobytes())
+        # written last, an interrupted hour is built again
+        open(done_path, 'w').close()
+    return hour_folder_paths
+
+# small numpy model in place of the CNN: 32x32 average pooling, one dense layer and a softmax
+class _StandInModel:
+    def __init__(self, seed=0):
+        self.weights = np.random.default_rng(seed).normal(0, 0.01, (7 * 7 * 3, len(_stand_in_classes))).astype('float32')
+
+    def predict_on_batch(self, batch):
+        pooled = batch.reshape(len(batch), 7, 32, 7, 32, 3).mean(axis=(2, 4)).reshape(len(batch), -1)
+        logits = pooled @ self.weights
+        exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def __call__(self, batch):
+        return self.predict_on_batch(np.asarray(batch))
+
+class _StandInLabels:
+    classes_ = np.array(_stand_in_classes)
+
+# start a new peak RSS measure of peak_rss_mb(), only possible on Linux
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+# run func once as a stage and return its row of the report
+def _run_stage(name, func, frame_num):
+    _reset_peak_rss()
+    tic = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - tic
+    return {'stage': name, 'frames': frame_num, 'seconds': seconds,
+            'frames_per_second': frame_num / seconds if seconds else 0.0, 'peak_rss_mb': peak_rss_mb()}
+
+def bench_pipeline(data_folder_path='./bench_data', hours=1, minutes=60, methods=None, threads=1, workers=1, seed=0):
+    """ Time every stage of the video and classification pipelines on a synthetic stream0 tree
+    Inputs:
+        data_folder_path: str. Folder of the synthetic stream0 tree and of the outputs, built on first use
+        hours: int. Number of synthetic hours
+        minutes: int. Number of one-minute files per hour
+        methods: list of str. Contrast methods of video_generator, default every method
+        threads: int. Threads of process_stack() and of the video writers
+        workers: int. themis_imager_readfile processes reading each hour
+        seed: int. Seed of the synthetic data and of the stand-in model
+    Returns:
+        report: dict. 'stages' rows with frames, seconds, frames_per_second and peak_rss_mb, and the run settings.
+                The peak RSS is the one of this process, the decode workers of themis_imager_readfile are not included
+    """
+    import all_tasks_func
+    import video_generator
+
+    hour_folder_paths = make_synthetic_stream0(os.path.join(data_folder_path, 'stream0'), hours, minutes, seed=seed)
+    output_folder_path = os.path.join(data_folder_path, 'outputs')
+    if os.path.isdir(output_folder_path):
+        shutil.rmtree(output_folder_path)
+    os.makedirs(output_folder_path)
+    if methods is None:
+        methods = video_generator._stack_methods
+
+    # the stand-in model replaces the CNN, so no TensorFlow or model files are needed
+    all_tasks_func.model = _StandInModel(seed)
+    all_tasks_func.lb = _StandInLabels()
+
+    rows = []
+    decoded = {}
+    def decode():
+        hour_images, image_names = [], []
+        for hour_folder_path in hour_folder_paths:
+            img, hour_image_names = video_generator._read_hour(hour_folder_path, workers)
+            hour_images.append(img)
+            image_names.extend(hour_image_names)
+        decoded['images'] = np.concatenate(hour_images, axis=-1)
+        decoded['image_names'] = image_names
+    frame_num = hours * minutes * _frames_per_file
+    rows.append(_run_stage('decode', decode, frame_num))
+    images, image_names = decoded['images'], decoded['image_names']
+    frame_num = len(image_names)
+
+    for method in methods:
+        rows.append(_run_stage(f'method {method}', lambda: video_generator.process_stack(images, method, threads),
+                               frame_num))
+
+    # classifier input of the clahe frames, then the stand-in model over the same frames
+    frames = np.stack([all_tasks_func.clahe_frame(images[:, :, frame]) for frame in range(frame_num)], axis=-1)
+    model_input = np.empty((frame_num, 224, 224, 3), dtype='float32')
+    rows.append(_run_stage('preprocess', lambda: all_tasks_func.preprocess_stack(frames, out=model_input), frame_num))
+    del model_input
+    predicted = {}
+    def infer():
+        predicted['preds'] = all_tasks_func.predict_frames(frames)
+    rows.append(_run_stage('infer', infer, frame_num))
+
+    rows.append(_run_stage('write mp4', lambda: video_generator.images_to_mp4(
+        images, image_names, output_folder_path, method='clahe', processes=threads, encoder='opencv'), frame_num))
+    if shutil.which('ffmpeg') is not None:
+        rows.append(_run_stage('write mp4 ffmpeg', lambda: video_generator.images_to_mp4(
+            images, image_names, output_folder_path, file_suffix='x264.mp4', method='clahe', processes=threads,
+            threads=threads), frame_num))
+    rows.append(_run_stage('write h5', lambda: video_generator.images_to_h5(
+        images, image_names, h5_folder_path=output_folder_path, method='clahe', processes=threads,
+        skymap_folder_path=None), frame_num))
+
+    # classification store, tsv and events of the camera-day
+    txt_path = os.path.join(output_folder_path, synthetic_date.strftime('%Y%m%d')+'_'+synthetic_asi+'_classifications.txt')
+    chunks = [(hour_folder_paths[0], image_names, predicted['preds'])]
+    rows.append(_run_stage('write tsv', lambda: all_tasks_func.write_classifications(chunks, txt_path), frame_num))
+
+    return {'stages': rows,
+            'settings': {'hours': hours, 'minutes': minutes, 'frames': frame_num, 'threads': threads,
+                         'workers': workers, 'seed': seed},
+            'host': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                     'cpu_count': os.cpu_count()}}
+
+# table of the stages of a bench_pipeline() report
+def format_pipeline(report):
+    lines = [f'{report["settings"]["frames"]} synthetic frames, threads = {report["settings"]["threads"]}, '
+             f'workers = {report["settings"]["workers"]}',
+             f'{"stage":<24}{"frames":>8}{"seconds":>10}{"frames/s":>11}{"peak RSS MB":>13}']
+    for row in report['stages']:
+        lines.append(f'{row["stage"]:<24}{row["frames"]:>8}{row["seconds"]:>10.2f}{row["frames_per_second"]:>11.1f}'
+                     f'{row["peak_rss_mb"]:>13.1f}')
+    return '\n'.join(lines)
+
+def bench_download(data_folder_path='./bench_data', days=6, hours=2, minutes=2, network_workers=6, callers=2,
+                   max_transfers=4, seed=0):
+    """ Download synthetic days from a local folder with the server layout, many at once, and check them
+    Consecutive days of one site share the skymap folder, and every day is also requested by several callers at once,
+    so the downloads race on the skymap listing, the .sav files and the hour files as they do in batch_driver.py.
+    Inputs:
+        data_folder_path: str. Folder of the local server tree and of the downloads, the downloads are removed first
+        days: int. Number of consecutive days from the synthetic date
+        hours: int. Number of ut** folders of every day
+        minutes: int. Number of one-minute files per hour
+        network_workers: int. Number of downloads at once
+        callers: int. Number of concurrent downloads of every day
+        max_transfers: int. Hour folders fetched at once by each download
+        seed: int. Seed of the synthetic data
+    Returns:
+        report: dict. 'failed' downloads with their error and 'incomplete' days, both empty when the check passes,
+                with the seconds, megabytes and megabytes_per_second of the downloads
+    """
+    from download_manager import verify_day
+    from video_generator import download_themis_images
+
+    # server tree: stream0/ with the synthetic days and skymaps/ with one skymap of the site
+    server_path = os.path.join(data_folder_path, 'server')
+    dates = [synthetic_date + datetime.timedelta(days=day) for day in range(days)]
+    for date in dates:
+        make_synthetic_stream0(os.path.join(server_path, 'stream0'), hours, minutes, date=date, seed=seed)
+    skymap_dir_path = os.path.join(server_path, 'skymaps', synthetic_site, synthetic_site+'_20190312')
+    os.makedirs(skymap_dir_path, exist_ok=True)
+    with open(os.path.join(skymap_dir_path, f'themis_skymap_{synthetic_site}_20190312-+_v02.sav'), 'wb') as f:
+        f.write(np.random.default_rng(seed).bytes(4 * 1024**2))
+
+    download_folder_path = os.path.join(data_folder_path, 'downloads')
+    if os.path.isdir(download_folder_path):
+        shutil.rmtree(download_folder_path)
+    image_folder_path = os.path.join(download_folder_path, 'images')
+    skymap_folder_path = os.path.join(download_folder_path, 'skymaps')
+
+    failed = []
+    tic = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=network_workers) as executor:
+        futures = [(date, executor.submit(download_themis_images, date, synthetic_site, folder_path=image_folder_path,
+                                          skymap_folder_path=skymap_folder_path, server=os.path.join(server_path, ''),
+                                          max_transfers=max_transfers))
+                   for date in dates for _ in range(callers)]
+        for date, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failed.append((date.strftime('%Y-%m-%d'), f'{type(e).__name__}: {e}'))
+    seconds = time.perf_counter() - tic
+
+    incomplete = []
+    size = 0
+    for date in dates:
+        full_path = os.path.join(image_folder_path, synthetic_site, date.strftime('%Y-%m-%d'))
+        complete, missing_hours = verify_day(full_path)
+        if not complete or not any(name.endswith('.sav') for name in os.listdir(full_path)):
+            incomplete.append(date.strftime('%Y-%m-%d'))
+        for root, dirs, file_names in os.walk(full_path):
+            size += sum(os.path.getsize(os.path.join(root, file_name)) for file_name in file_names)
+    return {'downloads': len(futures), 'failed': failed, 'incomplete': incomplete, 'seconds': seconds,
+            'megabytes': size / 1e6, 'megabytes_per_second': size / 1e6 / seconds if seconds else 0.0}
+
+def _print_results(name, results):
+    print(name)
+    for key, value in results.items():
+        if isinstance(value, float):
+            print(f'  {key:<16} {value:.4f}')
+        else:
+            print(f'  {key:<16} {value}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the THEMIS processing steps.')
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    preprocess_parser = subparsers.add_parser('preprocess', help='per-frame vs whole-stack classifier preprocessing')
+    preprocess_parser.add_argument('--frames', type=int, default=1200)
+    preprocess_parser.add_argument('--repeat', type=int, default=3)
+
+    synthetic_parser = subparsers.add_parser('synthetic', help='build a synthetic stream0 tree')
+    synthetic_parser.add_argument('folder', help='parent folder of the stream0 tree')
+    synthetic_parser.add_argument('--hours', type=int, default=1)
+    synthetic_parser.add_argument('--minutes', type=int, default=60, help='one-minute files of 20 frames per hour')
+    synthetic_parser.add_argument('--seed', type=int, default=0)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='time every stage on a synthetic stream0 tree')
+    pipeline_parser.add_argument('--data', default='./bench_data', help='folder of the synthetic tree and outputs')
+    pipeline_parser.add_argument('--hours', type=int, default=1)
+    pipeline_parser.add_argument('--minutes', type=int, default=60, help='one-minute files of 20 frames per hour')
+    pipeline_parser.add_argument('--methods', default=None, help='comma separated, default every method')
+    pipeline_parser.add_argument('--threads', type=int, default=1)
+    pipeline_parser.add_argument('--workers', type=int, default=1)
+    pipeline_parser.add_argument('--seed', type=int, default=0)
+    pipeline_parser.add_argument('--json', default=None, help='also write the report to this json file')
+
+    download_parser = subparsers.add_parser('download', help='concurrent downloads from a local server tree')
+    download_parser.add_argument('--data', default='./bench_data', help='folder of the server tree and downloads')
+    download_parser.add_argument('--days', type=int, default=6)
+    download_parser.add_argument('--hours', type=int, default=2)
+    download_parser.add_argument('--minutes', type=int, default=2, help='one-minute files of 20 frames per hour')
+    download_parser.add_argument('--network', type=int, default=6, help='downloads at once')
+    download_parser.add_argument('--callers', type=int, default=2, help='concurrent downloads of every day')
+    download_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    if args.bench == 'preprocess':
+        _print_results('preprocess', bench_preprocess(args.frames, args.repeat))
+    elif args.bench == 'synthetic':
+        for hour_folder_path in make_synthetic_stream0(os.path.join(args.folder, 'stream0'), args.hours, args.minutes,
+                                                       seed=args.seed):
+            print(hour_folder_path)
+    elif args.bench == 'pipeline':
+        report = bench_pipeline(args.data, args.hours, args.minutes,
+                                args.methods.split(',') if args.methods else None, args.threads, args.workers, args.seed)
+        print(format_pipeline(report))
+        if args.json is not None:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=1)
+    elif args.bench == 'download':
+        report = bench_download(args.data, args.days, args.hours, args.minutes, args.network, args.callers,
+                                seed=args.seed)
+        _print_results('download', report)
+        if report['failed'] or report['incomplete']:
+            raise SystemExit(1)
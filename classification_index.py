@@ -0,0 +1,217 @@
+"""
+Queryable index over the all_tasks.py classification files.
+Every frame of the *_classifications.h5 stores (or the txt files of days without a store) goes into one sqlite table
+keyed on (site, time), with secondary indexes for filtering by class and confidence.
+Usage:
+    python classification_index.py update [root]
+    python classification_index.py query --site gill --start 2015-12-01 --end 2016-01-01 --class arc --min-confidence 0.9
+"""
+
+import argparse
+import calendar
+import os
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+
+from classification_store import read_store, store_path
+
+def open_index(index_path='./classifications_index.sqlite'):
+    """ Open the index database, creating it if needed
+    Inputs:
+        index_path: str. Path of the sqlite file
+    Returns:
+        conn: sqlite3.Connection
+    """
+    conn = sqlite3.connect(index_path, timeout=60, check_same_thread=False)
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS sources (
+            source_id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER,
+            mtime_ns INTEGER,
+            row_count INTEGER);
+        CREATE TABLE IF NOT EXISTS frames (
+            site TEXT NOT NULL,
+            asi TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            prediction INTEGER,
+            prediction_str TEXT,
+            confidence REAL,
+            source_id INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS frames_site_time ON frames (site, timestamp);
+        CREATE INDEX IF NOT EXISTS frames_site_class_time ON frames (site, prediction_str, timestamp);
+        CREATE INDEX IF NOT EXISTS frames_class_confidence ON frames (prediction_str, confidence);
+        CREATE INDEX IF NOT EXISTS frames_source ON frames (source_id);''')
+    conn.commit()
+    return conn
+
+# asi name of a classification file. Example: '2015/12/1/20151201_gill_themis19_classifications.h5' -> 'gill_themis19'
+def _asi_name(path):
+    name = os.path.basename(path)
+    name = name[:name.rindex('_classifications')]
+    return name.split('_', 1)[1]
+
+# rows of a classification file with POSIX timestamps
+def _read_rows(path):
+    if path.endswith('.h5'):
+        df, softmax, attrs = read_store(path)
+        return df
+    df = pd.read_csv(path, sep='\t', comment='#', dtype={'date': str, 'time': str})
+    timestamps = [calendar.timegm(datetime.strptime(d+t, '%Y%m%d%H:%M:%S').timetuple())
+                  for d, t in zip(df['date'], df['time'])]
+    return pd.DataFrame({'timestamp': timestamps, 'prediction': df['prediction'],
+                         'prediction_str': df['prediction_str'], 'confidence': df['confidence']})
+
+def index_file(conn, path):
+    """ Add or refresh one classification file, unchanged files are skipped
+    Inputs:
+        conn: sqlite3.Connection from open_index()
+        path: str. A *_classifications.h5 store or *_classifications.txt file, stored by its real path so relative
+            and absolute paths of one file are the same source
+    Returns:
+        row_count: int. Rows indexed, 0 if the file was unchanged
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    row = conn.execute('SELECT source_id, size, mtime_ns FROM sources WHERE path = ?', (path,)).fetchone()
+    if row is not None and row[1] == stat.st_size and row[2] == stat.st_mtime_ns:
+        return 0
+
+    df = _read_rows(path)
+    asi = _asi_name(path)
+    site = asi.split('_')[0]
+    with conn:
+        if row is None:
+            source_id = conn.execute('INSERT INTO sources (path, size, mtime_ns, row_count) VALUES (?, ?, ?, ?)',
+                                     (path, stat.st_size, stat.st_mtime_ns, len(df))).lastrowid
+        else:
+            source_id = row[0]
+            conn.execute('DELETE FROM frames WHERE source_id = ?', (source_id,))
+            conn.execute('UPDATE sources SET size = ?, mtime_ns = ?, row_count = ? WHERE source_id = ?',
+                         (stat.st_size, stat.st_mtime_ns, len(df), source_id))
+        conn.executemany('INSERT INTO frames (site, asi, timestamp, prediction, prediction_str, confidence, source_id) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         zip([site]*len(df), [asi]*len(df), df['timestamp'].astype('int64').tolist(),
+                             df['prediction'].astype('int64').tolist(), df['prediction_str'].astype(str).tolist(),
+                             df['confidence'].astype(float).tolist(), [source_id]*len(df)))
+    return len(df)
+
+def update_index(root='.', index_path='./classifications_index.sqlite'):
+    """ Index every new or changed classification file under root, and drop the files that are gone
+    Inputs:
+        root: str. Folder holding the YYYY/M/D classification folders
+        index_path: str. Path of the sqlite file
+    Returns:
+        counts: dict. Number of files indexed, skipped and removed
+    """
+    conn = open_index(index_path)
+    counts = {'indexed': 0, 'skipped': 0, 'removed': 0}
+    seen = set()
+    for folder_path, dirs, file_names in os.walk(root):
+        dirs.sort()
+        for file_name in sorted(file_names):
+            path = os.path.realpath(os.path.join(folder_path, file_name))
+            if file_name.endswith('_classifications.h5'):
+                pass
+            # txt files are only indexed for days without a store
+            elif file_name.endswith('_classifications.txt') and not os.path.exists(store_path(path)):
+                pass
+            else:
+                continue
+            seen.add(path)
+            if index_file(conn, path):
+                counts['indexed'] += 1
+            else:
+                counts['skipped'] += 1
+
+    # files removed under root since the last update, and the relative paths stored by older versions
+    root_path = os.path.realpath(root)
+    for source_id, path in conn.execute('SELECT source_id, path FROM sources').fetchall():
+        resolved = os.path.realpath(path)
+        inside = resolved == root_path or resolved.startswith(os.path.join(root_path, ''))
+        if inside and path not in seen:
+            with conn:
+                conn.execute('DELETE FROM frames WHERE source_id = ?', (source_id,))
+                conn.execute('DELETE FROM sources WHERE source_id = ?', (source_id,))
+            counts['removed'] += 1
+    conn.close()
+    return counts
+
+# POSIX timestamp of a datetime or a 'YYYY-MM-DD[ HH:MM:SS]' string in UT
+def _to_timestamp(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return calendar.timegm(value.timetuple())
+
+def query(index_path='./classifications_index.sqlite', site=None, start=None, end=None, prediction_str=None,
+          min_confidence=None, limit=None):
+    """ Query the indexed frames
+    Inputs:
+        index_path: str. Path of the sqlite file
+        site: str. Example: 'gill'
+        start, end: datetime or str in UT, start included and end excluded. Example: '2015-12-01'
+        prediction_str: str. Example: 'arc'
+        min_confidence: float. Only frames with a larger confidence
+        limit: int. Maximum number of rows
+    Returns:
+        df: pandas.DataFrame. Columns site, asi, datetime, prediction, prediction_str, confidence, sorted in time
+    """
+    conditions, params = [], []
+    if site is not None:
+        conditions.append('site = ?')
+        params.append(site)
+    if start is not None:
+        conditions.append('timestamp >= ?')
+        params.append(_to_timestamp(start))
+    if end is not None:
+        conditions.append('timestamp < ?')
+        params.append(_to_timestamp(end))
+    if prediction_str is not None:
+        conditions.append('prediction_str = ?')
+        params.append(prediction_str)
+    if min_confidence is not None:
+        conditions.append('confidence > ?')
+        params.append(min_confidence)
+
+    sql = 'SELECT site, asi, timestamp, prediction, prediction_str, confidence FROM frames'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY timestamp, site'
+    if limit is not None:
+        sql += f' LIMIT {int(limit)}'
+
+    conn = open_index(index_path)
+    df = pd.read_sql_query(sql, conn, params=params)
+    conn.close()
+    df.insert(2, 'datetime', pd.to_datetime(df.pop('timestamp'), unit='s'))
+    return df
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index and query the THEMIS classification files.')
+    parser.add_argument('--index', default='./classifications_index.sqlite', help='sqlite file of the index')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    update_parser = subparsers.add_parser('update', help='index new or changed classification files')
+    update_parser.add_argument('root', nargs='?', default='.', help='folder holding the YYYY/M/D folders')
+
+    query_parser = subparsers.add_parser('query', help='print the frames matching the filters as tab separated rows')
+    query_parser.add_argument('--site', default=None)
+    query_parser.add_argument('--start', default=None, help='UT, format: YYYY-MM-DD[ HH:MM:SS]')
+    query_parser.add_argument('--end', default=None, help='UT, excluded, format: YYYY-MM-DD[ HH:MM:SS]')
+    query_parser.add_argument('--class', dest='prediction_str', default=None, help='example: arc')
+    query_parser.add_argument('--min-confidence', type=float, default=None)
+    query_parser.add_argument('--limit', type=int, default=None)
+    query_parser.add_argument('--count', action='store_true', help='only print the number of frames')
+
+    args = parser.parse_args()
+    if args.command == 'update':
+        print(update_index(args.root, args.index))
+    elif args.command == 'query':
+        df = query(args.index, site=args.site, start=args.start, end=args.end, prediction_str=args.prediction_str,
+                   min_confidence=args.min_confidence, limit=args.limit)
+        if args.count:
+            print(len(df))
+        else:
+            print(df.to_csv(sep='\t', index=False), end='')
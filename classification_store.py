@@ -0,0 +1,112 @@
+"""
+Columnar store of the all_tasks.py classifications.
+One appendable h5 file per (date, camera) next to the classification txt file, with the frame timestamps,
+predicted class, confidence and the full softmax vector. The txt files are exported from it.
+"""
+
+import calendar
+import os
+from datetime import datetime
+
+import h5py
+import numpy as np
+import pandas as pd
+
+# frames per h5 chunk, about 13 minutes of images at 3 s cadence
+_chunk_rows = 256
+
+# columns of the classification txt files
+txt_columns = ['date', 'time', 'prediction', 'prediction_str', 'confidence']
+
+# path of the h5 store next to a classification txt file
+def store_path(txt_path):
+    return os.path.splitext(txt_path)[0]+'.h5'
+
+# POSIX timestamps in UTC of keys like 'atha20200104000206'
+def keys_to_timestamps(keys):
+    return np.array([calendar.timegm(datetime.strptime(key[4:], '%Y%m%d%H%M%S').timetuple()) for key in keys],
+                    dtype='int64')
+
+def create_store(h5f, classes, attrs=None):
+    """ Create the empty appendable datasets in an open h5 file
+    Inputs:
+        h5f: h5py.File opened for writing
+        classes: list of str. Class names of the model, in softmax order
+        attrs: dict. Extra file attributes, example: {'asi': 'gill_themis19', 'model_version': 'CNN_0524-...'}
+    """
+    n_classes = len(classes)
+    h5f.create_dataset('timestamp', shape=(0,), maxshape=(None,), dtype='int64', chunks=(_chunk_rows,))
+    h5f.create_dataset('prediction', shape=(0,), maxshape=(None,), dtype='int16', chunks=(_chunk_rows,))
+    h5f.create_dataset('confidence', shape=(0,), maxshape=(None,), dtype='float32', chunks=(_chunk_rows,))
+    h5f.create_dataset('softmax', shape=(0, n_classes), maxshape=(None, n_classes), dtype='float32',
+                       chunks=(_chunk_rows, n_classes))
+    h5f['timestamp'].attrs['about'] = 'UT POSIX Timestamp of the start of the image.'
+    h5f.attrs['classes'] = [str(c) for c in classes]
+    for key, value in (attrs or {}).items():
+        h5f.attrs[key] = value
+
+def append_rows(h5f, timestamps, preds):
+    """ Append frames to a store created by create_store()
+    Inputs:
+        h5f: h5py.File
+        timestamps: numpy.ndarray. int64 POSIX timestamps, one per frame
+        preds: numpy.ndarray. Softmax of shape (N, n_classes)
+    """
+    preds = np.asarray(preds, dtype='float32')
+    n = len(timestamps)
+    start = h5f['timestamp'].shape[0]
+    for name in ['timestamp', 'prediction', 'confidence', 'softmax']:
+        h5f[name].resize(start + n, axis=0)
+    h5f['timestamp'][start:] = timestamps
+    h5f['prediction'][start:] = np.argmax(preds, axis=1)
+    h5f['confidence'][start:] = np.max(preds, axis=1)
+    h5f['softmax'][start:] = preds
+
+def read_store(h5_path):
+    """ Read a store back
+    Inputs:
+        h5_path: str. Example: '2011/8/8/20110808_mcgr_themis11_classifications.h5'
+    Returns:
+        df: pandas.DataFrame. Columns timestamp, prediction, prediction_str, confidence
+        softmax: numpy.ndarray of shape (N, n_classes)
+        attrs: dict. File attributes, including 'classes'
+    """
+    with h5py.File(h5_path, 'r') as h5f:
+        attrs = {key: h5f.attrs[key] for key in h5f.attrs}
+        classes = np.array([str(c) for c in h5f.attrs['classes']])
+        prediction = h5f['prediction'][:]
+        df = pd.DataFrame({'timestamp': h5f['timestamp'][:],
+                           'prediction': prediction,
+                           'prediction_str': classes[prediction] if len(prediction) else np.array([], dtype=str),
+                           'confidence': h5f['confidence'][:]})
+        softmax = h5f['softmax'][:]
+    attrs['classes'] = list(classes)
+    return df, softmax, attrs
+
+# rows in the txt format from a store dataframe
+def to_txt_rows(df):
+    dts = pd.to_datetime(df['timestamp'], unit='s')
+    return pd.DataFrame({'date': dts.dt.strftime('%Y%m%d'),
+                         'time': dts.dt.strftime('%H:%M:%S'),
+                         'prediction': df['prediction'].astype('int64'),
+                         'prediction_str': df['prediction_str'],
+                         'confidence': df['confidence']},
+                        columns=txt_columns)
+
+def export_txt(h5_path, txt_path):
+    """ Export a store to the tab separated classification txt format
+    Inputs:
+        h5_path: str. Store written by write_classifications()
+        txt_path: str. Example: '2011/8/8/20110808_mcgr_themis11_classifications.txt'
+    Returns:
+        row_num: int
+    """
+    df, softmax, attrs = read_store(h5_path)
+    with open(txt_path+'.part', 'w') as f:
+        # create the comment section
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        comment = f"# File created on {now}\n# This file contains the predictions generated by the model.\n\n"
+        f.write(comment)
+        to_txt_rows(df).to_csv(f, sep='\t', index=False)
+    os.replace(txt_path+'.part', txt_path)
+    return len(df)
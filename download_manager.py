@@ -0,0 +1,206 @@
+"""
+Concurrent, resumable download of THEMIS days.
+The remote day folder is listed once, its ut** hour folders are fetched in parallel with a bounded number of rsync
+processes, and every file is checked against the listed sizes. The listing and the completed hours are kept in a
+manifest in the day folder, so an interrupted day resumes with the missing hours only.
+The server is an rsync:// url, or a local folder (plain path or file:// url) with the same layout for testing.
+"""
+
+import fnmatch
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# base of the THEMIS all-sky imager data, holds the stream0/ and skymaps/ folders
+themis_server = 'rsync://data.phys.ucalgary.ca/data/sort_by_project/THEMIS/asi/'
+
+# manifest of a downloaded day, hidden so the image listing functions skip it
+manifest_name = '.download_manifest.json'
+
+# one entry of an rsync listing: permissions, size, date, time and path
+_rsync_entry = re.compile(r'^([dl-][rwxsStT-]{9})\s+([\d,]+)\s+\S+\s+\S+\s+(.+)$')
+
+# local folder of a file:// url or a plain path, None for rsync urls
+def _local_path(url):
+    if url.startswith('rsync://'):
+        return None
+    return url[len('file://'):] if url.startswith('file://') else url
+
+def list_remote(url, recursive=False):
+    """ List a remote folder
+    Inputs:
+        url: str. Folder url ending with '/'. Example: 'rsync://data.phys.ucalgary.ca/data/sort_by_project/THEMIS/asi/stream0/2020/01/04/'
+        recursive: Bool. 0-only the folder, 1-every file below it
+    Returns:
+        entries: list of (path, size, is_dir). Paths are relative to the folder
+    """
+    local_path = _local_path(url)
+    if local_path is not None:
+        entries = []
+        if recursive:
+            for root, dirs, file_names in os.walk(local_path):
+                dirs.sort()
+                for file_name in sorted(file_names):
+                    path = os.path.join(root, file_name)
+                    entries.append((os.path.relpath(path, local_path), os.path.getsize(path), False))
+        else:
+            for name in sorted(os.listdir(local_path)):
+                path = os.path.join(local_path, name)
+                is_dir = os.path.isdir(path)
+                entries.append((name, 0 if is_dir else os.path.getsize(path), is_dir))
+        return entries
+
+    command = ['rsync', '--list-only'] + (['-r'] if recursive else []) + [url]
+    output = subprocess.check_output(command, timeout=600).decode('UTF-8', errors='replace')
+    entries = []
+    for line in output.splitlines():
+        match = _rsync_entry.match(line.strip())
+        if match is None or match.group(3) == '.':
+            continue
+        entries.append((match.group(3), int(match.group(2).replace(',', '')), match.group(1)[0] == 'd'))
+    return entries
+
+def fetch_folder(url, folder_path, pattern=None):
+    """ Copy the files of a remote folder, partial files are resumed and complete ones skipped
+    Inputs:
+        url: str. Folder url ending with '/'
+        folder_path: str. Local destination folder
+        pattern: str or None. Only the file names matching this pattern. Example: '*.sav'
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    local_path = _local_path(url)
+    if local_path is None:
+        filters = [f'--include={pattern}', '--exclude=*'] if pattern else []
+        subprocess.run(['rsync', '-rt', '--partial', '--timeout=300'] + filters + [url, folder_path],
+                       stdout=subprocess.DEVNULL, check=True)
+        return
+
+    for path, size, is_dir in list_remote(url, recursive=True):
+        if pattern and not fnmatch.fnmatch(os.path.basename(path), pattern):
+            continue
+        destination = os.path.join(folder_path, path)
+        if os.path.exists(destination) and os.path.getsize(destination) == size:
+            continue
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        _copy_replace(os.path.join(local_path, path), destination)
+
+# copy a file through a temporary file of its own in the destination folder, so concurrent copies of the same file
+# never share a partial file and the destination is always whole
+def _copy_replace(source_path, destination):
+    fd, part_path = tempfile.mkstemp(dir=os.path.dirname(destination), prefix='.'+os.path.basename(destination)+'.',
+                                     suffix='.part')
+    os.close(fd)
+    try:
+        shutil.copy2(source_path, part_path)
+        os.replace(part_path, destination)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+# hour folders of the remote listing of a camera day, {'ut00': {'ut00/..._full.pgm.gz': size, ...}, ...}
+def _group_hours(entries):
+    hours = {}
+    for path, size, is_dir in entries:
+        parts = path.split('/')
+        if is_dir or len(parts) != 2:
+            continue
+        hours.setdefault(parts[0], {})[path] = size
+    return hours
+
+# hours whose local files all exist with the listed sizes
+def _complete_hours(full_path, hours):
+    complete = []
+    for hour, files in hours.items():
+        if all(os.path.exists(os.path.join(full_path, path)) and os.path.getsize(os.path.join(full_path, path)) == size
+               for path, size in files.items()):
+            complete.append(hour)
+    return complete
+
+def read_manifest(full_path):
+    """ Read the manifest of a day folder, None if the day was never listed """
+    manifest_path = os.path.join(full_path, manifest_name)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def _write_manifest(full_path, manifest):
+    manifest_path = os.path.join(full_path, manifest_name)
+    fd, part_path = tempfile.mkstemp(dir=full_path, prefix=manifest_name+'.', suffix='.part')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(part_path, manifest_path)
+
+def verify_day(full_path):
+    """ Check a day folder against its manifest
+    Inputs:
+        full_path: str. Example: './images/gako/2020-01-31'
+    Returns:
+        complete: Bool. 1 if the day was listed and every listed file is there with its size
+        missing_hours: list of str. Example: ['ut05', 'ut06']
+    """
+    manifest = read_manifest(full_path)
+    if manifest is None:
+        return False, []
+    complete = _complete_hours(full_path, manifest['hours'])
+    missing_hours = sorted(hour for hour in manifest['hours'] if hour not in complete)
+    return not missing_hours, missing_hours
+
+def download_day(date, asi, full_path, server=themis_server, max_transfers=4):
+    """ Download the hour folders of one camera day in parallel, resuming a partial download
+    Inputs:
+        date: datetime object. Example: datetime.datetime(2020, 3, 19, 0, 0)
+        asi: str. Example: 'gako'
+        full_path: str. Day folder receiving the ut** folders. Example: './images/gako/2020-03-19'
+        server: str. rsync:// url or local folder holding stream0/
+        max_transfers: int. Number of rsync processes at once
+    Returns:
+        manifest: dict. Remote listing of the hours, the complete hours and whether the day is complete
+    """
+    os.makedirs(full_path, exist_ok=True)
+    date_url = server + 'stream0/' + date.strftime('%Y/%m/%d/')
+
+    # the cameras of the site on that day, usually one. The hours of several cameras are merged, their file names
+    # differ by camera, and every hour keeps one url per camera folder
+    asi_folders = [path for path, size, is_dir in list_remote(date_url) if is_dir and path.startswith(asi)]
+    hours, hour_urls = {}, {}
+    for asi_folder in asi_folders:
+        asi_url = date_url + asi_folder + '/'
+        for hour, files in _group_hours(list_remote(asi_url, recursive=True)).items():
+            hours.setdefault(hour, {}).update(files)
+            hour_urls.setdefault(hour, []).append(asi_url + hour + '/')
+
+    # only the hours missing files are fetched
+    manifest = {'date': date.strftime('%Y-%m-%d'), 'asi': asi, 'server': server, 'hours': hours}
+    pending = sorted(hour for hour in hours if hour not in _complete_hours(full_path, {hour: hours[hour]}))
+    _write_manifest(full_path, dict(manifest, complete_hours=sorted(set(hours) - set(pending)), complete=False))
+    logging.info(f'{asi} {manifest["date"]}: {len(hours)} hours listed, {len(pending)} to fetch')
+
+    def fetch(hour):
+        for hour_url in hour_urls[hour]:
+            fetch_folder(hour_url, os.path.join(full_path, hour))
+        return hour
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, max_transfers)) as executor:
+        futures = {hour: executor.submit(fetch, hour) for hour in pending}
+        for hour, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logging.critical(f'Unable to download {", ".join(hour_urls[hour])}')
+                logging.critical('Exception: {}'.format(e))
+                errors.append(hour)
+
+    # the day is complete when every listed file is there with its size
+    complete_hours = sorted(_complete_hours(full_path, hours))
+    manifest.update(complete_hours=complete_hours, complete=len(complete_hours) == len(hours))
+    _write_manifest(full_path, manifest)
+    logging.info(f'{asi} {manifest["date"]}: {len(complete_hours)} of {len(hours)} hours complete')
+    return manifest
@@ -0,0 +1,146 @@
+"""
+Persistent cache of decoded THEMIS hours.
+Each decoded ut** folder is kept as one contiguous uint16 .npy block of shape (256, 256, N), keyed by the fingerprint
+of its .pgm.gz files, with its image names and size in a sqlite table. Later reads memory-map the block instead of
+decompressing the hour again. The least recently used hours are evicted once the cache is larger than its limit.
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+import numpy
+
+# default size limit of the cache in MB, about 13 camera-days of uint16 frames
+max_cache_mb = 20480
+
+# changes whenever the layout of the cached blocks changes, so old blocks are never read back
+_format_version = 1
+
+def open_cache(cache_folder_path):
+    """ Open the table of a cache folder, creating both if needed
+    Inputs:
+        cache_folder_path: str. Example: './frame_cache'
+    Returns:
+        conn: sqlite3.Connection
+    """
+    os.makedirs(cache_folder_path, exist_ok=True)
+    # a long timeout lets the decode workers share one cache
+    conn = sqlite3.connect(os.path.join(cache_folder_path, 'frame_cache.sqlite'), timeout=60)
+    conn.execute('''CREATE TABLE IF NOT EXISTS hours (
+                        key TEXT PRIMARY KEY,
+                        folder_path TEXT,
+                        frames INTEGER,
+                        bytes INTEGER,
+                        image_names TEXT,
+                        last_used REAL)''')
+    conn.commit()
+    return conn
+
+def hour_key(file_paths):
+    """ Fingerprint the compressed files of one hour from their names, sizes and modification times
+    Inputs:
+        file_paths: list of str. The .pgm.gz files given to themis_imager_readfile.read
+    Returns:
+        key: str. sha1 hex digest
+    """
+    digest = hashlib.sha1(f'v{_format_version}'.encode())
+    for file_path in sorted(file_paths):
+        stat = os.stat(file_path)
+        digest.update(f'{os.path.basename(file_path)}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+# path of the block of a key
+def _block_path(cache_folder_path, key):
+    return os.path.join(cache_folder_path, key+'.npy')
+
+def load_hour(cache_folder_path, key):
+    """ Memory-map a cached hour
+    Inputs:
+        cache_folder_path: str. Example: './frame_cache'
+        key: str. From hour_key()
+    Returns:
+        img: read-only numpy.memmap of uint16 frames (256, 256, N), None if the hour is not cached
+        image_names: list of str. Example: ['atha20200104000206', ...], one per frame
+    """
+    conn = open_cache(cache_folder_path)
+    try:
+        row = conn.execute('SELECT image_names FROM hours WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None, None
+        try:
+            img = numpy.load(_block_path(cache_folder_path, key), mmap_mode='r')
+        except FileNotFoundError:
+            # evicted by another process
+            return None, None
+        with conn:
+            conn.execute('UPDATE hours SET last_used = ? WHERE key = ?', (time.time(), key))
+    finally:
+        conn.close()
+    return img, row[0].split('\n')
+
+def store_hour(cache_folder_path, key, folder_path, img, image_names, max_mb=max_cache_mb):
+    """ Add a decoded hour to the cache, then evict the least recently used hours above the size limit
+    Inputs:
+        cache_folder_path: str. Example: './frame_cache'
+        key: str. From hour_key()
+        folder_path: str. The ut** folder, only kept for reference
+        img: numpy.ndarray. uint16 frames (256, 256, N)
+        image_names: list of str. One per frame
+        max_mb: int. Size limit of the cache in MB
+    """
+    if not image_names:
+        return
+    os.makedirs(cache_folder_path, exist_ok=True)
+    block_path = _block_path(cache_folder_path, key)
+
+    # written to a partial file first, a killed run never leaves a truncated block
+    part_path = f'{block_path}.{os.getpid()}.part'
+    with open(part_path, 'wb') as f:
+        numpy.save(f, numpy.ascontiguousarray(img))
+    os.replace(part_path, block_path)
+
+    conn = open_cache(cache_folder_path)
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO hours (key, folder_path, frames, bytes, image_names, last_used) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (key, folder_path, len(image_names), os.path.getsize(block_path), '\n'.join(image_names),
+                          time.time()))
+        _evict(conn, cache_folder_path, max_mb)
+    finally:
+        conn.close()
+
+# remove the least recently used hours until the cache fits in max_mb, returns the number removed
+def _evict(conn, cache_folder_path, max_mb):
+    rows = conn.execute('SELECT key, bytes FROM hours ORDER BY last_used DESC').fetchall()
+    total = 0
+    removed = 0
+    for key, size in rows:
+        total += size
+        if total <= max_mb * 1024**2:
+            continue
+        with conn:
+            conn.execute('DELETE FROM hours WHERE key = ?', (key,))
+        # readers that mapped the block keep it until they are done
+        try:
+            os.remove(_block_path(cache_folder_path, key))
+        except FileNotFoundError:
+            pass
+        removed += 1
+    return removed
+
+def evict(cache_folder_path, max_mb=max_cache_mb):
+    """ Remove the least recently used hours until the cache fits in max_mb
+    Inputs:
+        cache_folder_path: str. Example: './frame_cache'
+        max_mb: int. Size limit of the cache in MB
+    Returns:
+        removed: int. Number of hours removed
+    """
+    conn = open_cache(cache_folder_path)
+    try:
+        return _evict(conn, cache_folder_path, max_mb)
+    finally:
+        conn.close()
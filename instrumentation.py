@@ -0,0 +1,225 @@
+"""
+Per-stage instrumentation of the THEMIS pipelines.
+Code runs inside named spans (decode, contrast, preprocess, infer, encode, write, ...) labelled with the date, site and hour
+they work on. Every span records its wall time, the CPU time of its thread, the frames it handled, the bytes it read
+and wrote and the peak RSS of the process, appends one JSON line to the metrics file and adds to an in-process total.
+cpu_seconds only counts the thread that opened the span, so spans overlapping on other threads are not charged each
+other's CPU; the work a span hands to a thread pool is in process_cpu_seconds, the CPU time of the whole process
+during the span, which is kept in the records but not added up.
+Spans nest: self_seconds is the wall time of a span minus the spans opened inside it on the same thread, so the
+summary table shows where the time goes without double counting.
+Spawned worker processes inherit the metrics file through the environment and append to the same file.
+"""
+
+import argparse
+import contextlib
+import functools
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import socket
+import threading
+import time
+
+# metrics file and run id, inherited by spawned workers through the environment
+_metrics_env = 'THEMIS_METRICS_PATH'
+_run_env = 'THEMIS_METRICS_RUN'
+
+# fields added up by the summary
+_sum_fields = ['wall_seconds', 'self_seconds', 'cpu_seconds', 'frames', 'bytes_read', 'bytes_written']
+
+# open spans and labels of each thread
+_thread_state = threading.local()
+
+# totals of the spans of this process per name, and the lock of the totals and the metrics file
+_totals = {}
+_lock = threading.Lock()
+
+def configure(metrics_path=None, run=None):
+    """ Set the metrics file of this process and of the workers it spawns later
+    Inputs:
+        metrics_path: str or None. JSONL file the span records are appended to, None to only keep the totals in memory
+        run: str or None. Id written in every record, default from the host, pid and time
+    Returns:
+        run: str
+    """
+    run = run or f'{socket.gethostname()}-{os.getpid()}-{int(time.time())}'
+    if metrics_path is None:
+        os.environ.pop(_metrics_env, None)
+    else:
+        directory_path = os.path.dirname(metrics_path)
+        if directory_path and not os.path.exists(directory_path):
+            os.makedirs(directory_path)
+        os.environ[_metrics_env] = os.path.abspath(metrics_path)
+    os.environ[_run_env] = run
+    return run
+
+def peak_rss_mb():
+    """ Peak resident memory of this process in MB """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if platform.system() == 'Darwin' else peak / 1024
+
+# date, site and hour of a stream0 or downloaded images path, or of a classification file.
+# Example: 'stream0/2020/01/04/gako_themis19/ut05' or './images/gako/2020-01-04/ut05' -> {'date': '2020-01-04', 'site': 'gako', 'hour': 'ut05'}
+def path_labels(path):
+    parts = os.path.normpath(path).split(os.sep)
+    labels = {}
+    # '20200104_gako_themis19_classifications.txt'
+    match = re.match(r'(\d{4})(\d{2})(\d{2})_([a-z]{4})_themis\d+_', parts[-1])
+    if match:
+        return {'date': '-'.join(match.groups()[:3]), 'site': match.group(4)}
+    if parts and re.fullmatch(r'ut\d\d', parts[-1]):
+        labels['hour'] = parts[-1]
+        parts = parts[:-1]
+    if len(parts) >= 2 and re.fullmatch(r'\d{4}-\d{2}-\d{2}(-decompressed)?', parts[-1]):
+        labels.update(date=parts[-1][:10], site=parts[-2])
+    elif len(parts) >= 4 and re.fullmatch(r'[a-z]{4}_themis\d+', parts[-1]):
+        labels.update(date='-'.join(parts[-4:-1]), site=parts[-1][:4])
+    return labels
+
+# date and site of image names or keys. Example: ['gako20200104000003', ...] -> {'date': '2020-01-04', 'site': 'gako'}
+def name_labels(image_names):
+    if not image_names:
+        return {}
+    name = image_names[0]
+    return {'date': f'{name[4:8]}-{name[8:10]}-{name[10:12]}', 'site': name[:4]}
+
+@contextlib.contextmanager
+def labels(**kwargs):
+    """ Labels added to the spans opened on this thread inside the block, example: labels(date='2020-01-04', site='gako') """
+    previous = getattr(_thread_state, 'labels', {})
+    _thread_state.labels = dict(previous, **{key: value for key, value in kwargs.items() if value is not None})
+    try:
+        yield
+    finally:
+        _thread_state.labels = previous
+
+@contextlib.contextmanager
+def span(name, **kwargs):
+    """ Measure the block as one span
+    Inputs:
+        name: str. Stage name. Example: 'decode'
+        kwargs: labels of this span, added to the labels() of the thread
+    Yields:
+        record: dict. Set 'frames', 'bytes_read' and 'bytes_written' in it, extra keys are written as they are
+    """
+    stack = getattr(_thread_state, 'stack', None)
+    if stack is None:
+        stack = _thread_state.stack = []
+    record = dict(getattr(_thread_state, 'labels', {}), **{key: value for key, value in kwargs.items() if value is not None})
+    record.update(span=name, parent=stack[-1]['span'] if stack else None, frames=0, bytes_read=0, bytes_written=0)
+    child_seconds = [0.0]
+    stack.append({'span': name, 'child_seconds': child_seconds})
+    start = time.time()
+    tic = time.perf_counter()
+    cpu_tic = time.thread_time()
+    process_cpu_tic = time.process_time()
+    try:
+        yield record
+    finally:
+        wall_seconds = time.perf_counter() - tic
+        stack.pop()
+        if stack:
+            stack[-1]['child_seconds'][0] += wall_seconds
+        record.update(run=os.environ.get(_run_env), pid=os.getpid(), start=start, wall_seconds=wall_seconds,
+                      self_seconds=max(wall_seconds - child_seconds[0], 0.0),
+                      cpu_seconds=time.thread_time() - cpu_tic,
+                      process_cpu_seconds=time.process_time() - process_cpu_tic, peak_rss_mb=peak_rss_mb())
+        _record(record)
+
+# add a finished span to the totals and the metrics file
+def _record(record):
+    with _lock:
+        _add(_totals, record)
+        metrics_path = os.environ.get(_metrics_env)
+        if metrics_path is not None:
+            try:
+                with open(metrics_path, 'a') as f:
+                    f.write(json.dumps(record, default=str)+'\n')
+            except OSError as e:
+                logging.critical(f'unable to write the metrics to {metrics_path}, error = {e}')
+
+# add a span record to totals per span name
+def _add(totals, record):
+    total = totals.setdefault(record['span'], dict({field: 0 for field in _sum_fields}, count=0, peak_rss_mb=0.0))
+    total['count'] += 1
+    for field in _sum_fields:
+        total[field] += record.get(field) or 0
+    total['peak_rss_mb'] = max(total['peak_rss_mb'], record.get('peak_rss_mb') or 0.0)
+
+def timed(func):
+    """ Decorator running the whole function as a span named after it, and logging its wall time """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__) as record:
+            result = func(*args, **kwargs)
+        logging.info(f'{func.__name__} took {record["wall_seconds"]:.3f} seconds')
+        return result
+    return wrapper
+
+def read_metrics(metrics_path, run=None):
+    """ Read the span records of a metrics file
+    Inputs:
+        metrics_path: str. JSONL file
+        run: str or None. Only the records of this run
+    Returns:
+        records: list of dict, empty if the file was never written
+    """
+    records = []
+    if not os.path.exists(metrics_path):
+        return records
+    with open(metrics_path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if run is None or record.get('run') == run:
+                    records.append(record)
+    return records
+
+def summarize(records=None):
+    """ Totals per span name
+    Inputs:
+        records: list of dict from read_metrics(), default the spans of this process
+    Returns:
+        totals: dict. {name: {'count', 'wall_seconds', 'self_seconds', 'cpu_seconds', 'frames', 'bytes_read', 'bytes_written', 'peak_rss_mb'}}
+    """
+    if records is None:
+        with _lock:
+            return {name: dict(total) for name, total in _totals.items()}
+    totals = {}
+    for record in records:
+        _add(totals, record)
+    return totals
+
+def format_summary(totals):
+    """ Table of summarize() sorted by self time, the share is of the total self time of every span.
+    The cpu column is the CPU of the thread of each span, the threads it hands work to are not included
+    """
+    all_self = sum(total['self_seconds'] for total in totals.values()) or 1.0
+    lines = [f'{"span":<30}{"count":>7}{"wall s":>10}{"self s":>10}{"share":>7}{"thread cpu s":>14}{"frames":>9}'
+             f'{"frames/s":>10}{"MB read":>9}{"MB written":>11}{"peak RSS MB":>12}']
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]['self_seconds']):
+        fps = total['frames'] / total['wall_seconds'] if total['wall_seconds'] and total['frames'] else 0.0
+        lines.append(f'{name:<30}{total["count"]:>7}{total["wall_seconds"]:>10.1f}{total["self_seconds"]:>10.1f}'
+                     f'{total["self_seconds"] / all_self:>7.0%}{total["cpu_seconds"]:>14.1f}{total["frames"]:>9}'
+                     f'{fps:>10.1f}{total["bytes_read"] / 1e6:>9.1f}{total["bytes_written"] / 1e6:>11.1f}'
+                     f'{total["peak_rss_mb"]:>12.1f}')
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize a metrics file of the THEMIS pipelines.')
+    parser.add_argument('metrics_path', help='JSONL metrics file')
+    parser.add_argument('--run', default=None, help='only the spans of this run, default every run')
+    args = parser.parse_args()
+    print(format_summary(summarize(read_metrics(args.metrics_path, args.run))))
@@ -0,0 +1,100 @@
+"""
+Persistent job manifest for all_tasks.py.
+One row per (date, asi, hour) unit records its state, the fingerprint of its input files,
+the model version and the output path, so reruns skip completed units and retry the failed ones.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+# the pipeline writer thread shares the connection with the main thread
+_lock = threading.RLock()
+
+# unit states
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+def open_manifest(manifest_path='./all_tasks_manifest.sqlite'):
+    """ Open the manifest database, creating it if needed
+    Inputs:
+        manifest_path: str. Path of the sqlite file
+    Returns:
+        conn: sqlite3.Connection
+    """
+    directory_path = os.path.dirname(manifest_path)
+    if directory_path and not os.path.exists(directory_path):
+        os.makedirs(directory_path)
+
+    # a long timeout lets several processes share one manifest
+    conn = sqlite3.connect(manifest_path, timeout=60, check_same_thread=False)
+    conn.execute('''CREATE TABLE IF NOT EXISTS units (
+                        date TEXT NOT NULL,
+                        asi TEXT NOT NULL,
+                        hour TEXT NOT NULL,
+                        state TEXT NOT NULL,
+                        fingerprint TEXT,
+                        model_version TEXT,
+                        output_path TEXT,
+                        error TEXT,
+                        updated REAL,
+                        PRIMARY KEY (date, asi, hour))''')
+    conn.commit()
+    return conn
+
+def fingerprint_folder(folder_path):
+    """ Fingerprint the image files of one ut** folder from their names, sizes and modification times
+    Inputs:
+        folder_path: str. Example: 'stream0/2011/08/08/mcgr_themis11/ut09'
+    Returns:
+        fingerprint: str. sha1 hex digest
+    """
+    digest = hashlib.sha1()
+    for file_name in sorted(os.listdir(folder_path)):
+        if file_name.startswith('.'):
+            continue
+        stat = os.stat(os.path.join(folder_path, file_name))
+        digest.update(f'{file_name}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+def get_unit(conn, date, asi, hour):
+    """ Return the manifest row of a unit as a dict, or None if it was never recorded """
+    with _lock:
+        cursor = conn.execute('SELECT date, asi, hour, state, fingerprint, model_version, output_path, error, updated '
+                              'FROM units WHERE date = ? AND asi = ? AND hour = ?', (date, asi, hour))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    keys = ['date', 'asi', 'hour', 'state', 'fingerprint', 'model_version', 'output_path', 'error', 'updated']
+    return dict(zip(keys, row))
+
+def needs_run(conn, date, asi, hour, fingerprint, model_version):
+    """ A unit needs to run unless it is done with the same input files and model version """
+    unit = get_unit(conn, date, asi, hour)
+    if unit is None or unit['state'] != DONE:
+        return True
+    return unit['fingerprint'] != fingerprint or unit['model_version'] != model_version
+
+def mark(conn, date, asi, hour, state, fingerprint=None, model_version=None, output_path=None, error=None):
+    """ Record the state of a unit, inserting the row on first use """
+    with _lock:
+        conn.execute('''INSERT INTO units (date, asi, hour, state, fingerprint, model_version, output_path, error, updated)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (date, asi, hour) DO UPDATE SET
+                            state = excluded.state,
+                            fingerprint = COALESCE(excluded.fingerprint, units.fingerprint),
+                            model_version = COALESCE(excluded.model_version, units.model_version),
+                            output_path = COALESCE(excluded.output_path, units.output_path),
+                            error = excluded.error,
+                            updated = excluded.updated''',
+                     (date, asi, hour, state, fingerprint, model_version, output_path, error, time.time()))
+        conn.commit()
+
+def summary(conn):
+    """ Count the units in each state, example: {'done': 120, 'failed': 2} """
+    with _lock:
+        return dict(conn.execute('SELECT state, COUNT(*) FROM units GROUP BY state').fetchall())
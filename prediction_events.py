@@ -0,0 +1,157 @@
+"""
+Temporal smoothing and event segmentation of the all_tasks.py classifications.
+The softmax of a whole camera-day is smoothed over time, with a time-windowed rolling mean or a time-aware exponential
+mean that both restart at gaps in the timestamps. The smoothed labels are stored next to the raw ones in the h5 store,
+and the runs of one smoothed class become events in a *_events.txt table next to the classification txt file.
+Usage:
+    python prediction_events.py 2015/12/1/20151201_gill_themis19_classifications.h5 [...] --method mean --window 60
+"""
+
+import argparse
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from classification_store import read_store
+
+# smoothing methods of smooth_predictions()
+methods = ['mean', 'ewm']
+
+# columns of the events txt files
+event_columns = ['start', 'end', 'prediction', 'prediction_str', 'mean_confidence', 'frames']
+
+# path of the events table next to a classification txt file
+def events_path(txt_path):
+    return txt_path[:-len('_classifications.txt')]+'_events.txt'
+
+# index of the first frame of every run without a gap larger than max_gap_seconds
+def _segment_starts(timestamps, max_gap_seconds):
+    return np.concatenate([[0], np.flatnonzero(np.diff(timestamps) > max_gap_seconds) + 1])
+
+# centered rolling mean over window_seconds, the window never crosses a gap
+def _rolling_mean(timestamps, softmax, window_seconds, segment_starts):
+    n = len(timestamps)
+    # first and last+1 frame of the segment of every frame
+    segment_id = np.repeat(np.arange(len(segment_starts)), np.diff(np.append(segment_starts, n)))
+    lo = segment_starts[segment_id]
+    hi = np.append(segment_starts[1:], n)[segment_id]
+
+    left = np.maximum(np.searchsorted(timestamps, timestamps - window_seconds / 2, side='left'), lo)
+    right = np.minimum(np.searchsorted(timestamps, timestamps + window_seconds / 2, side='right'), hi)
+    cumulative = np.concatenate([np.zeros((1, softmax.shape[1])), np.cumsum(softmax, axis=0, dtype='float64')])
+    return ((cumulative[right] - cumulative[left]) / (right - left)[:, None]).astype('float32')
+
+# exponential mean with a half life of window_seconds in time, not in frames, restarted at every gap
+def _ewm(timestamps, softmax, window_seconds, segment_starts):
+    smoothed = np.empty(softmax.shape, dtype='float32')
+    times = pd.to_datetime(timestamps, unit='s')
+    bounds = np.append(segment_starts, len(timestamps))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        smoothed[start:stop] = pd.DataFrame(softmax[start:stop]).ewm(
+            halflife=pd.Timedelta(seconds=window_seconds), times=times[start:stop]).mean().to_numpy()
+    return smoothed
+
+def smooth_predictions(timestamps, softmax, method='mean', window_seconds=60, max_gap_seconds=30):
+    """ Smooth the softmax of a camera-day over time
+    Inputs:
+        timestamps: numpy.ndarray. int64 POSIX timestamps, sorted, one per frame
+        softmax: numpy.ndarray of shape (N, n_classes)
+        method: str. Options: 'mean' centered rolling mean over window_seconds, 'ewm' exponential mean with a half life of window_seconds
+        window_seconds: float. Width of the window or half life, in seconds
+        max_gap_seconds: float. Frames further apart start a new segment, the smoothing never mixes segments
+    Returns:
+        smoothed: numpy.ndarray of shape (N, n_classes), float32
+    """
+    if method not in methods:
+        raise ValueError(f'method should be one of {methods}, got {method}')
+    timestamps = np.asarray(timestamps, dtype='int64')
+    softmax = np.asarray(softmax, dtype='float32')
+    if len(timestamps) == 0:
+        return softmax.copy()
+    segment_starts = _segment_starts(timestamps, max_gap_seconds)
+    if method == 'mean':
+        return _rolling_mean(timestamps, softmax, window_seconds, segment_starts)
+    return _ewm(timestamps, softmax, window_seconds, segment_starts)
+
+def segment_events(timestamps, prediction, confidence, max_gap_seconds=30):
+    """ Contiguous runs of one class without gaps
+    Inputs:
+        timestamps: numpy.ndarray. int64 POSIX timestamps, sorted, one per frame
+        prediction: numpy.ndarray. Class index of every frame
+        confidence: numpy.ndarray. Confidence of every frame
+        max_gap_seconds: float. Frames further apart end the event
+    Returns:
+        events: pandas.DataFrame. Columns start, end (POSIX timestamps of the first and last frame), prediction, mean_confidence, frames
+    """
+    timestamps = np.asarray(timestamps, dtype='int64')
+    prediction = np.asarray(prediction)
+    if len(timestamps) == 0:
+        return pd.DataFrame({'start': [], 'end': [], 'prediction': [], 'mean_confidence': [], 'frames': []})
+
+    # an event starts at a class change or after a gap
+    breaks = (np.diff(prediction) != 0) | (np.diff(timestamps) > max_gap_seconds)
+    starts = np.concatenate([[0], np.flatnonzero(breaks) + 1])
+    stops = np.append(starts[1:], len(timestamps))
+    frames = stops - starts
+    return pd.DataFrame({'start': timestamps[starts],
+                         'end': timestamps[stops - 1],
+                         'prediction': prediction[starts],
+                         'mean_confidence': np.add.reduceat(np.asarray(confidence, dtype='float64'), starts) / frames,
+                         'frames': frames})
+
+def export_events(h5_path, txt_path, method='mean', window_seconds=60, max_gap_seconds=30):
+    """ Smooth a classification store, add the smoothed labels to it and write its events table
+    Inputs:
+        h5_path: str. Store written by write_classifications()
+        txt_path: str. Events table. Example: '2011/8/8/20110808_mcgr_themis11_events.txt'
+        method, window_seconds, max_gap_seconds: see smooth_predictions()
+    Returns:
+        event_num: int
+    """
+    df, softmax, attrs = read_store(h5_path)
+    timestamps = df['timestamp'].to_numpy()
+    smoothed = smooth_predictions(timestamps, softmax, method, window_seconds, max_gap_seconds)
+    prediction = np.argmax(smoothed, axis=1) if len(smoothed) else np.empty(0, dtype='int64')
+    confidence = np.max(smoothed, axis=1) if len(smoothed) else np.empty(0, dtype='float32')
+
+    # per-frame smoothed labels next to the raw ones
+    with h5py.File(h5_path, 'a') as h5f:
+        for name, values, dtype in [('smoothed_prediction', prediction, 'int16'),
+                                    ('smoothed_confidence', confidence, 'float32')]:
+            if name in h5f:
+                del h5f[name]
+            h5f.create_dataset(name, data=values.astype(dtype))
+            h5f[name].attrs['method'] = method
+            h5f[name].attrs['window_seconds'] = window_seconds
+            h5f[name].attrs['max_gap_seconds'] = max_gap_seconds
+
+    events = segment_events(timestamps, prediction, confidence, max_gap_seconds)
+    classes = np.array(attrs['classes'])
+    table = pd.DataFrame({'start': pd.to_datetime(events['start'], unit='s').dt.strftime('%Y-%m-%d %H:%M:%S'),
+                          'end': pd.to_datetime(events['end'], unit='s').dt.strftime('%Y-%m-%d %H:%M:%S'),
+                          'prediction': events['prediction'].astype('int64'),
+                          'prediction_str': classes[events['prediction'].to_numpy(dtype='int64')],
+                          'mean_confidence': events['mean_confidence'].round(4),
+                          'frames': events['frames'].astype('int64')},
+                         columns=event_columns)
+    with open(txt_path+'.part', 'w') as f:
+        f.write(f'# Events of the predictions smoothed with method = {method}, window = {window_seconds} s, '
+                f'gaps over {max_gap_seconds} s split events.\n\n')
+        table.to_csv(f, sep='\t', index=False)
+    os.replace(txt_path+'.part', txt_path)
+    return len(table)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Smooth classification stores and write their events tables.')
+    parser.add_argument('h5_paths', nargs='+', help='*_classifications.h5 stores')
+    parser.add_argument('--method', default='mean', choices=methods)
+    parser.add_argument('--window', type=float, default=60, help='window or half life in seconds')
+    parser.add_argument('--max-gap', type=float, default=30, help='gap in seconds that splits the smoothing and events')
+    args = parser.parse_args()
+
+    for h5_path in args.h5_paths:
+        txt_path = events_path(os.path.splitext(h5_path)[0]+'.txt')
+        event_num = export_events(h5_path, txt_path, args.method, args.window, args.max_gap)
+        print(f'{txt_path}: {event_num} events')
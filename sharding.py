@@ -0,0 +1,82 @@
+"""
+Split the (date, camera) work units of all_tasks.py across processes or hosts.
+Either deterministically with --shard i/N, or through a shared queue folder that workers claim units from with file locks.
+"""
+
+import fcntl
+import os
+import socket
+import zlib
+
+def parse_shard(shard):
+    """ Parse a shard string
+    Inputs:
+        shard: str. 'i/N' with 0 <= i < N. Example: '2/8'
+    Returns:
+        shard_index, shard_count: int, int
+    """
+    try:
+        shard_index, shard_count = (int(value) for value in shard.split('/'))
+    except ValueError:
+        raise ValueError(f'shard should look like i/N, got {shard}')
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f'shard index should be in [0, {shard_count}), got {shard}')
+    return shard_index, shard_count
+
+def shard_of(date_str, asi_name, shard_count):
+    """ Shard of a (date, camera) unit, the same on every host and python version
+    Inputs:
+        date_str: str. Example: '2011-08-08'
+        asi_name: str. Example: 'mcgr_themis11'
+        shard_count: int
+    Returns:
+        shard_index: int
+    """
+    return zlib.crc32(f'{date_str}/{asi_name}'.encode()) % shard_count
+
+def claim_unit(queue_folder_path, date_str, asi_name):
+    """ Try to claim a (date, camera) unit from the queue folder
+    The claim is an exclusive lock on a per-unit file, held until release_unit(). A worker that dies releases it,
+    so the unit goes back to the queue. Units released as done are never claimed again.
+    Inputs:
+        queue_folder_path: str. Folder shared by all workers
+        date_str: str. Example: '2011-08-08'
+        asi_name: str. Example: 'mcgr_themis11'
+    Returns:
+        claim: file object to pass to release_unit(), None if another worker holds or finished the unit
+    """
+    if not os.path.exists(queue_folder_path):
+        os.makedirs(queue_folder_path, exist_ok=True)
+
+    unit_path = os.path.join(queue_folder_path, f'{date_str}_{asi_name}')
+    if os.path.exists(unit_path+'.done'):
+        return None
+
+    claim = open(unit_path+'.lock', 'a+')
+    try:
+        fcntl.flock(claim.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        claim.close()
+        return None
+
+    # the unit may have been finished between the check and the lock
+    if os.path.exists(unit_path+'.done'):
+        fcntl.flock(claim.fileno(), fcntl.LOCK_UN)
+        claim.close()
+        return None
+
+    # record the owner for people looking at the queue folder
+    claim.seek(0)
+    claim.truncate()
+    claim.write(f'{socket.gethostname()} {os.getpid()}\n')
+    claim.flush()
+    return claim
+
+def release_unit(claim, done):
+    """ Release a unit claimed by claim_unit(), marking it done so no worker claims it again """
+    if done:
+        unit_path = claim.name[:-len('.lock')]
+        with open(unit_path+'.done', 'w') as f:
+            f.write(f'{socket.gethostname()} {os.getpid()}\n')
+    fcntl.flock(claim.fileno(), fcntl.LOCK_UN)
+    claim.close()
@@ -14,48 +14,107 @@ import subprocess
 import shutil
 import h5py
 import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from scipy.io import readsav
+from download_manager import themis_server, list_remote, fetch_folder, download_day, verify_day
+import frame_cache
+import instrumentation
 
-# timing decorator
-def _timeit(func):
-    def wrapper(*args, **kwargs):
-        tic = datetime.datetime.now()
-        result = func(*args, **kwargs)
-        toc = datetime.datetime.now()
-        logging.info(f'{func.__name__} took {toc-tic} seconds')
-        return result
-    return wrapper
-
-# helper function that decompress one folder
-def _decompress_pgm_files(folder_path, decompressed_folder_path):
-    logging.info('decompress start, hour = '+folder_path[-4:])
+# optional lz4 filter for the h5 files
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# number of frames buffered before they are appended to a h5 file
+_h5_block_frames = 64
+
+# frame axis of the h5 images dataset for each layout: (256, 256, N) or (N, 256, 256)
+_h5_frame_axis = {'time_last': 2, 'frame_major': 0}
+
+# helper function that reads one ut** folder into memory, with workers processes of themis_imager_readfile
+def _read_hour(folder_path, workers=1, cache_folder_path=None, max_cache_mb=frame_cache.max_cache_mb):
     # folder_path: str, should be ut** folder path
+    # cache_folder_path: str or None, folder of the decoded hours cache, the hour is memory-mapped from it when cached
 
     # get all compressed images absolute path in the folder, exclude hidden files and different shape files
     file_names = os.listdir(folder_path)
-    file_names = [folder_path+'/'+f for f in file_names if 'full' in f and not f.startswith('.')]
+    file_names = sorted([folder_path+'/'+f for f in file_names if 'full' in f and not f.startswith('.')])
+
+    with instrumentation.span('decode', **instrumentation.path_labels(folder_path)) as record:
+        if cache_folder_path is not None:
+            key = frame_cache.hour_key(file_names)
+            img, image_names = frame_cache.load_hour(cache_folder_path, key)
+            if img is not None:
+                logging.info(f'{folder_path} read from the frame cache')
+                record.update(frames=len(image_names), cached=True)
+                return img, image_names
 
-    # read the images using themis_imager_readfile - input is the list of absolute paths to compressed images
-    img, meta, problematic_files = themis_imager_readfile.read(file_names)
-    frame_num = img.shape[2]
+        # read the images using themis_imager_readfile - input is the list of absolute paths to compressed images
+        img, meta, problematic_files = themis_imager_readfile.read(file_names, workers=workers)
+        record.update(frames=img.shape[2], bytes_read=sum(os.path.getsize(f) for f in file_names))
 
-    for frame in range(frame_num):
+    # image names example: ['atha20200104000206', ...], one per frame
+    image_names = []
+    for frame in range(img.shape[2]):
         # '2020-01-04 00:02:06.053611 UTC'
         strtime = meta[frame]['Image request start']
         # 'datetime.datetime(2020, 1, 4, 0, 2, 6, 53611)'
         dt = datetime.datetime.strptime(strtime, "%Y-%m-%d %H:%M:%S.%f %Z")
         # '20200104000206'
         dt = dt.strftime('%Y%m%d%H%M%S')
-        temp_file_name = meta[frame]['Site unique ID']+dt+'.pgm'
-        temp_path = os.path.join(decompressed_folder_path, temp_file_name)
-        cv2.imwrite(temp_path, img[:, :, frame])
+        image_names.append(meta[frame]['Site unique ID']+dt)
+
+    if cache_folder_path is not None:
+        frame_cache.store_hour(cache_folder_path, key, folder_path, img, image_names, max_cache_mb)
+    return img, image_names
+
+# helper function that writes in-memory frames as pgm files
+def _write_pgm_files(img, image_names, decompressed_folder_path):
+    with instrumentation.span('write pgm', **instrumentation.name_labels(image_names)) as record:
+        for frame, image_name in enumerate(image_names):
+            temp_path = os.path.join(decompressed_folder_path, image_name+'.pgm')
+            cv2.imwrite(temp_path, img[:, :, frame])
+            record['bytes_written'] += os.path.getsize(temp_path)
+        record['frames'] = len(image_names)
+
+# helper function that decompress one folder, then marks the hour done in the decompressed folder
+def _decompress_pgm_files(folder_path, decompressed_folder_path, workers=1, cache_folder_path=None,
+                          max_cache_mb=frame_cache.max_cache_mb):
+    logging.info('decompress start, hour = '+folder_path[-4:])
+    # folder_path: str, should be ut** folder path
+
+    img, image_names = _read_hour(folder_path, workers, cache_folder_path, max_cache_mb)
+    _write_pgm_files(img, image_names, decompressed_folder_path)
+
+    # the marker is written last, so an interrupted hour is decompressed again
+    _mark_hour_done(folder_path, decompressed_folder_path, len(image_names))
 
     logging.info(folder_path[-4:]+ ' decompress done')
-    return 
+    return len(image_names)
+
+# hidden marker of a decompressed hour. Example: './images/gako/2020-01-31-decompressed/.ut05.done'
+def _hour_marker_path(folder_path, decompressed_folder_path):
+    return os.path.join(decompressed_folder_path, '.'+os.path.basename(os.path.normpath(folder_path))+'.done')
+
+# write the marker of a decompressed hour with its number of frames
+def _mark_hour_done(folder_path, decompressed_folder_path, frame_num):
+    with open(_hour_marker_path(folder_path, decompressed_folder_path), 'w') as f:
+        f.write(f'{frame_num}\n')
+
+# read a pgm image from disk, or convert an in-memory frame the same way cv2.imread would
+def _load_image(image, flags=0):
+    if isinstance(image, str):
+        return cv2.imread(image, flags)
+    # cv2.imread with flag 0 keeps the high byte of 16 bit images
+    if flags == 0 and image.dtype == numpy.uint16:
+        return (image >> 8).astype(numpy.uint8)
+    return image
 
 # bytescale function from UCalgary
 def _bytescale(image_path, cmin=None, cmax=None, high=65535, low=0):
-    image = cv2.imread(image_path, 0)
+    image = _load_image(image_path, 0)
 
     if high > 65535:
         raise ValueError("`high` should be less than or equal to 65535.")
@@ -85,22 +144,22 @@ def _bytescale(image_path, cmin=None, cmax=None, high=65535, low=0):
 
 # equalize histogram
 def _eqhist(image_path):
-    image = cv2.imread(image_path, 0)
+    image = _load_image(image_path, 0)
     image = cv2.equalizeHist(image)  # equalize histogram
     image = numpy.uint8(image)
     return image
 
 # contrast limited adaptive histogram equalization
 def _clahe(image_path):
-    image = cv2.imread(image_path, 0)
-    clahe = cv2.createCLAHE(clipLimit=30)
+    image = _load_image(image_path, 0)
+    clahe = _thread_clahe(30)
     image = clahe.apply(image)
     return image
 
 # contrast limited adaptive histogram equalization on 16 bit image first then downscale the result to 8 bit
 def _clahe16bit(image_path):
-    image = cv2.imread(image_path, -1)
-    clahe = cv2.createCLAHE(clipLimit=3, tileGridSize=(8,8))
+    image = _load_image(image_path, -1)
+    clahe = _thread_clahe(3)
     image = clahe.apply(image)
     image_8bit = cv2.convertScaleAbs(image, alpha=(255.0/65535.0))
     return image_8bit
@@ -110,7 +169,7 @@ def _relu(image_path, low = 0, pivot=0.02, ratio=1.7):
     def _relu_help(data, pivot=pivot, low=low, ratio=ratio):
         return numpy.maximum(data+low, ratio*(data-pivot)+low)
 
-    image = cv2.imread(image_path, 0)
+    image = _load_image(image_path, 0)
     image = _relu_help(image)
     image = image.clip(low, 255).astype(numpy.uint8)
 
@@ -118,11 +177,12 @@ def _relu(image_path, low = 0, pivot=0.02, ratio=1.7):
 
 # read the image without edit
 def _read_img(image_path):
-    image = cv2.imread(image_path, 0)
+    image = _load_image(image_path, 0)
     return image
 
-@_timeit
-def download_themis_images(date, asi, folder_path='./images',force=0, skymap=1):
+@instrumentation.timed
+def download_themis_images(date, asi, folder_path='./images',force=0, skymap=1, skymap_folder_path='./skymaps',
+                           server=themis_server, max_transfers=4):
     """ Download images from UCalgary
     Inputs: 
         date: datetime object. Example: datetime.datetime(2020, 3, 19, 0, 0)
@@ -130,6 +190,9 @@ def download_themis_images(date, asi, folder_path='./images',force=0, skymap=1):
         folder_path: str. Folder to store the downloaded images
         force: Bool. 0-check if downloaded first, 1-delete existing date and redownload
         skymap: Bool. 0-not download skymap, 1-download skymap
+        skymap_folder_path: str. Folder caching the skymap listing and .sav files, so each skymap is downloaded once
+        server: str. rsync:// url of the THEMIS asi data, or a local folder with the same layout
+        max_transfers: int. Number of hour folders downloaded at once
     Returns:
         decompressed_folder_path: str. Example: './images/gako/2020-01-31-decompressed'
     """
@@ -139,11 +202,15 @@ def download_themis_images(date, asi, folder_path='./images',force=0, skymap=1):
     date_string = date.strftime('%Y-%m-%d')
     full_path = folder_path+'/'+asi+'/'+date_string
     if not os.path.exists(full_path):
-        os.makedirs(full_path)
-    # if path exists and not forcing, return path
+        # another download of the same day may create it first
+        os.makedirs(full_path, exist_ok=True)
+    # if the day is complete and not forcing, return path. A partial day is resumed
     elif force == 0:
-        logging.info(f'Already downloaded at {full_path}.')
-        return full_path
+        complete, missing_hours = verify_day(full_path)
+        if complete:
+            logging.info(f'Already downloaded at {full_path}.')
+            return full_path
+        logging.info(f'Resuming the download at {full_path}, missing hours = {missing_hours}')
     # if path exists and forcing, delete everything in the folder
     elif force == 1:
         try: 
@@ -153,64 +220,125 @@ def download_themis_images(date, asi, folder_path='./images',force=0, skymap=1):
             logging.critical(f'folder cannot be removed at {full_path}')
             logging.critical('Exception: {}'.format(e))
 
-    # dir_url - destination directory url
-    date_string_url = date.strftime('%Y/%m/%d/')
-    themis_url = 'data.phys.ucalgary.ca/data/sort_by_project/THEMIS/asi/stream0/'
-    dir_url = themis_url + date_string_url + asi + '*/'
-
     # Download skymap
     if skymap:
-        logging.info('Downloading skymap')
-        skymap_url = 'data.phys.ucalgary.ca/data/sort_by_project/THEMIS/asi/skymaps/' + asi + '/'
+        download_skymap(date, asi, full_path, skymap_folder_path, server)
 
-        # find skymap dirs online
-        try:
-            skymap_dirs = subprocess.check_output(['rsync',
-                                                'rsync://' + skymap_url]).splitlines()
-            skymap_dirs = [str(d.split(b' ')[-1], 'UTF-8')
-                        for d in skymap_dirs[1:]]
-        except Exception as e:
-            logging.critical('Unable to access skymap server: {}. '
-                            'Server may be down. Stopping.'.format(skymap_url))
-            logging.critical('Exception: {}'.format(e))
-            raise
+    # Download images, one hour folder per transfer
+    logging.info('Downloading images from {}...'.format(server))
+    try:
+        manifest = download_day(date, asi, full_path, server=server, max_transfers=max_transfers)
+    except Exception as e:
+        logging.critical('Unable to download images:{} {}.'.format(asi, date_string))
+        logging.critical('Exception: {}'.format(e))
+        raise
+    if not manifest['complete']:
+        missing_hours = sorted(set(manifest['hours']) - set(manifest['complete_hours']))
+        logging.critical(f'Incomplete download at {full_path}, missing hours = {missing_hours}')
+        raise RuntimeError(f'incomplete download at {full_path}, missing hours = {missing_hours}')
+    logging.info('Successfully downloaded at {}.'.format(full_path))
 
-        # Convert to datetimes
-        skymap_dates = [d.split('_')[1] for d in skymap_dirs]
-        skymap_dates = [datetime.datetime.strptime(d, '%Y%m%d') for d in skymap_dates]
-        time_diffs = numpy.array([(date - d).total_seconds() for d in skymap_dates])
-        skymap_dir = skymap_dirs[numpy.where(time_diffs > 0, time_diffs, numpy.inf).argmin()]
+    return full_path
 
-        skymap_url = skymap_url + skymap_dir + '/'
-        try:
-            subprocess.run(['rsync', '-vzrt', 'rsync://' + skymap_url + '*.sav',
-                            full_path], stdout=subprocess.DEVNULL)
-            logging.info('Successfully downloaded skymap.'
-                        ' It is saved at {}.'.format(full_path))
-        except Exception as e:
-            logging.critical(
-                'Unable to download skymap:{}. Stopping.'.format(skymap_url))
-            logging.critical('Exception: {}'.format(e))
-            raise
+def download_skymap(date, asi, full_path, skymap_folder_path='./skymaps', server=themis_server):
+    """ Download the skymap of a camera day into the skymap folder once and copy its .sav files to the day folder
+    Inputs:
+        date: datetime object. Example: datetime.datetime(2020, 3, 19, 0, 0)
+        asi: str. Example: 'gako'
+        full_path: str. Day folder receiving the .sav files. Example: './images/gako/2020-03-19'
+        skymap_folder_path: str. Folder caching the skymap listing and .sav files
+        server: str. rsync:// url of the THEMIS asi data, or a local folder with the same layout
+    Returns:
+        skymap_dir_path: str. Example: './skymaps/gako/gako_20190312'
+    """
+    logging.info('Downloading skymap')
+    skymap_url = server + 'skymaps/' + asi + '/'
 
-    # Download images
-    logging.info('Downloading images from {}...'.format(dir_url))
+    # find skymap dirs online
     try:
-        subprocess.run(['rsync', '-vzrt', '--size-only', '--ignore-existing', 'rsync://' + dir_url,
-                        full_path], stdout=subprocess.DEVNULL)
-        logging.info('Successfully downloaded at {}.'.format(folder_path))
+        skymap_dirs = _list_skymap_dirs(asi, skymap_url, skymap_folder_path)
     except Exception as e:
-        logging.critical('Unable to download images:{}.'.format(dir_url))
+        logging.critical('Unable to access skymap server: {}. '
+                        'Server may be down. Stopping.'.format(skymap_url))
         logging.critical('Exception: {}'.format(e))
         raise
 
-    return full_path
+    # Convert to datetimes
+    skymap_dates = [d.split('_')[1] for d in skymap_dirs]
+    skymap_dates = [datetime.datetime.strptime(d, '%Y%m%d') for d in skymap_dates]
+    time_diffs = numpy.array([(date - d).total_seconds() for d in skymap_dates])
+    skymap_dir = skymap_dirs[numpy.where(time_diffs > 0, time_diffs, numpy.inf).argmin()]
+
+    skymap_url = skymap_url + skymap_dir + '/'
+    try:
+        # the .sav files are kept in the skymap folder, rsync skips them once they are there
+        skymap_dir_path = os.path.join(skymap_folder_path, asi, skymap_dir)
+        os.makedirs(skymap_dir_path, exist_ok=True)
+        os.makedirs(full_path, exist_ok=True)
+        fetch_folder(skymap_url, skymap_dir_path, '*.sav')
+        for file_name in os.listdir(skymap_dir_path):
+            if file_name.endswith('.sav'):
+                shutil.copy2(os.path.join(skymap_dir_path, file_name), full_path)
+        logging.info('Successfully downloaded skymap.'
+                    ' It is saved at {}.'.format(full_path))
+    except Exception as e:
+        logging.critical(
+            'Unable to download skymap:{}. Stopping.'.format(skymap_url))
+        logging.critical('Exception: {}'.format(e))
+        raise
+    return skymap_dir_path
+
+# skymap folders of a site on the server, the rsync listing is cached in the skymap folder for max_age_seconds
+def _list_skymap_dirs(asi, skymap_url, skymap_folder_path, max_age_seconds=86400):
+    listing_path = os.path.join(skymap_folder_path, f'{asi}_skymap_dirs.txt')
+    if os.path.exists(listing_path) and \
+            datetime.datetime.now().timestamp() - os.path.getmtime(listing_path) < max_age_seconds:
+        with open(listing_path) as f:
+            return f.read().split()
+
+    skymap_dirs = [path for path, size, is_dir in list_remote(skymap_url) if is_dir]
+
+    if not os.path.exists(skymap_folder_path):
+        os.makedirs(skymap_folder_path, exist_ok=True)
+    # written under a temporary name so a concurrent download never reads a truncated listing
+    part_path = listing_path+f'.{os.getpid()}.{threading.get_ident()}.part'
+    with open(part_path, 'w') as f:
+        f.write('\n'.join(skymap_dirs))
+    os.replace(part_path, listing_path)
+    return skymap_dirs
+
+# list the hour folders and the skymap file downloaded by download_themis_images()
+def _list_hours_and_skymap(img_folder_path):
+    # store the paths of the hour folder
+    hours = []
+    skymap_path = None
+
+    # Iterate over the child folders in the outer folder
+    for folder_name in sorted(os.listdir(img_folder_path)):
+        if folder_name.startswith('.'):
+            continue
+        if folder_name.endswith('.sav'):
+            skymap_path = os.path.join(img_folder_path, folder_name)
+            continue
+        # check if it is a sub folder
+        folder_path = os.path.join(img_folder_path, folder_name)
+        if os.path.isdir(folder_path):
+            hours.append(folder_path)
 
-@_timeit
-def list_and_decompress_pgm_files(img_folder_path):
+    return hours, skymap_path
+
+@instrumentation.timed
+def list_and_decompress_pgm_files(img_folder_path, processes=1, workers=1, cache_folder_path=None,
+                                  max_cache_mb=frame_cache.max_cache_mb):
     """ Decompress the images downloaded by the download_themis_images() function
+    Hours are decompressed in parallel and marked done one by one, so an interrupted run only redoes the unfinished hours.
     Inputs: 
         img_folder_path: str. Example: './images/gako/2020-01-31'
+        processes: int. Number of hours decompressed at once. Above 1 the hours go to spawned worker processes, so the
+            calling script has to run under an `if __name__ == '__main__':` guard
+        workers: int. Number of themis_imager_readfile processes reading each hour
+        cache_folder_path: str or None. Folder of the decoded hours cache. Example: './frame_cache'. Cached hours are memory-mapped instead of decompressed
+        max_cache_mb: int. Size limit of the cache, the least recently used hours are evicted above it
     Returns:
         decompressed_folder_path: str. Example: './images/gako/2020-01-31-decompressed'
     """
@@ -220,231 +348,869 @@ def list_and_decompress_pgm_files(img_folder_path):
     parent_folder_path = os.path.dirname(img_folder_path)
     current_folder_name = os.path.basename(img_folder_path)
     decompressed_folder_path = os.path.join(parent_folder_path, current_folder_name+'-decompressed')
-    if os.path.isdir(decompressed_folder_path):
+
+    # only the hours without a marker are decompressed
+    hours, skymap_path = _list_hours_and_skymap(img_folder_path)
+    pending = [hour for hour in hours if not os.path.exists(_hour_marker_path(hour, decompressed_folder_path))]
+    if os.path.isdir(decompressed_folder_path) and not pending:
         logging.info('Already decompressed at '+ decompressed_folder_path)
         return decompressed_folder_path
 
     os.makedirs(decompressed_folder_path, exist_ok=True)
-    logging.info('Decompressed folder created')
+    logging.info(f'Decompressed folder created, {len(pending)} of {len(hours)} hours to decompress')
 
-    # store the paths of the hour folder
-    hours = []
+    # if there is a skymap, copy it to the decompressed folder
+    if skymap_path is not None:
+        shutil.copy(skymap_path, decompressed_folder_path)
 
-    # Iterate over the child folders in the outer folder
-    for folder_name in os.listdir(img_folder_path):
-        # if it is the skymap, move it to the decompressed folder
-        if folder_name.endswith('.sav') and not folder_name.startswith('.'):
-            skymap_path = os.path.join(img_folder_path, folder_name)
-            shutil.copy(skymap_path, decompressed_folder_path)
-            continue
-        # check if it is a sub folder
-        folder_path = os.path.join(img_folder_path, folder_name)
-        if os.path.isdir(folder_path):
-            hours.append(folder_path)
-
-    for hour in hours:
-        _decompress_pgm_files(hour, decompressed_folder_path)
+    processes = max(1, min(processes, len(pending)))
+    if processes == 1:
+        for hour in pending:
+            _decompress_pgm_files(hour, decompressed_folder_path, workers, cache_folder_path, max_cache_mb)
+    else:
+        # spawn workers are not daemonic, so themis_imager_readfile can start its own pool inside them
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(_decompress_pgm_files, hour, decompressed_folder_path, workers, cache_folder_path,
+                                       max_cache_mb) for hour in pending]
+            for future in futures:
+                future.result()
 
     logging.info('list_and_decompress done')
     return decompressed_folder_path
 
-@_timeit
-def pgm_images_to_mp4(decompressed_folder_path, video_folder_path='./videos', file_suffix='video.mp4', method='None', processes=8):
-    """ Process and stitch decompressed pgm images to form video
+@instrumentation.timed
+def list_and_decompress_images(img_folder_path, pgm_cache=0, workers=1, cache_folder_path=None,
+                               max_cache_mb=frame_cache.max_cache_mb):
+    """ Decompress the images downloaded by the download_themis_images() function into memory
     Inputs: 
-        decompressed_folder_path: str. Example: './images/gako/2020-01-31-decompressed'
-        video_folder_path: str. Folder path to store videos
-        file_suffix: str. Suffix of the created file. Use it to distinguish videos using different processing skills.
-        method: str. Options: 'bytescale', 'eqhist', 'relu', 'clahe'. Default to not processing the images
-        processes: int. Number of processes called in multiprocessing.
+        img_folder_path: str. Example: './images/gako/2020-01-31'
+        pgm_cache: Bool. 0-keep the images in memory only, 1-also write the pgm files to the '-decompressed' folder
+        workers: int. Number of themis_imager_readfile processes reading each hour
+        cache_folder_path: str or None. Folder of the decoded hours cache. Example: './frame_cache'. Cached hours are memory-mapped instead of decompressed
+        max_cache_mb: int. Size limit of the cache, the least recently used hours are evicted above it
     Returns:
-        video_path: str. Example: './videos/gako20161013clahe.mp4'
+        images: numpy.ndarray. uint16 frames of shape (256, 256, N), sorted in time
+        image_names: list of str. Example: ['gako20200131000003', ...], one per frame
+        skymap_path: str or None. Example: './images/gako/2020-01-31/themis_skymap_gako_20190920-+_v02.sav'
     """
-    logging.info('video convertion start')
+    logging.info(f'list_and_decompress_images start for {img_folder_path}, pgm_cache = {pgm_cache}')
 
-    # create video_folder if not exists
-    if not os.path.exists(video_folder_path):
-            os.makedirs(video_folder_path)
+    hours, skymap_path = _list_hours_and_skymap(img_folder_path)
 
-    # Initialize a list to store the paths to the decompressed pgm files
+    # read every hour into memory
+    hour_images = []
+    image_names = []
+    hour_frames = []
+    for hour in hours:
+        img, hour_image_names = _read_hour(hour, workers, cache_folder_path, max_cache_mb)
+        hour_images.append(img)
+        image_names.extend(hour_image_names)
+        hour_frames.append(len(hour_image_names))
+    images = numpy.concatenate(hour_images, axis=-1) if hour_images else numpy.empty((256, 256, 0), dtype=numpy.uint16)
+
+    # sort the frames in time
+    order = numpy.argsort(image_names, kind='stable')
+    images = images[:, :, order]
+    image_names = [image_names[i] for i in order]
+
+    # optionally keep the on-disk pgm cache used by pgm_images_to_mp4() and pgm_images_to_h5()
+    if pgm_cache:
+        parent_folder_path = os.path.dirname(img_folder_path)
+        current_folder_name = os.path.basename(img_folder_path)
+        decompressed_folder_path = os.path.join(parent_folder_path, current_folder_name+'-decompressed')
+        os.makedirs(decompressed_folder_path, exist_ok=True)
+        if skymap_path is not None:
+            shutil.copy(skymap_path, decompressed_folder_path)
+        _write_pgm_files(images, image_names, decompressed_folder_path)
+        for hour, frame_num in zip(hours, hour_frames):
+            _mark_hour_done(hour, decompressed_folder_path, frame_num)
+        logging.info(f'pgm cache written at {decompressed_folder_path}')
+
+    logging.info(f'list_and_decompress_images done, {len(image_names)} frames')
+    return images, image_names, skymap_path
+
+@instrumentation.timed
+def decompress_to_cache(img_folder_path, cache_folder_path, workers=1, max_cache_mb=frame_cache.max_cache_mb):
+    """ Decompress the images downloaded by the download_themis_images() function into the frame cache only, one hour
+    at a time and without pgm files, so list_and_decompress_images() later memory-maps them
+    Inputs:
+        img_folder_path: str. Example: './images/gako/2020-01-31'
+        cache_folder_path: str. Folder of the decoded hours cache. Example: './frame_cache'
+        workers: int. Number of themis_imager_readfile processes reading each hour
+        max_cache_mb: int. Size limit of the cache, the least recently used hours are evicted above it
+    Returns:
+        hour_num: int. Number of ut** folders
+        frame_num: int. Number of frames of the day
+        cached_bytes: int. Size of the decoded frames
+    """
+    hours, skymap_path = _list_hours_and_skymap(img_folder_path)
+    frame_num, cached_bytes = 0, 0
+    for hour in hours:
+        img, image_names = _read_hour(hour, workers, cache_folder_path, max_cache_mb)
+        frame_num += len(image_names)
+        cached_bytes += img.nbytes
+        del img
+    logging.info(f'decompress_to_cache done for {img_folder_path}, {frame_num} frames')
+    return len(hours), frame_num, cached_bytes
+
+# list the decompressed pgm files and the skymap file, sorted in time
+def _list_pgm_files(decompressed_folder_path):
     pgm_file_paths = []
+    skymap_path = None
     for file_name in os.listdir(decompressed_folder_path):
-        if not file_name.startswith('.') and file_name.endswith('.pgm'):
-            pgm_file_paths.append(os.path.join(
-                decompressed_folder_path, file_name))
+        if not file_name.startswith('.'):
+            if file_name.endswith('.pgm'):
+                pgm_file_paths.append(os.path.join(decompressed_folder_path, file_name))
+            elif file_name.endswith('.sav'):
+                skymap_path = os.path.join(decompressed_folder_path, file_name)
 
     # Sort the list of pgm files -- needed as we decompressed using multithreading
     pgm_file_paths.sort()
+    return pgm_file_paths, skymap_path
 
-    with multiprocessing.Pool(processes=processes) as pool:
-        # process all images using the pool of worker processes
-        if method == 'bytescale':
-            processed_images = pool.map(_bytescale, pgm_file_paths)
-        elif method == 'eqhist':
-            processed_images = pool.map(_eqhist, pgm_file_paths)
-        elif method == 'relu':
-            processed_images = pool.map(_relu, pgm_file_paths)
-        elif method == 'clahe':
-            processed_images = pool.map(_clahe, pgm_file_paths)
-        elif method =='clahe16':
-            processed_images = pool.map(_clahe16bit, pgm_file_paths)
-        elif method == 'None':
-            processed_images = pool.map(_read_img, pgm_file_paths)
+# methods of process_stack(), the per-frame functions above give the same frames except for bytescale, which now sees the 16 bit data
+_stack_methods = ['None', 'bytescale', 'eqhist', 'relu', 'clahe', 'clahe16', 'clahe_temporal']
+
+# 65536-entry lookup tables from uint16 to uint8, built once per parameter set
+_luts = {}
+
+# CLAHE objects of each thread, cv2 CLAHE objects are not thread safe
+_thread_state = threading.local()
+
+# lookup table keeping the high byte, the same as cv2.imread with flag 0
+def _shift_lut():
+    if 'shift' not in _luts:
+        _luts['shift'] = (numpy.arange(65536) >> 8).astype(numpy.uint8)
+    return _luts['shift']
+
+# lookup table of _relu() applied to the high byte
+def _relu_lut(low=0, pivot=0.02, ratio=1.7):
+    key = ('relu', low, pivot, ratio)
+    if key not in _luts:
+        data = _shift_lut()
+        _luts[key] = numpy.maximum(data+low, ratio*(data-pivot)+low).clip(low, 255).astype(numpy.uint8)
+    return _luts[key]
+
+# lookup table of _bytescale() on 16 bit data with a fixed cmin and cmax
+def _bytescale_lut(cmin, cmax, high=65535, low=0):
+    key = ('bytescale', cmin, cmax, high, low)
+    if key not in _luts:
+        _luts[key] = _bytescale_values(numpy.arange(65536, dtype=numpy.float32), cmin, cmax, high, low)
+    return _luts[key]
+
+# _bytescale() arithmetic, cmin and cmax can be arrays broadcasting against data
+def _bytescale_values(data, cmin, cmax, high=65535, low=0):
+    if high > 65535:
+        raise ValueError("`high` should be less than or equal to 65535.")
+    if low < 0:
+        raise ValueError("`low` should be greater than or equal to 0.")
+    if high < low:
+        raise ValueError(
+            "`high` should be greater than or equal to `low`.")
+
+    cscale = numpy.asarray(cmax, dtype=numpy.float32) - numpy.asarray(cmin, dtype=numpy.float32)
+    if numpy.any(cscale < 0):
+        raise ValueError("`cmax` should be larger than `cmin`.")
+    cscale = numpy.where(cscale == 0, 1, cscale)
+
+    scale = numpy.float32(high - low) / cscale
+    bytedata = (data - cmin) * scale + low
+    im_scaled = (bytedata.clip(low, high) + 0.5).astype(numpy.uint16)
+    return (im_scaled // 256).astype(numpy.uint8)
+
+# CLAHE object of the calling thread
+def _thread_clahe(clip_limit, tile_grid_size=(8, 8)):
+    key = (clip_limit, tile_grid_size)
+    clahes = getattr(_thread_state, 'clahes', None)
+    if clahes is None:
+        clahes = _thread_state.clahes = {}
+    if key not in clahes:
+        clahes[key] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+    return clahes[key]
+
+# methods computed pixel by pixel, their threads split the stack by rows so each thread writes its own memory
+_pixel_methods = ['None', 'relu', 'bytescale']
+
+# rows looked up at once, numpy.take makes an index array 4 times the size of the uint16 rows
+_lut_rows = 8
+
+# process rows [start, stop) of a stack into out with a pixel method
+def _process_rows(images, out, method, start, stop, cmin, cmax):
+    if method == 'bytescale' and not numpy.isscalar(cmin):
+        lut = None
+    elif method == 'bytescale':
+        lut = _bytescale_lut(cmin, cmax)
+    elif method == 'relu':
+        lut = _relu_lut()
+    else:
+        lut = _shift_lut()
+    for row in range(start, stop, _lut_rows):
+        rows = slice(row, min(row + _lut_rows, stop))
+        if lut is None:
+            # per-frame min and max in 16 bit, the same as _bytescale() without cmin and cmax
+            out[rows] = _bytescale_values(images[rows].astype(numpy.float32), cmin, cmax)
         else:
-            logging.critical(
-                'method not available, using non-processed images.')
-            processed_images = pool.map(_read_img, pgm_file_paths)
+            # numpy.take releases the GIL
+            numpy.take(lut, images[rows], out=out[rows])
+
+# process frames [start, stop) of a stack into out with an OpenCV method
+def _process_frames(images, out, method, start, stop, cmin, cmax):
+    for frame in range(start, stop):
+        if method == 'clahe16':
+            image = numpy.ascontiguousarray(images[:, :, frame])
+            out[:, :, frame] = cv2.convertScaleAbs(_thread_clahe(3).apply(image), alpha=(255.0/65535.0))
+            continue
+        # the high byte, the same as cv2.imread with flag 0
+        image = (images[:, :, frame] >> 8).astype(numpy.uint8)
+        if method == 'eqhist':
+            out[:, :, frame] = cv2.equalizeHist(image)
+        elif method == 'clahe':
+            out[:, :, frame] = _thread_clahe(30).apply(image)
+
+# temporal CLAHE settings: the clip limit of 'clahe', an 8x8 tile grid and the number of frames whose clipped tile
+# histograms are averaged by default, 7 frames is 21 s at the 3 s cadence, and the number of frames whose histograms
+# are built at once
+_temporal_clip_limit = 30
+_temporal_grid = 8
+_temporal_window = 7
+_temporal_block_frames = 64
+
+# lookup table indexes and weights of the 4 nearest tiles of each pixel, as OpenCV CLAHE: the tile position of
+# pixel x is x/tile - 0.5, its weights are float32 and the tiles outside the grid are clamped to the border ones.
+# The indexes point into the flat (grid*grid*256) tables of a frame, the pixel value is added to them
+def _tile_coordinates(grid=_temporal_grid, size=256):
+    key = ('tiles', grid, size)
+    if key not in _luts:
+        position = numpy.arange(size, dtype=numpy.float32) * numpy.float32(1.0 / (size // grid)) - numpy.float32(0.5)
+        first = numpy.floor(position).astype(numpy.intp)
+        weight = (position - first).astype(numpy.float32)
+        tiles = numpy.clip(first, 0, grid-1), numpy.clip(first+1, 0, grid-1)
+        # row tiles are (size, 1) and column tiles (1, size), so the 4 indexes broadcast to (size, size)
+        indexes = [((row[:, None] * grid + column[None, :]) * 256).astype(numpy.intp) for row in tiles for column in tiles]
+        _luts[key] = (indexes, weight[None, :], 1 - weight[None, :], weight[:, None], 1 - weight[:, None])
+    return _luts[key]
+
+# clipped tile histograms of uint8 frames (n, 256, 256) as int32 (n, grid, grid, 256). As OpenCV CLAHE, the limit is
+# an integer number of pixels, the excess is spread evenly over all the bins and its remainder one pixel per bin at
+# a regular step from the first bin
+def _tile_histograms(frames, clip_limit=_temporal_clip_limit, grid=_temporal_grid):
+    n, height, width = frames.shape
+    tile = height // grid
+    key = ('bins', grid, height, width)
+    if key not in _luts:
+        _luts[key] = (((numpy.arange(height) // tile)[:, None] * grid + (numpy.arange(width) // tile)[None, :]) * 256).astype(numpy.intp)
+    hists = numpy.empty((n, grid * grid * 256), dtype=numpy.int32)
+    for frame in range(n):
+        hists[frame] = numpy.bincount((_luts[key] + frames[frame]).ravel(), minlength=grid * grid * 256)
+    hists = hists.reshape(n, grid, grid, 256)
+
+    limit = max(int(clip_limit * tile * tile / 256), 1)
+    excess = numpy.maximum(hists - limit, 0).sum(axis=-1, keepdims=True)
+    hists = numpy.minimum(hists, limit) + excess // 256
+    residual = excess % 256
+    step = numpy.maximum(256 // numpy.maximum(residual, 1), 1)
+    bins = numpy.arange(256)
+    hists += ((bins % step == 0) & (bins // step < residual)).astype(numpy.int32)
+    return hists
+
+def clahe_temporal_stack(frames, out=None, window=_temporal_window, history=None):
+    """ CLAHE of a sequence of frames with the clipped tile histograms averaged over the last window frames
+    Consecutive frames 3 s apart are nearly identical, so averaging their histograms reduces the flicker of frame by frame CLAHE.
+    Inputs:
+        frames: numpy.ndarray. uint8 frames of shape (n, 256, 256), in time order
+        out: numpy.ndarray or None. Preallocated uint8 output of shape (n, 256, 256)
+        window: int. Number of frames averaged, 1 gives the same frames as OpenCV CLAHE with the 'clahe' settings
+        history: dict or None. Carries the histograms of the previous frames between calls on consecutive blocks
+    Returns:
+        out: numpy.ndarray. uint8 frames of shape (n, 256, 256)
+    """
+    n, height, width = frames.shape
+    if out is None:
+        out = numpy.empty(frames.shape, dtype=numpy.uint8)
+    if history is None:
+        history = {}
+    tile = height // _temporal_grid
+
+    # trailing mean of the clipped histograms, the first frames of a sequence average what they have
+    hists = _tile_histograms(frames)
+    previous = history.get('hists', hists[:0])
+    sequence = numpy.concatenate([previous, hists])
+    cumulative = numpy.concatenate([numpy.zeros((1,)+hists.shape[1:], dtype=numpy.float64),
+                                    numpy.cumsum(sequence, axis=0, dtype=numpy.float64)])
+    ends = numpy.arange(len(previous)+1, len(sequence)+1)
+    starts = numpy.maximum(ends - window, 0)
+    smoothed = (cumulative[ends] - cumulative[starts]) / (ends - starts)[:, None, None, None]
+    history['hists'] = sequence[max(len(sequence)-(window-1), 0):]
+
+    # tile lookup tables from the cumulative histograms rounded to the nearest level, flat per frame
+    luts = numpy.rint(numpy.cumsum(smoothed, axis=-1) * (255.0 / (tile * tile)))
+    luts = numpy.clip(luts, 0, 255).astype(numpy.float32).reshape(n, -1)
+
+    # bilinear interpolation between the lookup tables of the 4 nearest tiles, in float32 as OpenCV
+    (index11, index12, index21, index22), x_weight, x_weight1, y_weight, y_weight1 = _tile_coordinates(_temporal_grid, height)
+    values = numpy.empty((height, width), dtype=numpy.intp)
+    index = numpy.empty((height, width), dtype=numpy.intp)
+    top, bottom, level = (numpy.empty((height, width), dtype=numpy.float32) for _ in range(3))
+    for frame in range(n):
+        lut = luts[frame]
+        values[...] = frames[frame]
+        for row, (left, right) in [(top, (index11, index12)), (bottom, (index21, index22))]:
+            numpy.add(left, values, out=index)
+            numpy.multiply(lut.take(index), x_weight1, out=row)
+            numpy.add(right, values, out=index)
+            numpy.multiply(lut.take(index), x_weight, out=level)
+            row += level
+        top *= y_weight1
+        bottom *= y_weight
+        top += bottom
+        # the levels are within 0..255, rint rounds half to even as OpenCV
+        out[frame] = numpy.rint(top, out=top)
+    return out
+
+def process_stack(images, method='None', threads=8, out=None, cmin=None, cmax=None, executor=None, history=None,
+                  window=_temporal_window):
+    """ Process a whole uint16 image stack in this process, with lookup tables and threads instead of pickled frames
+    Inputs:
+        images: numpy.ndarray. uint16 frames of shape (256, 256, N) from list_and_decompress_images()
+        method: str. Options: 'bytescale', 'eqhist', 'relu', 'clahe', 'clahe16', 'clahe_temporal'. Default to not processing the images
+        threads: int. Number of threads, OpenCV and numpy release the GIL while they work
+        out: numpy.ndarray or None. Preallocated uint8 output of the same shape
+        cmin, cmax: int or None. Fixed bytescale range in 16 bit counts, one lookup table is used when both are set
+        executor: ThreadPoolExecutor or None. Thread pool reused across calls, a new one is made when None
+        history: dict or None. State of 'clahe_temporal' carried between calls on consecutive blocks of a sequence
+        window: int. Number of frames whose histograms 'clahe_temporal' averages, 1 is plain CLAHE
+    Returns:
+        out: numpy.ndarray. uint8 frames of shape (256, 256, N)
+    """
+    if method not in _stack_methods:
+        logging.critical(
+            'method not available, using non-processed images.')
+        method = 'None'
+    if out is None:
+        out = numpy.empty(images.shape, dtype=numpy.uint8)
+
+    if method == 'clahe_temporal':
+        # the temporal CLAHE runs on the frame-major high bytes, in blocks carrying the last histograms so only
+        # one block of float histograms is in memory however long the stack is
+        history = {} if history is None else history
+        for start in range(0, images.shape[2], _temporal_block_frames):
+            stop = min(start + _temporal_block_frames, images.shape[2])
+            frames = numpy.ascontiguousarray(numpy.moveaxis(_shift_lut()[images[:, :, start:stop]], 2, 0))
+            out[:, :, start:stop] = numpy.moveaxis(clahe_temporal_stack(frames, window=window, history=history), 0, 2)
+        return out
+    if method == 'bytescale' and (cmin is None or cmax is None):
+        cmin = images.min(axis=(0, 1)) if cmin is None else cmin
+        cmax = images.max(axis=(0, 1)) if cmax is None else cmax
+
+    # pixel methods split the rows between the threads, OpenCV methods split the frames
+    if method in _pixel_methods:
+        func, size = _process_rows, images.shape[0]
+    else:
+        func, size = _process_frames, images.shape[2]
+    threads = max(1, min(threads, size))
+    bounds = numpy.linspace(0, size, threads+1).astype(int)
+    if threads == 1:
+        func(images, out, method, 0, size, cmin, cmax)
+    elif executor is None:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            _run_ranges(executor, func, images, out, method, bounds, cmin, cmax)
+    else:
+        _run_ranges(executor, func, images, out, method, bounds, cmin, cmax)
+    return out
+
+# run func on each range between bounds in the thread pool
+def _run_ranges(executor, func, images, out, method, bounds, cmin, cmax):
+    futures = [executor.submit(func, images, out, method, bounds[i], bounds[i+1], cmin, cmax)
+               for i in range(len(bounds)-1)]
+    for future in futures:
+        future.result()
+
+# read pgm files into a preallocated uint16 block of shape (256, 256, n) with threads
+def _read_pgm_block(pgm_file_paths, block, executor):
+    def read(frame):
+        block[:, :, frame] = cv2.imread(pgm_file_paths[frame], -1)
+    list(executor.map(read, range(len(pgm_file_paths))))
+    return block
+
+# read and process one block of frames into out, with the threads of executor
+def _process_block(images, start, stop, method, processes, block, out, executor, history, window):
+    if isinstance(images, list):
+        with instrumentation.span('decode pgm') as record:
+            stack = _read_pgm_block(images[start:stop], block[:, :, :stop-start], executor)
+            record.update(frames=stop-start, bytes_read=stack.nbytes)
+    else:
+        stack = images[:, :, start:stop]
+    with instrumentation.span('contrast', method=method) as record:
+        process_stack(stack, method, processes, out=out[:, :, :stop-start], executor=executor, history=history,
+                      window=window)
+        record['frames'] = stop - start
+    return out[:, :, :stop-start]
+
+# process pgm paths or an in-memory uint16 stack in blocks of chunksize frames, yielding the frames in order.
+# Two blocks are in memory: the next block is read and processed in the background while the frames of the current
+# one are consumed, so memory stays constant however long the night is and processing overlaps the encoding.
+def _process_stack_iter(images, method='None', processes=8, chunksize=64, window=_temporal_window):
+    frame_num = len(images) if isinstance(images, list) else images.shape[2]
+    outs = [numpy.empty((256, 256, chunksize), dtype=numpy.uint8) for _ in range(2)]
+    blocks = [numpy.empty((256, 256, chunksize), dtype=numpy.uint16) for _ in range(2)]
+    history = {}
+    starts = list(range(0, frame_num, chunksize))
+    # the blocks are processed in order by one background thread, which uses the threads of executor
+    with ThreadPoolExecutor(max_workers=processes) as executor, ThreadPoolExecutor(max_workers=1) as prefetch:
+        def submit(k):
+            stop = min(starts[k] + chunksize, frame_num)
+            return prefetch.submit(_process_block, images, starts[k], stop, method, processes, blocks[k % 2],
+                                   outs[k % 2], executor, history, window)
+        future = submit(0) if starts else None
+        for k in range(len(starts)):
+            processed = future.result()
+            # the other buffer pair is free once the frames of block k-1 were all yielded
+            future = submit(k + 1) if k + 1 < len(starts) else None
+            for frame in range(processed.shape[2]):
+                yield numpy.ascontiguousarray(processed[:, :, frame])
+
+# default constant rate factor of the ffmpeg codecs, about the same visual quality
+_default_crf = {'libx264': 23, 'libx265': 28, 'libvpx-vp9': 31}
+
+# OpenCV video writer of 8 bit gray frames, returns its write and release functions
+def _opencv_encoder(video_path, fps, frame_size):
+    video_writer = cv2.VideoWriter(
+        video_path, cv2.VideoWriter_fourcc('m', 'p', '4', 'v'), fps, frame_size, 0)
+    return video_writer.write, video_writer.release
+
+# ffmpeg subprocess reading raw 8 bit gray frames from a pipe, returns its write and release functions
+def _ffmpeg_encoder(video_path, fps, frame_size, codec='libx264', crf=None, preset='medium', threads=0):
+    crf = _default_crf.get(codec, 23) if crf is None else crf
+    command = ['ffmpeg', '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'gray', '-s', f'{frame_size[0]}x{frame_size[1]}', '-r', str(fps), '-i', '-',
+               '-c:v', codec, '-crf', str(crf), '-threads', str(threads), '-pix_fmt', 'yuv420p']
+    if codec.startswith('libvpx'):
+        # constant quality mode of VP9 needs a zero bitrate
+        command += ['-b:v', '0', '-row-mt', '1']
+    else:
+        command += ['-preset', preset]
+    command.append(video_path)
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    # close the pipe and wait for ffmpeg, a broken pipe means it already exited and its exit code tells why
+    def finish():
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return process.wait()
+
+    broken = []
+    def write(image):
+        try:
+            process.stdin.write(numpy.ascontiguousarray(image).tobytes())
+        except BrokenPipeError:
+            broken.append(True)
+            raise RuntimeError(f'ffmpeg exited with code {finish()} while encoding {video_path}') from None
+
+    # the exit code was already raised by write when the pipe broke
+    def release():
+        if finish() != 0 and not broken:
+            raise RuntimeError(f'ffmpeg failed with exit code {process.returncode} for {video_path}')
+    return write, release
+
+# temporary name of a video while it is encoded, the extension is kept so the encoders pick the same container.
+# Example: './videos/gako20200104video.mp4' -> './videos/gako20200104video.1234.part.mp4'
+def _part_video_path(video_path):
+    root, extension = os.path.splitext(video_path)
+    return f'{root}.{os.getpid()}.part{extension}'
+
+# stitch processed images into a video, processed_images can be a generator consumed frame by frame.
+# The encoder is an ffmpeg pipe when ffmpeg is installed, otherwise OpenCV
+def _write_mp4(processed_images, camera_date, video_folder_path, file_suffix, encoder='ffmpeg', codec='libx264',
+               crf=None, preset='medium', threads=0, fps=30, frame_size=(256, 256)):
+    # create video_folder if not exists
+    if not os.path.exists(video_folder_path):
+            os.makedirs(video_folder_path)
 
     # Initialize the video writer
-    camera_date = pgm_file_paths[0].split('/')[-1][:12]
     video_path = os.path.join(
         video_folder_path, camera_date+file_suffix)
-    logging.info(f'video_path = {video_path}, file name = {camera_date}')
-    video_writer = cv2.VideoWriter(
-        video_path, cv2.VideoWriter_fourcc('m', 'p', '4', 'v'), 30, (256, 256), 0)
+    logging.info(f'video_path = {video_path}, file name = {camera_date}, encoder = {encoder}')
+    # yuv420p and most codecs halve the chroma resolution, so odd sizes fail once ffmpeg sees the first frame
+    if frame_size[0] % 2 or frame_size[1] % 2:
+        raise ValueError(f'frame_size should be even, got {frame_size}')
+    if encoder == 'ffmpeg' and shutil.which('ffmpeg') is None:
+        logging.critical('ffmpeg not found, using the OpenCV encoder.')
+        encoder = 'opencv'
+    # written under a temporary name so a failed or killed run never leaves a truncated video
+    part_path = _part_video_path(video_path)
+    if encoder == 'ffmpeg':
+        write, release = _ffmpeg_encoder(part_path, fps, frame_size, codec, crf, preset, threads)
+    else:
+        if encoder != 'opencv':
+            logging.critical(f'encoder {encoder} not available, using the OpenCV encoder.')
+        write, release = _opencv_encoder(part_path, fps, frame_size)
 
     frame_number = 0
-    for image in processed_images:
-        cv2.putText(image, str(frame_number), (10, 50),
-                     cv2.FONT_HERSHEY_SIMPLEX, 0.5, (209, 80, 0, 255), 1)
-        video_writer.write(image)
-        frame_number = frame_number + 1
-
-    # Release the video writer
-    video_writer.release()
+    released = False
+    with instrumentation.span('encode', encoder=encoder, **instrumentation.name_labels([camera_date])) as record:
+        try:
+            for image in processed_images:
+                cv2.putText(image, str(frame_number), (10, 50),
+                             cv2.FONT_HERSHEY_SIMPLEX, 0.5, (209, 80, 0, 255), 1)
+                if image.shape[1::-1] != tuple(frame_size):
+                    image = cv2.resize(image, tuple(frame_size), interpolation=cv2.INTER_LINEAR)
+                write(image)
+                frame_number = frame_number + 1
+            # Release the video writer
+            released = True
+            release()
+        except BaseException:
+            # stop the encoder without hiding the first error, and drop the partial video
+            if not released:
+                try:
+                    release()
+                except Exception as e:
+                    logging.critical(f'unable to release the encoder of {video_path}, error = {e}')
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        os.replace(part_path, video_path)
+        record.update(frames=frame_number, bytes_written=os.path.getsize(video_path))
     logging.info(f'video converted at {video_path}')
     return video_path
 
-@_timeit
-def pgm_images_to_h5(decompressed_folder_path, h5_folder_path='./h5s', file_suffix='.h5', method='None', processes=8):
-    """ Process and stitch decompressed pgm images to form h5 file
-    Inputs: 
-        decompressed_folder_path: str. Example: './images/gako/2020-01-31-decompressed'
-        video_folder_path: str. Folder path to store h5 files
-        file_suffix: str. Suffix of the created file. Use it to distinguish h5s using different processing skills.
-        method: str. Options: 'bytescale', 'eqhist', 'relu', 'clahe'. Default to not processing the images
-        processes: int. Number of processes called in multiprocessing.
+# description of the skymap datasets
+_skymap_about = {'skymap_alt': 'Altitudes for different skymaps.',
+                 'skymap_glat': 'Geographic latitude at pixel corner, excluding last.',
+                 'skymap_glon': 'Geographic longitude at pixel corner, excluding last.',
+                 'skymap_elev': 'Elevation angle of pixel center.',
+                 'skymap_azim': 'Azimuthal angle of pixel center.'}
+
+# parse the arrays of an IDL skymap .sav file
+def _read_skymap(skymap_path):
+    skymap = readsav(skymap_path, python_dict=True)['skymap']
+    return {'skymap_alt': skymap['FULL_MAP_ALTITUDE'][0],
+            'skymap_glat': skymap['FULL_MAP_LATITUDE'][0][:, 0:-1, 0:-1],
+            'skymap_glon': skymap['FULL_MAP_LONGITUDE'][0][:, 0:-1, 0:-1],
+            'skymap_elev': skymap['FULL_ELEVATION'][0],
+            'skymap_azim': skymap['FULL_AZIMUTH'][0]}
+
+# write the skymap arrays and their descriptions into an open h5 file
+def _write_skymap_datasets(h5f, skymap_arrays):
+    for name, about in _skymap_about.items():
+        ds = h5f.create_dataset(name, shape=skymap_arrays[name].shape, dtype='float', data=skymap_arrays[name])
+        ds.attrs['about'] = about
+
+# (site, skymap date) of a skymap file. Example: 'themis_skymap_gako_20190312-+_v02.sav' -> ('gako', '20190312')
+def _skymap_key(skymap_path):
+    match = re.search(r'skymap_([a-z]{4})_(\d{8})', os.path.basename(skymap_path))
+    if match is None:
+        return os.path.splitext(os.path.basename(skymap_path))[0], ''
+    return match.group(1), match.group(2)
+
+def cache_skymap(skymap_path, skymap_folder_path='./skymaps'):
+    """ Parse a skymap .sav file once into a h5 file shared by all the nights of the same (site, skymap date)
+    Inputs:
+        skymap_path: str. Example: './images/gako/2020-01-31/themis_skymap_gako_20190312-+_v02.sav'
+        skymap_folder_path: str. Folder of the cached skymaps
     Returns:
-        h5_path: str. Example: './h5s/gako20161013clahe.h5'
+        cached_skymap_path: str. Example: './skymaps/gako_20190312_skymap.h5'
     """
-    logging.info('h5 convertion start')
+    site, skymap_date = _skymap_key(skymap_path)
+    file_name = f'{site}_{skymap_date}_skymap.h5' if skymap_date else f'{site}_skymap.h5'
+    cached_skymap_path = os.path.join(skymap_folder_path, file_name)
+    if os.path.exists(cached_skymap_path):
+        return cached_skymap_path
+
+    if not os.path.exists(skymap_folder_path):
+        os.makedirs(skymap_folder_path, exist_ok=True)
+    skymap_arrays = _read_skymap(skymap_path)
+    logging.info('Read in skymap file from: {}'.format(skymap_path))
+
+    # written under a temporary name so concurrent nights never link a partial file
+    with h5py.File(cached_skymap_path+f'.{os.getpid()}.part', 'w') as h5f:
+        _write_skymap_datasets(h5f, skymap_arrays)
+        h5f.attrs['site'] = site
+        h5f.attrs['skymap_date'] = skymap_date
+        h5f.attrs['source'] = os.path.basename(skymap_path)
+    os.replace(cached_skymap_path+f'.{os.getpid()}.part', cached_skymap_path)
+    logging.info(f'skymap cached at {cached_skymap_path}')
+    return cached_skymap_path
 
+# dataset filter arguments of h5py for a compression option
+def _h5_filters(compression=None, compression_opts=None, shuffle=False):
+    filters = {'shuffle': bool(shuffle)}
+    if compression == 'lz4':
+        if hdf5plugin is None:
+            logging.critical('lz4 needs the hdf5plugin package, using gzip instead.')
+            compression = 'gzip'
+        else:
+            filters.update(hdf5plugin.LZ4())
+            return filters
+    if compression is not None:
+        filters['compression'] = compression
+        filters['compression_opts'] = compression_opts
+    return filters
+
+# stitch processed images, timestamps and the skymap into a h5 file.
+# processed_images can be a generator, frames are appended in blocks together with their timestamps
+def _write_h5(processed_images, image_names, skymap_path, camera_date, h5_folder_path, file_suffix, data_dtype,
+              chunk_frames=1, compression=None, compression_opts=None, shuffle=False, layout='time_last',
+              skymap_folder_path='./skymaps'):
     # create h5 file folder if not exists
     if not os.path.exists(h5_folder_path):
         os.makedirs(h5_folder_path)
 
-    # Initialize a list to store the paths to the decompressed pgm files and read in skymap
-    pgm_file_paths = []
-    timestamps = []
-    for file_name in os.listdir(decompressed_folder_path):
-        if not file_name.startswith('.'):
-            if file_name.endswith('.pgm'):
-                # extract the time
-                timestamp_str = re.findall(r'\d{14}', file_name)[0]
-                timestamp = datetime.datetime.strptime(timestamp_str, '%Y%m%d%H%M%S')
-                timestamps.append(timestamp)
-                # add pgm image path
-                pgm_file_paths.append(os.path.join(decompressed_folder_path, file_name))
-            elif file_name.endswith('.sav'):
-                skymap_path = os.path.join(decompressed_folder_path, file_name)
-    
-    # Sort the list of pgm files -- needed as we decompressed using multithreading
-    pgm_file_paths.sort()
-
-    # process the images
-    with multiprocessing.Pool(processes=processes) as pool:
-        # process all images using the pool of worker processes
-        if method == 'bytescale':
-            processed_images = pool.map(_bytescale, pgm_file_paths)
-        elif method == 'eqhist':
-            processed_images = pool.map(_eqhist, pgm_file_paths)
-        elif method == 'relu':
-            processed_images = pool.map(_relu, pgm_file_paths)
-        elif method == 'clahe':
-            processed_images = pool.map(_clahe, pgm_file_paths)
-        elif method == 'clahe16':
-            processed_images = pool.map(_clahe16bit, pgm_file_paths)
-        elif method =='None':
-            processed_images = pool.map(_read_img, pgm_file_paths)
-        else: 
-            logging.critical('method not available, using non-processed images.')
-            processed_images = pool.map(_read_img, pgm_file_paths)
-    
-    # Stack the images into a 3D NumPy array
-    processed_images_array = numpy.stack(processed_images, axis=-1)
-    #logging.info(f'processed_images shape = {processed_images_array.shape}')
     # Stack the timestamps into the format
+    timestamps = [datetime.datetime.strptime(re.findall(r'\d{14}', name)[0], '%Y%m%d%H%M%S')
+                  for name in image_names]
     timestamps_array = numpy.array([int(t.timestamp()) for t in timestamps])
 
+    # the skymap is linked from the cache, or copied into the file when there is no cache
+    skymap_arrays = None
+    cached_skymap_path = None
     try:
-        # Try reading IDL save file
-        skymap = readsav(skymap_path, python_dict=True)['skymap']
-
-        # Get arrays
-        skymap_alt = skymap['FULL_MAP_ALTITUDE'][0]
-        skymap_glat = skymap['FULL_MAP_LATITUDE'][0][:, 0:-1, 0:-1]
-        skymap_glon = skymap['FULL_MAP_LONGITUDE'][0][:, 0:-1, 0:-1]
-        skymap_elev = skymap['FULL_ELEVATION'][0]
-        skymap_azim = skymap['FULL_AZIMUTH'][0]
-
-        logging.info('Read in skymap file from: {}'.format(skymap_path))
+        if skymap_folder_path is not None:
+            cached_skymap_path = cache_skymap(skymap_path, skymap_folder_path)
+        else:
+            skymap_arrays = _read_skymap(skymap_path)
+            logging.info('Read in skymap file from: {}'.format(skymap_path))
 
     except Exception as e:
         logging.error('Unable to read skymap file, creating file without it.')
         logging.error('Exception: {}'.format(e))
-
-        skymap_alt = numpy.array(['Unavailable'])
-        skymap_glat = numpy.array(['Unavailable'])
-        skymap_glon = numpy.array(['Unavailable'])
-        skymap_elev = numpy.array(['Unavailable'])
-        skymap_azim = numpy.array(['Unavailable'])
     
     # Initialize the h5 file 
-    camera_date = pgm_file_paths[0].split('/')[-1][:12]
     h5_path = os.path.join(h5_folder_path, camera_date+file_suffix)
     logging.info(f'video_path = {h5_path}, file name = {camera_date}')
 
+    # frames are written in blocks of whole chunks to bound the memory
+    block_frames = chunk_frames * max(1, _h5_block_frames // chunk_frames)
+    if layout not in _h5_frame_axis:
+        logging.critical(f'layout {layout} not available, using time_last.')
+        layout = 'time_last'
+    frame_axis = _h5_frame_axis[layout]
+
     # Write in information
 
-    data_dtype = 'uint16' if method=='None' else 'uint8'
-    with h5py.File(h5_path, 'w') as h5f:
-
-        # Initialize the datasets for images and timestamps
-        img_ds = h5f.create_dataset('images', dtype=data_dtype, 
-                                    data=processed_images_array)
-
-        time_ds = h5f.create_dataset('timestamps', dtype='uint64',
-                                     data = timestamps_array)
-
-        alt_ds = h5f.create_dataset('skymap_alt', shape=skymap_alt.shape,
-                                    dtype='float', data=skymap_alt)
-
-        glat_ds = h5f.create_dataset('skymap_glat', shape=skymap_glat.shape,
-                                     dtype='float', data=skymap_glat)
-
-        glon_ds = h5f.create_dataset('skymap_glon', shape=skymap_glon.shape,
-                                     dtype='float', data=skymap_glon)
-
-        elev_ds = h5f.create_dataset('skymap_elev', shape=skymap_elev.shape,
-                                     dtype='float', data=skymap_elev)
-
-        azim_ds = h5f.create_dataset('skymap_azim', shape=skymap_azim.shape,
-                                     dtype='float', data=skymap_azim)
-        
-        # Add attributes to datasets
-        time_ds.attrs['about'] = ('UT POSIX Timestamp.'
-                                  ' Use datetime.fromtimestamp '
-                                  'to convert. Time is start of image.'
-                                  ' 1 second exposure.')
-        img_ds.attrs['wavelength'] = 'white'
-        # img_ds.attrs['station_latitude'] = float(meta[0]['Geodetic latitude'])
-        # img_ds.attrs['station_longitude'] = float(meta[0]['Geodetic Longitude'])
-        alt_ds.attrs['about'] = 'Altitudes for different skymaps.'
-        glat_ds.attrs['about'] = 'Geographic latitude at pixel corner, excluding last.'
-        glon_ds.attrs['about'] = 'Geographic longitude at pixel corner, excluding last.'
-        elev_ds.attrs['about'] = 'Elevation angle of pixel center.'
-        azim_ds.attrs['about'] = 'Azimuthal angle of pixel center.'
+    with instrumentation.span('write h5', **instrumentation.name_labels([camera_date])) as record:
+        with h5py.File(h5_path, 'w') as h5f:
+
+            # Initialize the resizable datasets for images and timestamps, one chunk every chunk_frames frames
+            img_ds = h5f.create_dataset('images', shape=_h5_frame_shape(0, frame_axis), maxshape=_h5_frame_shape(None, frame_axis),
+                                        dtype=data_dtype, chunks=_h5_frame_shape(chunk_frames, frame_axis),
+                                        **_h5_filters(compression, compression_opts, shuffle))
+            img_ds.attrs['layout'] = layout
+
+            time_ds = h5f.create_dataset('timestamps', shape=(0,), maxshape=(None,), dtype='uint64',
+                                         chunks=(max(chunk_frames, 1024),))
+
+            # Add attributes to datasets
+            time_ds.attrs['about'] = ('UT POSIX Timestamp.'
+                                      ' Use datetime.fromtimestamp '
+                                      'to convert. Time is start of image.'
+                                      ' 1 second exposure.')
+            img_ds.attrs['wavelength'] = 'white'
+            # img_ds.attrs['station_latitude'] = float(meta[0]['Geodetic latitude'])
+            # img_ds.attrs['station_longitude'] = float(meta[0]['Geodetic Longitude'])
+
+            # skymap datasets
+            if cached_skymap_path is not None:
+                # relative links keep working when the h5 and skymap folders are moved together
+                link_path = os.path.relpath(cached_skymap_path, h5_folder_path)
+                for name in _skymap_about:
+                    h5f[name] = h5py.ExternalLink(link_path, name)
+            elif skymap_arrays is not None:
+                _write_skymap_datasets(h5f, skymap_arrays)
+            else:
+                for name in _skymap_about:
+                    h5f.create_dataset(name, data=numpy.array([b'Unavailable']))
+
+            # append the frames as they are processed, with their timestamps in lockstep
+            block = numpy.empty(_h5_frame_shape(block_frames, frame_axis), dtype=data_dtype)
+            block_view = numpy.moveaxis(block, frame_axis, 0)
+            frame_num = 0
+            block_num = 0
+            for image in processed_images:
+                block_view[block_num] = image
+                block_num += 1
+                if block_num == block_frames:
+                    _append_h5_frames(img_ds, time_ds, block, timestamps_array[frame_num:frame_num+block_num], frame_axis)
+                    frame_num += block_num
+                    block_num = 0
+            if block_num:
+                block = numpy.take(block, range(block_num), axis=frame_axis)
+                _append_h5_frames(img_ds, time_ds, block, timestamps_array[frame_num:frame_num+block_num], frame_axis)
+                frame_num += block_num
+        record.update(frames=frame_num, bytes_written=os.path.getsize(h5_path))
     
-    logging.info(f'h5 file converted at {h5_path}')
+    logging.info(f'h5 file converted at {h5_path}, {frame_num} frames')
     return h5_path
 
+# shape of the images dataset with frame_num frames along frame_axis
+def _h5_frame_shape(frame_num, frame_axis):
+    return (frame_num, 256, 256) if frame_axis == 0 else (256, 256, frame_num)
+
+# append a block of frames and their timestamps, the frames are along frame_axis of the block
+def _append_h5_frames(img_ds, time_ds, frames, timestamps, frame_axis=2):
+    start = img_ds.shape[frame_axis]
+    n = frames.shape[frame_axis]
+    img_ds.resize(start + n, axis=frame_axis)
+    if frame_axis == 0:
+        img_ds[start:] = frames
+    else:
+        img_ds[:, :, start:] = frames
+    time_ds.resize(start + n, axis=0)
+    time_ds[start:] = timestamps
+
+def read_h5_window(h5_path, start, end):
+    """ Read the frames of a time window from a h5 file made by pgm_images_to_h5() or images_to_h5()
+    Only the chunks holding the window are read, frame_major files with one frame per chunk are the fastest.
+    Inputs:
+        h5_path: str. Example: './h5s/gako20161013clahe.h5'
+        start: datetime object. First image start time included, in the same convention as the timestamps dataset
+        end: datetime object. Image start times before end are included
+    Returns:
+        images: numpy.ndarray. Shape (n, 256, 256) for frame_major files and (256, 256, n) for time_last files
+        timestamps: numpy.ndarray. uint64 POSIX timestamps of the n frames
+    """
+    with h5py.File(h5_path, 'r') as h5f:
+        # the timestamps are sorted, so the window is a slice found by binary search
+        timestamps = h5f['timestamps'][:]
+        first = numpy.searchsorted(timestamps, int(start.timestamp()), side='left')
+        last = numpy.searchsorted(timestamps, int(end.timestamp()), side='left')
+        img_ds = h5f['images']
+        if img_ds.attrs.get('layout', 'time_last') == 'frame_major':
+            images = img_ds[first:last]
+        else:
+            images = img_ds[:, :, first:last]
+    return images, timestamps[first:last]
+
+
+@instrumentation.timed
+def pgm_images_to_mp4(decompressed_folder_path, video_folder_path='./videos', file_suffix='video.mp4', method='None', processes=8, chunksize=64,
+                      window=_temporal_window, encoder='ffmpeg', codec='libx264', crf=None, preset='medium', threads=0, fps=30, frame_size=(256, 256)):
+    """ Process and stitch decompressed pgm images to form video
+    Inputs: 
+        decompressed_folder_path: str. Example: './images/gako/2020-01-31-decompressed'
+        video_folder_path: str. Folder path to store videos
+        file_suffix: str. Suffix of the created file. Use it to distinguish videos using different processing skills.
+        method: str. Options: 'bytescale', 'eqhist', 'relu', 'clahe', 'clahe16', 'clahe_temporal'. Default to not processing the images
+        processes: int. Number of threads processing the frames.
+        chunksize: int. Number of frames processed at once. Frames are encoded in order as their block completes.
+        window: int. Number of frames whose tile histograms 'clahe_temporal' averages, 1 is plain CLAHE
+        encoder: str. Options: 'ffmpeg' pipes the frames to ffmpeg, 'opencv' uses cv2.VideoWriter with mp4v. ffmpeg falls back to opencv when it is not installed
+        codec: str. ffmpeg codec. Options: 'libx264', 'libx265', 'libvpx-vp9' (use a '.webm' file_suffix)
+        crf: int or None. ffmpeg constant rate factor, lower is better quality. Default depends on the codec
+        preset: str. ffmpeg x264/x265 preset. Example: 'veryfast', 'medium', 'slow'
+        threads: int. ffmpeg encoder threads, 0 lets ffmpeg decide
+        fps: int. Frame rate of the video
+        frame_size: tuple. Even (width, height) of the video, frames are resized when it is not (256, 256)
+    Returns:
+        video_path: str. Example: './videos/gako20161013clahe.mp4'
+    """
+    logging.info('video convertion start')
+
+    # Initialize a list to store the paths to the decompressed pgm files
+    pgm_file_paths, skymap_path = _list_pgm_files(decompressed_folder_path)
+
+    processed_images = _process_stack_iter(pgm_file_paths, method, processes, chunksize, window)
+
+    camera_date = pgm_file_paths[0].split('/')[-1][:12]
+    return _write_mp4(processed_images, camera_date, video_folder_path, file_suffix, encoder, codec, crf, preset, threads,
+                      fps, frame_size)
+
+@instrumentation.timed
+def images_to_mp4(images, image_names, video_folder_path='./videos', file_suffix='video.mp4', method='None', processes=8, chunksize=64,
+                  window=_temporal_window, encoder='ffmpeg', codec='libx264', crf=None, preset='medium', threads=0, fps=30, frame_size=(256, 256)):
+    """ Process and stitch in-memory images to form video, without intermediate pgm files
+    Inputs: 
+        images: numpy.ndarray. uint16 frames of shape (256, 256, N) from list_and_decompress_images()
+        image_names: list of str. Example: ['gako20200131000003', ...], one per frame
+        video_folder_path: str. Folder path to store videos
+        file_suffix: str. Suffix of the created file. Use it to distinguish videos using different processing skills.
+        method: str. Options: 'bytescale', 'eqhist', 'relu', 'clahe', 'clahe16', 'clahe_temporal'. Default to not processing the images
+        processes: int. Number of threads processing the frames.
+        chunksize: int. Number of frames processed at once. Frames are encoded in order as their block completes.
+        window: int. Number of frames whose tile histograms 'clahe_temporal' averages, 1 is plain CLAHE
+        encoder: str. Options: 'ffmpeg' pipes the frames to ffmpeg, 'opencv' uses cv2.VideoWriter with mp4v. ffmpeg falls back to opencv when it is not installed
+        codec: str. ffmpeg codec. Options: 'libx264', 'libx265', 'libvpx-vp9' (use a '.webm' file_suffix)
+        crf: int or None. ffmpeg constant rate factor, lower is better quality. Default depends on the codec
+        preset: str. ffmpeg x264/x265 preset. Example: 'veryfast', 'medium', 'slow'
+        threads: int. ffmpeg encoder threads, 0 lets ffmpeg decide
+        fps: int. Frame rate of the video
+        frame_size: tuple. Even (width, height) of the video, frames are resized when it is not (256, 256)
+    Returns:
+        video_path: str. Example: './videos/gako20161013clahe.mp4'
+    """
+    logging.info('video convertion start')
+
+    processed_images = _process_stack_iter(images, method, processes, chunksize, window)
+
+    camera_date = image_names[0][:12]
+    return _write_mp4(processed_images, camera_date, video_folder_path, file_suffix, encoder, codec, crf, preset, threads,
+                      fps, frame_size)
+
+@instrumentation.timed
+def pgm_images_to_h5(decompressed_folder_path, h5_folder_path='./h5s', file_suffix='.h5', method='None', processes=8,
+                     chunk_frames=1, compression=None, compression_opts=None, shuffle=False, layout='time_last',
+                     skymap_folder_path='./skymaps', window=_temporal_window):
+    """ Process and stitch decompressed pgm images to form h5 file
+    Inputs: 
+        decompressed_folder_path: str. Example: './images/gako/2020-01-31-decompressed'
+        video_folder_path: str. Folder path to store h5 files
+        file_suffix: str. Suffix of the created file. Use it to distinguish h5s using different processing skills.
+        method: str. Options: 'bytescale', 'eqhist', 'relu', 'clahe', 'clahe16', 'clahe_temporal'. Default to not processing the images
+        processes: int. Number of threads processing the frames.
+        chunk_frames: int. Number of frames in each h5 chunk, 1 gives the fastest single frame reads
+        compression: str or None. Options: 'gzip', 'lzf', 'lz4' (needs hdf5plugin). Default to no compression
+        compression_opts: int or None. gzip level from 0 to 9
+        shuffle: Bool. Apply the shuffle filter before compression, helps uint16 images
+        layout: str. Options: 'time_last' stores images as (256, 256, N), 'frame_major' as (N, 256, 256) for fast time slices
+        skymap_folder_path: str or None. Folder of the skymap cache, the h5 file links the skymap datasets from it. None copies them into the file
+        window: int. Number of frames whose tile histograms 'clahe_temporal' averages, 1 is plain CLAHE
+    Returns:
+        h5_path: str. Example: './h5s/gako20161013clahe.h5'
+    """
+    logging.info('h5 convertion start')
+
+    # Initialize a list to store the paths to the decompressed pgm files and read in skymap
+    pgm_file_paths, skymap_path = _list_pgm_files(decompressed_folder_path)
+    image_names = [os.path.basename(path)[:-len('.pgm')] for path in pgm_file_paths]
+
+    # process the images
+    processed_images = _process_stack_iter(pgm_file_paths, method, processes, window=window)
+
+    camera_date = pgm_file_paths[0].split('/')[-1][:12]
+    data_dtype = 'uint16' if method=='None' else 'uint8'
+    return _write_h5(processed_images, image_names, skymap_path, camera_date, h5_folder_path, file_suffix, data_dtype,
+                     chunk_frames, compression, compression_opts, shuffle, layout, skymap_folder_path)
+
+@instrumentation.timed
+def images_to_h5(images, image_names, skymap_path=None, h5_folder_path='./h5s', file_suffix='.h5', method='None', processes=8,
+                 chunk_frames=1, compression=None, compression_opts=None, shuffle=False, layout='time_last',
+                 skymap_folder_path='./skymaps', window=_temporal_window):
+    """ Process and stitch in-memory images to form h5 file, without intermediate pgm files
+    Inputs: 
+        images: numpy.ndarray. uint16 frames of shape (256, 256, N) from list_and_decompress_images()
+        image_names: list of str. Example: ['gako20200131000003', ...], one per frame
+        skymap_path: str or None. Path to the skymap .sav file
+        h5_folder_path: str. Folder path to store h5 files
+        file_suffix: str. Suffix of the created file. Use it to distinguish h5s using different processing skills.
+        method: str. Options: 'bytescale', 'eqhist', 'relu', 'clahe', 'clahe16', 'clahe_temporal'. Default to not processing the images
+        processes: int. Number of threads processing the frames.
+        chunk_frames: int. Number of frames in each h5 chunk, 1 gives the fastest single frame reads
+        compression: str or None. Options: 'gzip', 'lzf', 'lz4' (needs hdf5plugin). Default to no compression
+        compression_opts: int or None. gzip level from 0 to 9
+        shuffle: Bool. Apply the shuffle filter before compression, helps uint16 images
+        layout: str. Options: 'time_last' stores images as (256, 256, N), 'frame_major' as (N, 256, 256) for fast time slices
+        skymap_folder_path: str or None. Folder of the skymap cache, the h5 file links the skymap datasets from it. None copies them into the file
+        window: int. Number of frames whose tile histograms 'clahe_temporal' averages, 1 is plain CLAHE
+    Returns:
+        h5_path: str. Example: './h5s/gako20161013clahe.h5'
+    """
+    logging.info('h5 convertion start')
+
+    processed_images = _process_stack_iter(images, method, processes, window=window)
+
+    camera_date = image_names[0][:12]
+    data_dtype = 'uint16' if method=='None' else 'uint8'
+    return _write_h5(processed_images, image_names, skymap_path, camera_date, h5_folder_path, file_suffix, data_dtype,
+                     chunk_frames, compression, compression_opts, shuffle, layout, skymap_folder_path)